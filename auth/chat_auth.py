@@ -1,61 +1,168 @@
-import mysql.connector
-
-# establishes a connection to the MySQL database using the mysql.connector library
-# connects to the database specified by the host, user, password and database parameters
-# in this case -- localhost, root, root and chatroom
-# the connection object returned can be used to interact with the database
-def get_db_connection() :
-    return mysql.connector.connect (
-        host = "localhost",
-        user = "root",
-        password = "root",
-        database = "chatroom"
-    )
-
-# responsible for registering a new user in the users table of the chatroom database
-# takes a username and a password as inputs and attempts to insert them into the users table
-# if the username is already in use (a duplicate entry), the function will catch the error and return False
-# Otherwise, the user is successfully registered and the function returns True
-def register_user(username, password) :
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try :
-        cursor.execute("INSERT INTO users (username, password) VALUES (%s, %s)", (username, password))
-        conn.commit()
-        return True
-    except mysql.connector.IntegrityError :
-        return False
-    finally :
-        cursor.close()
-        conn.close()
-
-# checks if a user exists in the database with the provided username and password
-# performs a SELECT query on the users table and returns True if a matching record is found
-# if no such record exists, the function returns False, indicating that the authentication has failed
-def authenticate_user(username, password):
-    try:
-        # Establish the connection to the database
-        conn = get_db_connection()
-        cursor = conn.cursor(dictionary=True)
-
-        # Execute the query to find the user with the provided username and password
-        cursor.execute("SELECT * FROM users WHERE username = %s AND password = %s", (username, password))
-
-        # Fetch a single result (user) from the query
-        result = cursor.fetchone()
-
-        # Close the cursor and connection after the operation
-        cursor.close()
-        conn.close()
-
-        # Return True if the user was found, otherwise False
-        return result is not None
-
-    except mysql.connector.Error as err:
-        # Log the MySQL error (for debugging purposes)
-        print(f"MySQL error during authentication: {err}")
-        return False
-    except Exception as e:
-        # Log any unexpected errors
-        print(f"Unexpected error during authentication: {e}")
-        return False
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+from auth import passwords
+from storage.backends import get_storage
+
+FAILURE_TTL = 60          # the seconds a failed login is remembered
+UNKNOWN_USER_TTL = 5      # the seconds a username with no user is remembered, short since another process may register it
+MAX_FAILURES = 20         # the failed logins of a username, within FAILURE_TTL, after which its logins fail without a check
+MAX_REMEMBERED = 100000   # the most failures remembered, the oldest are forgotten first
+
+# runs the calls of the same key one at a time : a call made while another one of the same key is running waits for it
+# and gets its result (or its exception) instead of running again
+class SingleFlight :
+    def __init__(self) :
+        self.calls = {}   # key -> [threading.Event set once the call is done, its result, its exception]
+        self.lock = threading.Lock()
+        self.coalesced = 0
+
+    def do(self, key, function) :
+        with self.lock :
+            call = self.calls.get(key)
+            leader = call is None
+            if leader :
+                call = self.calls[key] = [threading.Event(), None, None]
+            else :
+                self.coalesced += 1
+        if not leader :
+            call[0].wait()
+            if call[2] is not None :
+                raise call[2]
+            return call[1]
+        try :
+            call[1] = function()
+            return call[1]
+        except Exception as exception :
+            call[2] = exception
+            raise
+        finally :
+            with self.lock :
+                del self.calls[key]
+            call[0].set()
+
+# the recent failed logins, so that retrying them costs neither a query nor a hash
+# a failed password is remembered by its fingerprint (a keyed hash, the password itself is never kept), a username with no user
+# as failing every password, and a username with MAX_FAILURES failures within FAILURE_TTL too, until they expire
+# not thread safe on its own, the auth module only uses it while holding failures_lock
+class FailureCache :
+    def __init__(self, ttl = FAILURE_TTL, max_failures = MAX_FAILURES) :
+        self.ttl = ttl
+        self.max_failures = max_failures
+        self.entries = OrderedDict()   # (username, fingerprint) or (username, None) for the username -> [expiry time, failures]
+        self.rejected = 0
+
+    def get(self, key, now) :
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] <= now :
+            del self.entries[key]
+            entry = None
+        return entry
+
+    # True if the login is known to fail
+    def failing(self, username, fingerprint) :
+        now = time.monotonic()
+        user = self.get((username, None), now)
+        if self.get((username, fingerprint), now) is not None or (user is not None and user[1] >= self.max_failures) :
+            self.rejected += 1
+            return True
+        return False
+
+    def record(self, username, fingerprint, unknown_user) :
+        now = time.monotonic()
+        if unknown_user :
+            self.put((username, None), now + min(self.ttl, UNKNOWN_USER_TTL), self.max_failures)
+            return
+        self.put((username, fingerprint), now + self.ttl, 1)
+        user = self.get((username, None), now)
+        if user is None :
+            self.put((username, None), now + self.ttl, 1)
+        else :
+            user[1] += 1
+
+    def put(self, key, expiry, failures) :
+        self.entries[key] = [expiry, failures]
+        self.entries.move_to_end(key)
+        while len(self.entries) > MAX_REMEMBERED :
+            self.entries.popitem(last = False)
+
+    # forgets the failures of the username, after it logged in or was registered
+    def forget(self, username) :
+        self.entries.pop((username, None), None)
+
+    def __len__(self) :
+        return len(self.entries)
+
+fingerprint_key = os.urandom(32)
+failures = FailureCache()
+failures_lock = threading.Lock()
+lookups = SingleFlight()    # the queries of the users, by username
+attempts = SingleFlight()   # the logins, by username and password fingerprint
+
+# changes how long the failed logins are remembered and how many failures of a username stop its logins
+def configure(failure_ttl = None, max_failures = None) :
+    with failures_lock :
+        if failure_ttl is not None :
+            failures.ttl = failure_ttl
+        if max_failures is not None :
+            failures.max_failures = max_failures
+
+def fingerprint(password) :
+    return hmac.new(fingerprint_key, password.encode('utf-8'), hashlib.sha256).digest()
+
+# responsible for registering a new user in the users table of the chatroom database (see storage/backends.py)
+# takes a username and a password as inputs, hashes the password (see auth/passwords.py) and attempts to add them to the users of the storage
+# if the username is already in use (a duplicate entry), the function returns False
+# Otherwise, the user is successfully registered and the function returns True
+def register_user(username, password) :
+    if not get_storage().add_user(username, passwords.hash_password(password)) :
+        return False
+    with failures_lock :
+        failures.forget(username)
+    return True
+
+# checks if a user exists in the database with the provided username and password
+# the logins that failed recently fail again right away (see FailureCache), the same login tried by several clients at once
+# is checked once for all of them, and so is the query of a username (see SingleFlight)
+# if no such user exists, the function returns False, indicating that the authentication has failed
+def authenticate_user(username, password):
+    try:
+        key = fingerprint(password)
+        with failures_lock :
+            if failures.failing(username, key) :
+                return False
+        return attempts.do((username, key), lambda : check_login(username, password, key))
+
+    except Exception as e:
+        # Log the database error (for debugging purposes)
+        print(f"Database error during authentication: {e}")
+        return False
+
+def check_login(username, password, key) :
+    # Look the user up in the storage
+    user = lookups.do(username, lambda : get_storage().find_user(username))
+
+    # Return True if the user was found with this password, otherwise False
+    if user is None or not passwords.check_password(password, user["password"]) :
+        with failures_lock :
+            failures.record(username, key, user is None)
+        return False
+
+    with failures_lock :
+        failures.forget(username)
+    # the password stored before the hashing (or with another cost) is replaced by its hash, the login succeeds either way
+    if passwords.needs_upgrade(user["password"]) :
+        try :
+            get_storage().set_password(username, passwords.hash_password(password))
+        except Exception as exception :
+            print(f"Error hashing the stored password of {username} : {exception}")
+    return True
+
+def metrics() :
+    with failures_lock :
+        remembered, rejected = len(failures), failures.rejected
+    return {"coalesced_lookups" : lookups.coalesced, "coalesced_logins" : attempts.coalesced, "remembered_failures" : remembered,
+            "rejected_failures" : rejected, "passwords" : passwords.metrics()}
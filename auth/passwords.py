@@ -0,0 +1,112 @@
+import base64
+import concurrent.futures
+import hashlib
+import hmac
+import multiprocessing
+import os
+import threading
+
+# the hashing of the passwords of the users, with scrypt and a random salt per password
+# a stored password is "scrypt<log2 n>$<salt>$<key>" (the salt and the key base64 encoded), short enough for the
+# varchar(60) password column of the users table : r and p are fixed, only the cost n is kept with the password
+# the rows stored before the hashing hold the password itself, check_password still accepts them and needs_upgrade tells
+# the caller to store the hash instead (see authenticate_user in auth/chat_auth.py)
+# scrypt is slow on purpose, so the hashes are computed in a pool of worker processes : the thread of the connection
+# only waits for the result, it never holds the GIL the threads that serve the chat traffic need
+# the pool is forked when it starts (see start), the server starts it before its own threads
+SCRYPT_LOG_N = 14              # the cost of a new hash, n = 2 ** 14 takes about 16 MiB and some 50 ms of a core
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_BYTES = 12
+KEY_BYTES = 24
+HASH_WORKERS = min(4, os.cpu_count() or 1)   # the processes of the pool, 0 to hash in the calling thread
+
+hash_workers = HASH_WORKERS
+work_factor = SCRYPT_LOG_N
+pool = None
+pool_lock = threading.Lock()   # guards the creation of the pool and the counters
+counters = {'hashed' : 0, 'checked' : 0, 'plaintext' : 0}
+
+# changes the number of processes of the pool (from the next start) and the cost of the new hashes
+def configure(workers = None, log_n = None) :
+    global hash_workers, work_factor
+    if workers is not None :
+        hash_workers = workers
+    if log_n is not None :
+        work_factor = log_n
+
+def encode(data) :
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode('ascii')
+
+def decode(text) :
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+def derive(password, salt, log_n) :
+    return hashlib.scrypt(password.encode('utf-8'), salt = salt, n = 1 << log_n, r = SCRYPT_R, p = SCRYPT_P, dklen = KEY_BYTES)
+
+# the cost of the stored password, None if it is not a hash
+def hash_cost(stored) :
+    parts = stored.split("$")
+    if len(parts) != 3 or not parts[0].startswith("scrypt") or not parts[0][6:].isdigit() :
+        return None
+    return int(parts[0][6:])
+
+# runs in the pool
+def make_hash(password, log_n) :
+    salt = os.urandom(SALT_BYTES)
+    return f"scrypt{log_n}${encode(salt)}${encode(derive(password, salt, log_n))}"
+
+# runs in the pool
+def matches(password, stored) :
+    _, salt, key = stored.split("$")
+    return hmac.compare_digest(derive(password, decode(salt), hash_cost(stored)), decode(key))
+
+# starts the processes of the pool, with the fork start method all of them are forked right away,
+# so this is called while the process has a single thread
+def start() :
+    global pool
+    with pool_lock :
+        if pool is None and hash_workers :
+            context = multiprocessing.get_context("fork" if hasattr(os, "fork") else None)
+            pool = concurrent.futures.ProcessPoolExecutor(max_workers = hash_workers, mp_context = context)
+            pool.submit(abs, 0).result()
+
+# runs function(*args) in the pool (started on first use if need be), in the calling thread without workers
+def run(function, *args) :
+    if pool is None and hash_workers :
+        start()
+    if pool is None :
+        return function(*args)
+    return pool.submit(function, *args).result()
+
+def count(name) :
+    with pool_lock :
+        counters[name] += 1
+
+# returns the string to store for the password
+def hash_password(password) :
+    count('hashed')
+    return run(make_hash, password, work_factor)
+
+# returns True if the password is the one stored (a hash, or the password itself for the rows stored before the hashing)
+def check_password(password, stored) :
+    if hash_cost(stored) is None :
+        count('plaintext')
+        return hmac.compare_digest(password.encode('utf-8'), stored.encode('utf-8'))
+    count('checked')
+    return run(matches, password, stored)
+
+# True if the stored password should be hashed again : it is not a hash, or its cost is not the current one
+def needs_upgrade(stored) :
+    return hash_cost(stored) != work_factor
+
+def close() :
+    global pool
+    with pool_lock :
+        if pool is not None :
+            pool.shutdown()
+            pool = None
+
+def metrics() :
+    with pool_lock :
+        return {**counters, 'workers' : hash_workers if pool is not None else 0, 'work_factor' : work_factor}
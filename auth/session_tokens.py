@@ -0,0 +1,55 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import time
+
+# the session tokens handed out by the "login" and "join_room" actions and redeemed by the "resume" action
+# a token is the base64 encoded JSON claims (username, room_ID, expires) followed by a dot and their HMAC-SHA256 signature
+# the server verifies a token with the secret alone, so a reconnecting client is let back in without a database query
+# the secret comes from the CHAT_SESSION_SECRET environment variable, otherwise a random one is drawn when the server starts
+# (then the tokens stop being valid once the server restarts, and the clients have to log in again)
+TOKEN_TTL = 24 * 60 * 60   # the seconds a token stays valid after it was issued
+
+secret = os.environ.get("CHAT_SESSION_SECRET", "").encode('utf-8') or os.urandom(32)
+token_ttl = TOKEN_TTL
+
+# changes the signing secret (bytes or str) and the lifetime of the tokens issued from now on
+# changing the secret invalidates every token issued before
+def configure(session_secret = None, ttl = None) :
+    global secret, token_ttl
+    if session_secret is not None :
+        secret = session_secret.encode('utf-8') if isinstance(session_secret, str) else session_secret
+    if ttl is not None :
+        token_ttl = ttl
+
+def encode(data) :
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode('ascii')
+
+def decode(text) :
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+def sign(body) :
+    return encode(hmac.new(secret, body.encode('ascii'), hashlib.sha256).digest())
+
+# returns a token for the user, room_ID is the room the client is in (None outside of rooms)
+def issue_token(username, room_ID = None) :
+    claims = {"username" : username, "room_ID" : room_ID, "expires" : int(time.time() + token_ttl)}
+    body = encode(json.dumps(claims, separators = (',', ':')).encode('utf-8'))
+    return f"{body}.{sign(body)}"
+
+# returns the claims of the token as a dictionary, or None if the token is malformed, forged or expired
+def verify_token(token) :
+    if not isinstance(token, str) or token.count(".") != 1 :
+        return None
+    body, signature = token.split(".")
+    try :
+        if not hmac.compare_digest(signature.encode('ascii'), sign(body).encode('ascii')) :
+            return None
+        claims = json.loads(decode(body))
+    except ValueError :   # not ASCII, not base64 or not JSON
+        return None
+    if claims.get("expires", 0) < time.time() :
+        return None
+    return claims
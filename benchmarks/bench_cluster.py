@@ -0,0 +1,116 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import socket
+import subprocess
+import sys
+import time
+from benchmarks.bench_server_modes import raise_open_files_limit, read_frame, request, stop_server
+from protocol.framing import encode_frame
+
+# measures how the message throughput of the server grows with the number of worker processes (the --workers option)
+# for every worker count the server is started as a subprocess, then load generator processes open the client connections :
+# every client logs in, joins one of the rooms and sends messages at the given rate while counting the messages it receives
+# the connections are spread between the workers by the kernel (SO_REUSEPORT), so most rooms have members on several workers
+# and their messages go through the broker, reports the aggregate messages sent and delivered per second
+# the server keeps its users and rooms in the storage given by --db (a SQLite file by default, see storage/backends.py),
+# the clients are the users bench0, bench1... (registered on their first run)
+# run from the repository root : python -m benchmarks.bench_cluster --workers 1 2 4 --clients 2000 --rate 5
+
+# starts the server with the given number of workers and waits until its port accepts connections
+def start_server(workers, args) :
+    command = [sys.executable, "-m", "server.server", "--mode", args.mode, "--port", str(args.port), "--db", args.db]
+    if workers > 1 :
+        command += ["--workers", str(workers)]
+    process = subprocess.Popen(command, stdin = subprocess.PIPE, stdout = subprocess.DEVNULL, text = True)
+    deadline = time.time() + 10
+    while time.time() < deadline :
+        try :
+            socket.create_connection(("localhost", args.port), timeout = 1).close()
+            time.sleep(0.5)   # lets every worker start listening
+            return process
+        except OSError :
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f"the server did not start with {workers} workers")
+
+# a single client : joins its room, then sends rate messages per second until stop_at and counts the messages it receives
+async def client(number, args, counts, stop_at) :
+    reader, writer = await asyncio.open_connection("localhost", args.port)
+    username = f"{args.user_prefix}{number}"
+    credentials = {"username" : username, "password" : args.password}
+    if (await request(reader, writer, {"action" : "login", **credentials}))["code"] != 200 :
+        await request(reader, writer, {"action" : "register", **credentials})
+    room_ID = args.room_IDs[number % len(args.room_IDs)]
+    writer.write(encode_frame(json.dumps({"action" : "join_room", "room_ID" : room_ID, "room_password" : args.room_password})))
+    await writer.drain()
+
+    async def receive() :
+        while True :
+            frame = await read_frame(reader)
+            if frame.startswith(b'{"event"') :
+                counts["received"] += 1
+
+    receiver = asyncio.ensure_future(receive())
+    await asyncio.sleep(1)   # waits for every client to join before sending
+    message = encode_frame(json.dumps({"action" : "send_message", "username" : username, "message" : "x" * 64}))
+    while time.time() < stop_at :
+        writer.write(message)
+        counts["sent"] += 1
+        await asyncio.sleep(1 / args.rate)
+    await asyncio.sleep(1)   # lets the last messages arrive
+    receiver.cancel()
+    writer.close()
+
+async def generate(first, count, args, stop_at) :
+    counts = {"sent" : 0, "received" : 0}
+    await asyncio.gather(*(client(number, args, counts, stop_at) for number in range(first, first + count)))
+    return counts
+
+# a load generator process, runs its share of the clients on its own event loop
+def run_generator(first, count, args, stop_at) :
+    raise_open_files_limit()
+    return asyncio.run(generate(first, count, args, stop_at))
+
+def bench_workers(workers, args) :
+    process = start_server(workers, args)
+    try :
+        per_generator = args.clients // args.generators
+        stop_at = time.time() + 2 + args.duration
+        with multiprocessing.Pool(args.generators) as pool :
+            results = pool.starmap(run_generator, [(number * per_generator, per_generator, args, stop_at)
+                                                   for number in range(args.generators)])
+    finally :
+        stop_server(process)
+    sent = sum(result["sent"] for result in results)
+    received = sum(result["received"] for result in results)
+    return {
+        "workers" : workers,
+        "mode" : args.mode,
+        "clients" : per_generator * args.generators,
+        "rooms" : len(args.room_IDs),
+        "sent_per_second" : round(sent / args.duration, 1),
+        "delivered_per_second" : round(received / args.duration, 1),
+    }
+
+if __name__ == "__main__" :
+    parser = argparse.ArgumentParser(description = "Message throughput against the number of server worker processes")
+    parser.add_argument("--workers", nargs = "+", type = int, default = [1, 2, 4])
+    parser.add_argument("--mode", default = "asyncio")
+    parser.add_argument("--port", type = int, default = 7274)
+    parser.add_argument("--db", choices = ("sqlite", "standin", "mysql"), default = "sqlite", help = "the storage of the server")
+    parser.add_argument("--clients", type = int, default = 2000)
+    parser.add_argument("--generators", type = int, default = multiprocessing.cpu_count(),
+                        help = "the load generator processes the clients are spread over")
+    parser.add_argument("--rate", type = float, default = 5.0, help = "the messages every client sends per second")
+    parser.add_argument("--duration", type = float, default = 20.0, help = "seconds of load per worker count")
+    parser.add_argument("--user-prefix", dest = "user_prefix", default = "bench")
+    parser.add_argument("--password", default = "bench123")
+    parser.add_argument("--room-IDs", dest = "room_IDs", nargs = "+", default = ["1"])
+    parser.add_argument("--room-password", dest = "room_password", default = "test5",
+                        help = "the password of the rooms, they must all share it")
+    args = parser.parse_args()
+
+    for workers in args.workers :
+        print(json.dumps(bench_workers(workers, args)))
@@ -0,0 +1,50 @@
+import argparse
+import json
+import time
+from protocol.binary import decode_action, decode_event, encode_action, encode_message_event
+
+# compares the JSON and the binary encodings (see protocol/binary.py) on the two payloads of every chat message :
+# the "send_message" action a client sends, and the message event the server sends to every member of the room
+# measures how many payloads per second are serialized and parsed, and the size of a payload, for each encoding
+# the JSON "send_message" carries the username, like the clients that do not negotiate the binary encoding send it
+# run from the repository root : python -m benchmarks.bench_codec
+
+def timed(function, count) :
+    started = time.perf_counter()
+    for _ in range(count) :
+        function()
+    return count / (time.perf_counter() - started)
+
+def bench(count, message) :
+    action = {"action" : "send_message", "username" : "user1234", "message" : message}
+    room_ID, seq, line = "42", 123456, f"user1234 >> {message}"
+    event = {"event" : "message", "room_ID" : room_ID, "seq" : seq, "message" : line}
+
+    json_action = json.dumps(action).encode('utf-8')
+    binary_action = encode_action(action)
+    json_event = json.dumps(event).encode('utf-8')
+    binary_event = encode_message_event(room_ID, seq, line)
+
+    return [
+        {"payload" : "send_message", "encoding" : "json", "bytes" : len(json_action),
+         "serialize_per_s" : round(timed(lambda : json.dumps(action).encode('utf-8'), count)),
+         "parse_per_s" : round(timed(lambda : decode_action(json_action), count))},
+        {"payload" : "send_message", "encoding" : "binary", "bytes" : len(binary_action),
+         "serialize_per_s" : round(timed(lambda : encode_action(action), count)),
+         "parse_per_s" : round(timed(lambda : decode_action(binary_action), count))},
+        {"payload" : "message_event", "encoding" : "json", "bytes" : len(json_event),
+         "serialize_per_s" : round(timed(lambda : json.dumps(event).encode('utf-8'), count)),
+         "parse_per_s" : round(timed(lambda : json.loads(json_event), count))},
+        {"payload" : "message_event", "encoding" : "binary", "bytes" : len(binary_event),
+         "serialize_per_s" : round(timed(lambda : encode_message_event(room_ID, seq, line), count)),
+         "parse_per_s" : round(timed(lambda : decode_event(binary_event), count))},
+    ]
+
+if __name__ == "__main__" :
+    parser = argparse.ArgumentParser(description = "JSON vs. binary encoding of the chat payloads")
+    parser.add_argument("--count", type = int, default = 200000, help = "the payloads serialized and parsed per measure")
+    parser.add_argument("--message-size", dest = "message_size", type = int, default = 64, help = "the characters of a chat message")
+    args = parser.parse_args()
+
+    for result in bench(args.count, "x" * args.message_size) :
+        print(json.dumps({**result, "message_size" : args.message_size}))
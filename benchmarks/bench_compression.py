@@ -0,0 +1,73 @@
+import argparse
+import json
+import random
+import time
+import zlib
+from protocol.compression import compress_payload, decompress_payload
+from protocol.framing import MAX_FRAME_SIZE
+from server.history_blocks import HistoryBlocks
+
+# measures the bytes a client receives for the chatting history sent on joining a room, and what it costs the server to send them :
+# plain text frames, every frame compressed on its own with zlib, and the compression of protocol/compression.py
+# (a raw deflate stream with the preset dictionary, the full blocks of the history compressed once and cached, see server/history_blocks.py)
+# the history is made of chat-like messages from a small vocabulary, every join sends the last --page messages of the room
+# and the room gets --messages-between-joins new messages between two joins, so the cache is measured as it is used
+# run from the repository root : python -m benchmarks.bench_compression
+WORDS = ("the and you that have for not with this but are was what can just like all about there will know would get when out "
+         "your think one time good yes see from going they how some people really because well right now meeting tomorrow lunch "
+         "deploy server build failed passed review merge ticket coffee weekend thanks sure later sounds great").split()
+
+def make_messages(count, rng) :
+    return [(seq, 0.0, f"user{rng.randrange(20)} >> " + " ".join(rng.choice(WORDS) for _ in range(rng.randrange(3, 25))))
+            for seq in range(1, count + 1)]
+
+def text_of(records) :
+    return "".join(message + "\n" for _, _, message in records).encode('utf-8')
+
+def plain(blocks, records) :
+    return [text_of(records)]
+
+def zlib_per_frame(blocks, records) :
+    return [zlib.compress(text_of(records))]
+
+def cached_blocks(blocks, records) :
+    payloads = []
+    for block, run in blocks.split(records) :
+        if block is not None :
+            payloads.append(blocks.payload("1", block, run)[0])
+        else :
+            payloads.append(compress_payload(text_of(run)))
+    return payloads
+
+def bench(joins, page, messages_between_joins, seed) :
+    rng = random.Random(seed)
+    messages = make_messages(page + joins * messages_between_joins, rng)
+    results = []
+    for name, send in (("plain", plain), ("zlib_per_frame", zlib_per_frame), ("dictionary_blocks", cached_blocks)) :
+        blocks = HistoryBlocks()
+        sent = 0
+        started = time.perf_counter()
+        for join in range(joins) :
+            upto = page + join * messages_between_joins
+            sent += sum(len(payload) for payload in send(blocks, messages[upto - page : upto]))
+        elapsed = time.perf_counter() - started
+        results.append({"method" : name, "bytes_per_join" : round(sent / joins), "us_per_join" : round(elapsed / joins * 1e6, 1),
+                        **({"cache" : blocks.metrics()} if name == "dictionary_blocks" else {})})
+
+    # the client side : every compressed block decompresses to the original text
+    blocks = HistoryBlocks()
+    records = messages[:page]
+    assert b"".join(decompress_payload(payload, MAX_FRAME_SIZE) for payload in cached_blocks(blocks, records)) == text_of(records)
+    return results
+
+if __name__ == "__main__" :
+    parser = argparse.ArgumentParser(description = "bytes and time of the history sent on joining a room, plain vs. compressed")
+    parser.add_argument("--joins", type = int, default = 2000, help = "the joins measured")
+    parser.add_argument("--page", type = int, default = 50, help = "the messages sent on every join (HISTORY_PAGE_SIZE)")
+    parser.add_argument("--messages-between-joins", dest = "messages_between_joins", type = int, default = 2,
+                        help = "the messages posted to the room between two joins")
+    parser.add_argument("--seed", type = int, default = 1)
+    args = parser.parse_args()
+
+    for result in bench(args.joins, args.page, args.messages_between_joins, args.seed) :
+        print(json.dumps(result))
@@ -0,0 +1,90 @@
+import argparse
+import json
+import time
+import tracemalloc
+from protocol.framing import FrameDecoder
+from server.rooms import ClientSession, RoomIndex
+
+# measures the cost of finding the recipients of a message in a small room as the number of connected clients grows
+# "scan" is the old way : walking the whole clients dictionary and comparing the room_ID of every client
+# "index" looks the room up in the RoomIndex, so its cost depends on the size of the room only
+# also reports the memory taken by one session record, as a dictionary and as a slotted ClientSession
+# run from the repository root : python -m benchmarks.bench_fanout
+
+# a socket stand-in that only counts what it was asked to send
+class CountingSocket :
+    __slots__ = ('sent',)
+
+    def __init__(self) :
+        self.sent = 0
+
+    def sendall(self, data) :
+        self.sent += 1
+
+# connects total_clients sessions, spread over rooms of room_size members
+def populate(total_clients, room_size) :
+    clients = {}
+    index = RoomIndex()
+    for number in range(total_clients) :
+        session = ClientSession(CountingSocket())
+        session.username = f"user{number}"
+        clients[session.client_socket] = session
+        index.join(session, str(number // room_size))
+    return clients, index
+
+def fanout_scan(clients, username, room_ID) :
+    for client_socket, session in clients.items() :
+        if session.room_ID == room_ID and session.username != username :
+            client_socket.sendall(b"")
+
+def fanout_index(index, username, room_ID) :
+    for member in index.members(room_ID) :
+        if member.username != username :
+            member.client_socket.sendall(b"")
+
+# returns the average time of one fanout in microseconds
+def time_fanout(function, repeat) :
+    started = time.perf_counter()
+    for _ in range(repeat) :
+        function()
+    return (time.perf_counter() - started) / repeat * 1e6
+
+# returns the average number of bytes allocated for one session record built by the factory
+def session_bytes(factory, count = 10000) :
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    records = [factory(number) for number in range(count)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del records
+    return (after - before) / count
+
+def new_dict_session(number) :
+    return {'client_socket' : None, 'username' : f"user{number}", 'room_ID' : str(number), 'decoder' : FrameDecoder()}
+
+def new_session(number) :
+    session = ClientSession(None)
+    session.username = f"user{number}"
+    session.room_ID = str(number)
+    return session
+
+if __name__ == "__main__" :
+    parser = argparse.ArgumentParser(description = "Fanout cost vs. the number of connected clients")
+    parser.add_argument("--totals", nargs = "+", type = int, default = [100, 1000, 10000, 100000])
+    parser.add_argument("--room-size", dest = "room_size", type = int, default = 3)
+    parser.add_argument("--repeat", type = int, default = 200)
+    args = parser.parse_args()
+
+    for total in args.totals :
+        clients, index = populate(total, args.room_size)
+        print(json.dumps({
+            "total_clients" : total,
+            "room_size" : args.room_size,
+            "scan_us" : round(time_fanout(lambda : fanout_scan(clients, "user0", "0"), args.repeat), 2),
+            "index_us" : round(time_fanout(lambda : fanout_index(index, "user0", "0"), args.repeat), 2),
+        }))
+
+    print(json.dumps({
+        "dict_session_bytes" : round(session_bytes(new_dict_session)),
+        "slotted_session_bytes" : round(session_bytes(new_session)),
+    }))
@@ -0,0 +1,109 @@
+import argparse
+import json
+import threading
+import time
+from server.fanout import FanoutEngine, FANOUT_WORKERS, SHARD_THRESHOLD
+from server.rooms import ClientSession, RoomIndex
+
+# measures the delivery of the messages of a single room as the room grows, the way deliver_message does it (see server/server.py)
+# "direct" is the old way : the sender's thread queues the frame to every member of the room itself
+# "sharded" hands the shards of the room to the workers of a FanoutEngine (see server/fanout.py), the rooms below the threshold
+# are still delivered directly, so the small sizes show the cost of the check only
+# one sender sends the messages back to back, every member records the sequence numbers it gets, so the order is checked too
+# reports the time the sender is blocked on every message, the latency from the sending of a message to its last delivery,
+# the deliveries per second until every message is delivered, and the number of messages received out of order (always 0)
+# the member sockets only count the frames, the real sendall also queues them (see server/outbound.py)
+# back to back, a sender that no longer waits for the delivery outruns the workers and the latency is the backlog it builds up,
+# --interval paces the sender to see the latency of a single message
+# run from the repository root : python -m benchmarks.bench_fanout_shards
+
+FRAME = b"\x00\x00\x00\x50" + b"x" * 80   # a framed 80 byte message event
+
+# a socket stand-in that remembers the last sequence number it got and counts the ones that came out of order
+class OrderCheckingSocket :
+    __slots__ = ('last', 'received', 'disordered')
+
+    def __init__(self) :
+        self.last = -1
+        self.received = 0
+        self.disordered = 0
+
+    def deliver(self, seq) :
+        if seq <= self.last :
+            self.disordered += 1
+        self.last = seq
+        self.received += 1
+
+    def sendall(self, data) :
+        pass
+
+def populate(room_size, shard_count, threshold) :
+    index = RoomIndex(shard_count, threshold)
+    for number in range(room_size) :
+        session = ClientSession(OrderCheckingSocket())
+        session.username = f"user{number}"
+        index.join(session, "0")
+    return index
+
+# sends the messages to the room of room_size members, through an engine of workers threads (0 for the direct delivery)
+def run(room_size, messages, workers, threshold, interval) :
+    index = populate(room_size, workers, threshold)
+    engine = FanoutEngine(workers)
+    engine.start()
+    lock = threading.Lock()                    # stands for clients_lock
+    finished = [[] for _ in range(messages)]   # the times the shards of every message were done
+    sender_times = []
+
+    started = time.perf_counter()
+    sent_at = []
+    for seq in range(messages) :
+        sent = time.perf_counter()
+        sent_at.append(sent)
+        with engine.ordered("0") :
+            with lock :
+                shards = index.member_shards("0")
+                if shards is None :
+                    members = list(index.members("0"))
+                else :
+                    members = None
+                    shards = [tuple(shard) for shard in shards]
+
+            def send(members, seq = seq) :
+                for member in members :
+                    if member.username != "user0" :
+                        member.client_socket.sendall(FRAME)
+                        member.client_socket.deliver(seq)
+                finished[seq].append(time.perf_counter())
+
+            engine.submit(members, shards, send)
+        sender_times.append(time.perf_counter() - sent)
+        if interval :
+            time.sleep(interval)
+    engine.close()
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(max(times) - sent for times, sent in zip(finished, sent_at))
+    sessions = index.members("0")
+    return {
+        "sender_us" : round(sum(sender_times) / messages * 1e6, 1),
+        "latency_p50_ms" : round(latencies[len(latencies) // 2] * 1e3, 3),
+        "latency_p99_ms" : round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1e3, 3),
+        "deliveries_per_s" : round(sum(session.client_socket.received for session in sessions) / elapsed),
+        "disordered" : sum(session.client_socket.disordered for session in sessions),
+    }
+
+if __name__ == "__main__" :
+    parser = argparse.ArgumentParser(description = "Fanout latency and throughput vs. the size of the room, direct and sharded")
+    parser.add_argument("--sizes", nargs = "+", type = int, default = [10, 100, 1000, 10000, 50000])
+    parser.add_argument("--workers", type = int, default = FANOUT_WORKERS)
+    parser.add_argument("--threshold", type = int, default = SHARD_THRESHOLD)
+    parser.add_argument("--deliveries", type = int, default = 1000000,
+                        help = "the deliveries of every run, the messages are this divided by the room size (between 20 and 2000)")
+    parser.add_argument("--interval", type = float, default = 0, help = "the seconds the sender waits between two messages")
+    args = parser.parse_args()
+
+    for size in args.sizes :
+        messages = max(20, min(2000, args.deliveries // size))
+        for name, workers in (("direct", 0), ("sharded", args.workers)) :
+            print(json.dumps({"room_size" : size, "messages" : messages, "mode" : name, "workers" : workers,
+                              **run(size, messages, workers, args.threshold, args.interval)}))
@@ -0,0 +1,88 @@
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from server.history import HistoryLog, FLUSH_INTERVAL, FLUSH_BYTES
+from storage.sqlite_storage import SQLiteHistory
+
+# measures how many messages per second reach the disk when many senders write to many rooms at the same time
+# "legacy" is the old way : every sender opens {room_ID}.txt, appends one line and closes it, for every message
+# "log" appends to a HistoryLog, whose writer thread commits the messages in batches with one fsync per touched segment
+# "sqlite" appends to a SQLiteHistory, whose writer thread inserts the messages in batches, one transaction per batch (see storage/sqlite_storage.py)
+# the logs are only timed until close() returns, that is until every message is written and synced
+# also reports the average time a sender spends in a single append, the time a sender of the room would wait
+# run from the repository root : python -m benchmarks.bench_history
+
+MESSAGE = "user >> " + "x" * 72   # an 80 character chat message
+
+def run_senders(senders, messages, rooms, append) :
+    per_sender = messages // senders
+    append_times = [0.0] * senders
+
+    def send(number) :
+        started = time.perf_counter()
+        for count in range(per_sender) :
+            append(str((number * per_sender + count) % rooms), MESSAGE)
+        append_times[number] = time.perf_counter() - started
+
+    threads = [threading.Thread(target = send, args = (number,)) for number in range(senders)]
+    for thread in threads :
+        thread.start()
+    for thread in threads :
+        thread.join()
+    return sum(append_times) / (per_sender * senders) * 1e6
+
+def bench_legacy(directory, args) :
+    def append(room_ID, message) :
+        with open(os.path.join(directory, f"{room_ID}.txt"), "a") as chat_file :
+            chat_file.write(message + "\n")
+
+    started = time.perf_counter()
+    append_us = run_senders(args.senders, args.messages, args.rooms, append)
+    return time.perf_counter() - started, append_us, {}
+
+def bench_log(directory, args) :
+    history = HistoryLog(directory, flush_interval = args.flush_interval, flush_bytes = args.flush_bytes)
+    history.start()
+    started = time.perf_counter()
+    append_us = run_senders(args.senders, args.messages, args.rooms, history.append)
+    history.close()
+    return time.perf_counter() - started, append_us, history.metrics()
+
+def bench_sqlite(directory, args) :
+    history = SQLiteHistory(os.path.join(directory, "chatroom.db"), directory, flush_interval = args.flush_interval, flush_bytes = args.flush_bytes)
+    history.start()
+    started = time.perf_counter()
+    append_us = run_senders(args.senders, args.messages, args.rooms, history.append)
+    history.close()
+    return time.perf_counter() - started, append_us, history.metrics()
+
+if __name__ == "__main__" :
+    parser = argparse.ArgumentParser(description = "Room history persistence : one file append per message vs. the group-commit logs")
+    parser.add_argument("--engines", nargs = "+", default = ["legacy", "log", "sqlite"])
+    parser.add_argument("--rooms", type = int, default = 1000)
+    parser.add_argument("--senders", type = int, default = 32)
+    parser.add_argument("--messages", type = int, default = 100000)
+    parser.add_argument("--flush-interval", dest = "flush_interval", type = float, default = FLUSH_INTERVAL)
+    parser.add_argument("--flush-bytes", dest = "flush_bytes", type = int, default = FLUSH_BYTES)
+    args = parser.parse_args()
+
+    engines = {"legacy" : bench_legacy, "log" : bench_log, "sqlite" : bench_sqlite}
+    for engine in args.engines :
+        directory = tempfile.mkdtemp(prefix = f"bench_history_{engine}_")
+        try :
+            elapsed, append_us, metrics = engines[engine](directory, args)
+        finally :
+            shutil.rmtree(directory, ignore_errors = True)
+        print(json.dumps({
+            "engine" : engine,
+            "rooms" : args.rooms,
+            "senders" : args.senders,
+            "messages" : args.messages,
+            "messages_per_s" : round(args.messages / elapsed),
+            "append_us" : round(append_us, 2),
+            **({"batches" : metrics['batches'], "fsyncs" : metrics['fsyncs']} if metrics else {}),
+        }))
@@ -0,0 +1,127 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from auth import chat_auth, passwords
+from storage.backends import configure_storage
+
+# measures a storm of logins on hashed passwords, like the clients of a busy server all reconnecting at once
+# (see auth/chat_auth.py and auth/passwords.py), on a SQLite storage in a temporary directory
+# every one of --threads threads (the threads of the connections) logs in --logins times : mostly the right password of one
+# of --users users, the others a wrong password retried (--bad) or a username that does not exist (--unknown)
+# "inline" is the plain way : every login queries the user and hashes the password on the thread of the connection
+# "pooled" goes through authenticate_user : the hashes are computed in the process pool, the identical logins and lookups
+# in flight are coalesced and the recent failures fail right away
+# a probe thread stands for a thread serving the chat traffic, it sleeps 1 ms in a loop and records how late it wakes up,
+# the time the logins kept it from the GIL
+# reports the logins per second, their latency, the hashes and the queries they took, and the lateness of the probe
+# run from the repository root : python -m benchmarks.bench_login_storm
+
+PASSWORD = "correct horse"
+
+def inline_login(storage, username, password) :
+    user = storage.find_user(username)
+    return user is not None and passwords.check_password(password, user["password"])
+
+def workload(rng, args) :
+    roll = rng.random()
+    if roll < args.unknown :
+        return f"nobody{rng.randrange(args.users)}", PASSWORD, False
+    if roll < args.unknown + args.bad :
+        return f"storm{rng.randrange(args.users)}", "wrong password", False
+    return f"storm{rng.randrange(args.users)}", PASSWORD, True
+
+def percentile(values, fraction) :
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def run(storage, login, args) :
+    latencies = []
+    wrong = []
+    lateness = []
+    done = threading.Event()
+    barrier = threading.Barrier(args.threads + 1)
+
+    def probe() :
+        while not done.is_set() :
+            started = time.perf_counter()
+            time.sleep(0.001)
+            lateness.append(time.perf_counter() - started - 0.001)
+
+    def connection(number) :
+        rng = random.Random(number)
+        barrier.wait()
+        for _ in range(args.logins) :
+            username, password, expected = workload(rng, args)
+            started = time.perf_counter()
+            if login(username, password) != expected :
+                wrong.append(username)
+            latencies.append(time.perf_counter() - started)
+
+    threads = [threading.Thread(target = connection, args = (number,)) for number in range(args.threads)]
+    for thread in threads :
+        thread.start()
+    prober = threading.Thread(target = probe)
+    prober.start()
+    queries = storage.metrics()["pool"]["acquired"]
+    hashes = passwords.metrics()["checked"]
+    barrier.wait()
+    started = time.perf_counter()
+    for thread in threads :
+        thread.join()
+    elapsed = time.perf_counter() - started
+    done.set()
+    prober.join()
+
+    latencies.sort()
+    lateness.sort()
+    return {
+        "logins_per_s" : round(len(latencies) / elapsed, 1),
+        "login_p50_ms" : round(percentile(latencies, 0.5) * 1e3, 2),
+        "login_p99_ms" : round(percentile(latencies, 0.99) * 1e3, 2),
+        "hashes" : passwords.metrics()["checked"] - hashes,
+        "queries" : storage.metrics()["pool"]["acquired"] - queries,
+        "probe_late_p99_ms" : round(percentile(lateness, 0.99) * 1e3, 2),
+        "probe_late_max_ms" : round(lateness[-1] * 1e3, 2),
+        "wrong_results" : len(wrong),
+    }
+
+if __name__ == "__main__" :
+    parser = argparse.ArgumentParser(description = "Login storm : inline hashing vs. the hashing pool with single-flight and negative caching")
+    parser.add_argument("--modes", nargs = "+", default = ["inline", "pooled"])
+    parser.add_argument("--threads", type = int, default = 32)
+    parser.add_argument("--logins", type = int, default = 10, help = "the logins of every thread")
+    parser.add_argument("--users", type = int, default = 20)
+    parser.add_argument("--bad", type = float, default = 0.3, help = "the share of the logins with a wrong password")
+    parser.add_argument("--unknown", type = float, default = 0.1, help = "the share of the logins of users that do not exist")
+    parser.add_argument("--hash-workers", dest = "hash_workers", type = int, default = passwords.HASH_WORKERS)
+    parser.add_argument("--hash-cost", dest = "hash_cost", type = int, default = passwords.SCRYPT_LOG_N)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix = "bench_login_storm_")
+    try :
+        passwords.configure(0, args.hash_cost)
+        storage = configure_storage("sqlite", os.path.join(directory, "chatroom.db"))
+        storage.start()
+        for number in range(args.users) :
+            chat_auth.register_user(f"storm{number}", PASSWORD)
+
+        for mode in args.modes :
+            workers = 0 if mode == "inline" else args.hash_workers
+            passwords.close()
+            passwords.configure(workers)
+            passwords.start()   # the run's threads are gone, so the pool is forked from a single thread
+            chat_auth.failures = chat_auth.FailureCache()
+            if mode == "inline" :
+                login = lambda username, password : inline_login(storage, username, password)
+            else :
+                login = chat_auth.authenticate_user
+            print(json.dumps({"mode" : mode, "threads" : args.threads, "logins" : args.threads * args.logins, "cost" : args.hash_cost,
+                              "hash_workers" : workers, **run(storage, login, args)}))
+        storage.close()
+        passwords.close()
+    finally :
+        shutil.rmtree(directory, ignore_errors = True)
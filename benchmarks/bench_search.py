@@ -0,0 +1,76 @@
+import argparse
+import json
+import random
+import shutil
+import tempfile
+import time
+from server.history import HistoryLog
+from server.search import SearchIndex
+
+# measures the "search" action on a room with millions of messages (see server/search.py)
+# writes --messages chat-like messages of --users users into one room of a HistoryLog, then starts a SearchIndex on it,
+# which builds the index from the log like a server starting with an old history, and reports how long that took
+# then times --queries searches of every kind : a frequent word, a rare word, two words, a prefix, the messages of a user,
+# and the third page of a frequent word, reporting the median and the 99th percentile latency in milliseconds
+# run from the repository root : python -m benchmarks.bench_search
+WORDS = ("the and you that have for not with this but are was what can just like all about there will know would get when out "
+         "your think one time good yes see from going they how some people really because well right now meeting tomorrow lunch "
+         "deploy server build failed passed review merge ticket coffee weekend thanks sure later sounds great").split()
+RARE_WORDS = ("xylophone", "quokka", "zeppelin", "kumquat")
+
+def write_history(directory, messages, users, rng) :
+    history = HistoryLog(directory)
+    history.start()
+    for number in range(messages) :
+        words = [rng.choice(WORDS) for _ in range(rng.randrange(3, 15))]
+        if number % 10000 == 0 :
+            words.append(rng.choice(RARE_WORDS))
+        history.append("1", f"user{rng.randrange(users)} >> " + " ".join(words))
+    history.close()
+    return history
+
+def timed(search, queries) :
+    latencies = []
+    for _ in range(queries) :
+        started = time.perf_counter()
+        search()
+        latencies.append((time.perf_counter() - started) * 1000)
+    latencies.sort()
+    return {"p50_ms" : round(latencies[len(latencies) // 2], 3), "p99_ms" : round(latencies[int(len(latencies) * 0.99)], 3)}
+
+def bench(args) :
+    directory = tempfile.mkdtemp(prefix = "chatroom_bench_search_")
+    try :
+        rng = random.Random(args.seed)
+        history = write_history(directory, args.messages, args.users, rng)
+        index = SearchIndex()
+        started = time.perf_counter()
+        index.start(history)
+        while index.metrics()['caught_up'] < args.messages :
+            time.sleep(0.05)
+        print(json.dumps({"messages" : args.messages, "index_build_s" : round(time.perf_counter() - started, 1)}))
+
+        _, cursor = index.search("1", "coffee")
+        _, cursor = index.search("1", "coffee", before = cursor)
+        cases = {
+            "frequent_word" : lambda : index.search("1", "coffee"),
+            "rare_word" : lambda : index.search("1", rng.choice(RARE_WORDS)),
+            "two_words" : lambda : index.search("1", "deploy failed"),
+            "prefix" : lambda : index.search("1", "meet*"),
+            "user" : lambda : index.search("1", "", f"user{rng.randrange(args.users)}"),
+            "user_and_word" : lambda : index.search("1", "lunch", f"user{rng.randrange(args.users)}"),
+            "third_page" : lambda : index.search("1", "coffee", before = cursor),
+        }
+        for name, search in cases.items() :
+            print(json.dumps({"query" : name, **timed(search, args.queries)}))
+        index.close()
+    finally :
+        shutil.rmtree(directory, ignore_errors = True)
+
+if __name__ == "__main__" :
+    parser = argparse.ArgumentParser(description = "Full-text search latency on a room with millions of messages")
+    parser.add_argument("--messages", type = int, default = 1000000)
+    parser.add_argument("--users", type = int, default = 200)
+    parser.add_argument("--queries", type = int, default = 200)
+    parser.add_argument("--seed", type = int, default = 1)
+    bench(parser.parse_args())
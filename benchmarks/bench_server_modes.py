@@ -0,0 +1,142 @@
+import argparse
+import asyncio
+import json
+import resource
+import socket
+import subprocess
+import sys
+import time
+from protocol.framing import HEADER, encode_frame
+
+# compares the threaded and the asyncio server modes under the same load
+# for every mode the server is started as a subprocess (python -m server.server --mode <mode>)
+# then a number of idle connections are opened and kept open, while the active connections
+# log in, join a room and repeatedly request the list of rooms, measuring the round trip of every request
+# the server keeps its users and rooms in the storage given by --db (a SQLite file by default, see storage/backends.py),
+# the active clients log in with the given credentials
+# run from the repository root : python -m benchmarks.bench_server_modes --idle 10000 --active 1000
+
+# raises the soft limit of open files up to the hard limit, both this process and the server need one descriptor per connection
+def raise_open_files_limit() :
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+# starts the server in the given mode and waits until its port accepts connections
+def start_server(mode, port, db = "sqlite") :
+    process = subprocess.Popen([sys.executable, "-m", "server.server", "--mode", mode, "--port", str(port), "--db", db],
+                               stdin = subprocess.PIPE, stdout = subprocess.DEVNULL, text = True)
+    deadline = time.time() + 10
+    while time.time() < deadline :
+        try :
+            socket.create_connection(("localhost", port), timeout = 1).close()
+            return process
+        except OSError :
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f"the server did not start in {mode} mode")
+
+# stops the server with the console "shutdown" command
+def stop_server(process) :
+    try :
+        process.communicate("shutdown\n", timeout = 10)
+    except subprocess.TimeoutExpired :
+        process.kill()
+
+# reads the resident memory and the thread count of the given process from /proc
+def process_usage(pid) :
+    usage = {}
+    with open(f"/proc/{pid}/status") as status_file :
+        for line in status_file :
+            if line.startswith("VmRSS:") :
+                usage["rss_kb"] = int(line.split()[1])
+            elif line.startswith("Threads:") :
+                usage["threads"] = int(line.split()[1])
+    return usage
+
+async def read_frame(reader) :
+    (length,) = HEADER.unpack(await reader.readexactly(HEADER.size))
+    return await reader.readexactly(length)
+
+async def request(reader, writer, action) :
+    writer.write(encode_frame(json.dumps(action)))
+    await writer.drain()
+    return json.loads(await read_frame(reader))
+
+# a single active client, logs in, joins the room and then sends the list action as fast as the server answers
+async def active_client(port, args, latencies, stop_at) :
+    reader, writer = await asyncio.open_connection("localhost", port)
+    await request(reader, writer, {"action" : "login", "username" : args.username, "password" : args.password})
+    await request(reader, writer, {"action" : "join_room", "room_ID" : args.room_ID, "room_password" : args.room_password})
+    # drops the chatting history frames that follow the join response
+    while True :
+        try :
+            await asyncio.wait_for(read_frame(reader), 0.5)
+        except asyncio.TimeoutError :
+            break
+
+    while time.time() < stop_at :
+        started = time.perf_counter()
+        await request(reader, writer, {"action" : "list"})
+        latencies.append(time.perf_counter() - started)
+    writer.close()
+
+def percentile(values, fraction) :
+    if not values :
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+async def run_load(port, args, pid) :
+    idle = []
+    for _ in range(args.idle) :
+        idle.append(await asyncio.open_connection("localhost", port))
+
+    latencies = []
+    stop_at = time.time() + args.duration
+    await asyncio.gather(*(active_client(port, args, latencies, stop_at) for _ in range(args.active)))
+    usage = process_usage(pid)
+
+    for _, writer in idle :
+        writer.close()
+    return latencies, usage
+
+def bench_mode(mode, args) :
+    process = start_server(mode, args.port, args.db)
+    try :
+        started = time.time()
+        latencies, usage = asyncio.run(run_load(args.port, args, process.pid))
+        elapsed = time.time() - started
+    finally :
+        stop_server(process)
+    return {
+        "mode" : mode,
+        "idle" : args.idle,
+        "active" : args.active,
+        "requests" : len(latencies),
+        "requests_per_second" : round(len(latencies) / elapsed, 1),
+        "p50_ms" : round(percentile(latencies, 0.50) * 1000, 3),
+        "p99_ms" : round(percentile(latencies, 0.99) * 1000, 3),
+        **usage,
+    }
+
+if __name__ == "__main__" :
+    parser = argparse.ArgumentParser(description = "Threaded vs asyncio server benchmark")
+    parser.add_argument("--modes", nargs = "+", default = ["threaded", "asyncio"])
+    parser.add_argument("--port", type = int, default = 7272)
+    parser.add_argument("--db", choices = ("sqlite", "standin", "mysql"), default = "sqlite", help = "the storage of the server")
+    parser.add_argument("--idle", type = int, default = 10000)
+    parser.add_argument("--active", type = int, default = 1000)
+    parser.add_argument("--duration", type = float, default = 20.0, help = "seconds of load per mode")
+    parser.add_argument("--username", default = "admin")
+    parser.add_argument("--password", default = "admin123")
+    parser.add_argument("--room-ID", dest = "room_ID", default = "1")
+    parser.add_argument("--room-password", dest = "room_password", default = "test5")
+    args = parser.parse_args()
+
+    limit = raise_open_files_limit()
+    if limit < 2 * (args.idle + args.active) + 100 :
+        print(f"Warning : the open files limit ({limit}) is too low for {args.idle + args.active} connections")
+
+    for mode in args.modes :
+        print(json.dumps(bench_mode(mode, args)))
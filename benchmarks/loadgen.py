@@ -0,0 +1,311 @@
+import argparse
+import asyncio
+import json
+import math
+import multiprocessing
+import random
+import socket
+import subprocess
+import sys
+import time
+from benchmarks.bench_server_modes import raise_open_files_limit, read_frame, stop_server
+from protocol.framing import HEADER, encode_frame
+
+# a headless load generator that measures the whole server end to end
+# starts the server as a subprocess (with the SQLite storage by default, see storage/backends.py), creates the rooms as admin,
+# then simulates the users from several generator processes, every one of them running its share of the users on an event loop :
+# every user logs in (registering on its first run), joins one of the rooms and chats at the given rate until the end of the run
+# every message carries the time it was sent, so the receivers measure the fanout latency (from sending to receiving)
+# reports the login and join latencies, the fanout latency percentiles (p50, p99, p999), the messages sent and delivered per second
+# and the resident memory of the server (summed over its worker processes), as a single JSON document that can be diffed between releases
+# run from the repository root : python -m benchmarks.loadgen --users 2000 --rooms 20 --rate 1 --duration 30 --output results.json
+
+PERCENTILES = {"p50" : 0.50, "p99" : 0.99, "p999" : 0.999}
+BUCKET_GROWTH = 1.02   # the width of a latency histogram bucket, relative to its lower bound (so the percentiles are within 2%)
+
+# a histogram of latencies with logarithmic buckets, small enough to be sent back from the generator processes whatever the load
+class LatencyHistogram :
+    def __init__(self) :
+        self.buckets = {}   # bucket number -> count, the bucket n holds the latencies from BUCKET_GROWTH ** n microseconds
+        self.count = 0
+        self.total = 0.0
+        self.largest = 0.0
+
+    def add(self, seconds) :
+        microseconds = max(seconds * 1e6, 1.0)
+        bucket = int(math.log(microseconds, BUCKET_GROWTH))
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.largest = max(self.largest, seconds)
+
+    def merge(self, other) :
+        for bucket, count in other.buckets.items() :
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.largest = max(self.largest, other.largest)
+
+    def percentile(self, fraction) :
+        rank = fraction * self.count
+        seen = 0
+        for bucket in sorted(self.buckets) :
+            seen += self.buckets[bucket]
+            if seen >= rank :
+                return BUCKET_GROWTH ** bucket / 1e6
+        return 0.0
+
+    # the summary in milliseconds
+    def summary(self) :
+        summary = {"count" : self.count, "mean_ms" : round(self.total / self.count * 1000, 3) if self.count else 0.0}
+        for name, fraction in PERCENTILES.items() :
+            summary[f"{name}_ms"] = round(self.percentile(fraction) * 1000, 3) if self.count else 0.0
+        summary["max_ms"] = round(self.largest * 1000, 3)
+        return summary
+
+# the connection of a simulated user, the reader task hands the responses to request() and measures the message events
+class User :
+    def __init__(self, reader, writer, stats) :
+        self.reader = reader
+        self.writer = writer
+        self.stats = stats
+        self.responses = asyncio.Queue()
+        self.read_task = asyncio.ensure_future(self.read_loop())
+
+    async def read_loop(self) :
+        try :
+            while True :
+                frame = await read_frame(self.reader)
+                if frame.startswith(b'{"event"') :
+                    received_at = time.time()
+                    event = json.loads(frame)
+                    sent_at = float(event["message"].split(" >> ", 1)[1].split(" ", 1)[0])
+                    self.stats["fanout"].add(received_at - sent_at)
+                    self.stats["delivered"] += 1
+                elif frame.startswith(b"{") :
+                    await self.responses.put(json.loads(frame))
+                # the other frames are the chatting history sent on joining
+        except (asyncio.IncompleteReadError, ConnectionError) :
+            await self.responses.put(None)
+
+    async def request(self, action) :
+        self.writer.write(encode_frame(json.dumps(action)))
+        await self.writer.drain()
+        response = await self.responses.get()
+        if response is None :
+            raise ConnectionResetError("the server closed the connection")
+        return response
+
+    def close(self) :
+        self.read_task.cancel()
+        self.writer.close()
+
+# connects the user, logs it in (registering it if it does not exist yet) and joins its room, timing the login and the join
+async def connect_user(number, args, room_ID, stats) :
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    user = User(reader, writer, stats)
+    credentials = {"username" : f"{args.user_prefix}{number}", "password" : args.password}
+    started = time.perf_counter()
+    if (await user.request({"action" : "login", **credentials}))["code"] != 200 :
+        if (await user.request({"action" : "register", **credentials}))["code"] != 200 :
+            raise RuntimeError(f"could not log in or register {credentials['username']}")
+    stats["login"].add(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    response = await user.request({"action" : "join_room", "room_ID" : room_ID, "room_password" : args.room_password})
+    if response["code"] != 200 :
+        raise RuntimeError(f"could not join room {room_ID} : {response['message']}")
+    stats["join"].add(time.perf_counter() - started)
+    return user
+
+# a simulated user : connects, waits for the start of the run, then sends rate messages per second until stop_at
+async def simulate_user(number, args, room_ID, stats, connect_slots, start_at, stop_at) :
+    try :
+        async with connect_slots :
+            user = await connect_user(number, args, room_ID, stats)
+    except (OSError, RuntimeError, asyncio.IncompleteReadError) as exception :
+        stats["errors"] += 1
+        stats["last_error"] = str(exception)
+        return
+
+    interval = 1 / args.rate
+    padding = "x" * max(0, args.message_size - 18)
+    next_at = start_at + random.random() * interval   # spreads the users over the interval, so they do not all send at once
+    try :
+        while True :
+            await asyncio.sleep(max(0, next_at - time.time()))
+            if time.time() >= stop_at :
+                break
+            message = f"{time.time():.6f} {padding}"
+            user.writer.write(encode_frame(json.dumps({"action" : "send_message", "username" : f"{args.user_prefix}{number}",
+                                                       "message" : message})))
+            stats["sent"] += 1
+            next_at += interval
+        await asyncio.sleep(args.drain)   # lets the last messages arrive
+    except ConnectionError :
+        stats["errors"] += 1
+    finally :
+        user.close()
+
+async def generate(numbers, args, room_IDs, start_at, stop_at) :
+    stats = {"login" : LatencyHistogram(), "join" : LatencyHistogram(), "fanout" : LatencyHistogram(),
+             "sent" : 0, "delivered" : 0, "errors" : 0, "last_error" : None}
+    connect_slots = asyncio.Semaphore(args.connect_concurrency)
+    await asyncio.gather(*(simulate_user(number, args, room_IDs[number % len(room_IDs)], stats, connect_slots, start_at, stop_at)
+                           for number in numbers))
+    return stats
+
+# a generator process, runs every user whose number is in numbers on its own event loop
+def run_generator(numbers, args, room_IDs, start_at, stop_at) :
+    raise_open_files_limit()
+    return asyncio.run(generate(numbers, args, room_IDs, start_at, stop_at))
+
+# starts the server and waits until its port accepts connections
+def start_server(args) :
+    command = [sys.executable, "-m", "server.server", "--mode", args.mode, "--port", str(args.port), "--db", args.db]
+    if args.workers :
+        command += ["--workers", str(args.workers)]
+    command += args.server_args
+    process = subprocess.Popen(command, stdin = subprocess.PIPE, stdout = subprocess.DEVNULL, text = True)
+    deadline = time.time() + 10
+    while time.time() < deadline :
+        try :
+            socket.create_connection((args.host, args.port), timeout = 1).close()
+            time.sleep(0.5)   # lets every worker start listening
+            return process
+        except OSError :
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("the server did not start")
+
+# returns the resident memory in kilobytes and the threads of the process and of its child processes (the workers)
+def server_usage(pid) :
+    usage = {"rss_kb" : 0, "threads" : 0}
+    pids = [pid]
+    while pids :
+        current = pids.pop()
+        try :
+            with open(f"/proc/{current}/status") as status_file :
+                for line in status_file :
+                    if line.startswith("VmRSS:") :
+                        usage["rss_kb"] += int(line.split()[1])
+                    elif line.startswith("Threads:") :
+                        usage["threads"] += int(line.split()[1])
+            with open(f"/proc/{current}/task/{current}/children") as children_file :
+                pids.extend(int(child) for child in children_file.read().split())
+        except OSError :
+            pass
+    return usage
+
+# creates the rooms of the run as admin, unless rooms named loadgen-<number> already exist, and returns their room IDs
+def prepare_rooms(args) :
+    sock = socket.create_connection((args.host, args.port))
+    reader = sock.makefile("rb")
+
+    def request(action) :
+        sock.sendall(encode_frame(json.dumps(action)))
+        (length,) = HEADER.unpack(reader.read(HEADER.size))
+        return json.loads(reader.read(length))
+
+    if request({"action" : "login", "username" : args.admin_username, "password" : args.admin_password})["code"] != 200 :
+        raise RuntimeError("could not log in as admin")
+    names = {room["room_name"] for room in request({"action" : "list"})["rooms"]}
+    for number in range(args.rooms) :
+        if f"loadgen-{number}" not in names :
+            request({"action" : "create_room", "room_name" : f"loadgen-{number}",
+                     "room_description" : "created by benchmarks/loadgen.py", "room_password" : args.room_password})
+    rooms = {room["room_name"] : room["room_ID"] for room in request({"action" : "list"})["rooms"]}
+    sock.close()
+    return [str(rooms[f"loadgen-{number}"]) for number in range(args.rooms)]
+
+def git_revision() :
+    try :
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output = True, text = True, check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError) :
+        return None
+
+def run(args) :
+    process = start_server(args) if not args.external else None
+    try :
+        room_IDs = prepare_rooms(args)
+        start_at = time.time() + args.ramp_up
+        stop_at = start_at + args.duration
+        shares = [range(number, args.users, args.generators) for number in range(args.generators)]
+        peak = {"rss_kb" : 0, "threads" : 0}
+        with multiprocessing.Pool(args.generators) as pool :
+            pending = pool.starmap_async(run_generator, [(numbers, args, room_IDs, start_at, stop_at) for numbers in shares])
+            while not pending.ready() :
+                pending.wait(1)
+                if process is not None :
+                    usage = server_usage(process.pid)
+                    peak = {key : max(peak[key], usage[key]) for key in peak}
+            results = pending.get()
+        end_usage = server_usage(process.pid) if process is not None else {}
+    finally :
+        if process is not None :
+            stop_server(process)
+
+    totals = {"login" : LatencyHistogram(), "join" : LatencyHistogram(), "fanout" : LatencyHistogram()}
+    for stats in results :
+        for name, histogram in totals.items() :
+            histogram.merge(stats[name])
+    sent = sum(stats["sent"] for stats in results)
+    delivered = sum(stats["delivered"] for stats in results)
+    errors = [stats["last_error"] for stats in results if stats["last_error"]]
+    return {
+        "revision" : git_revision(),
+        "started_at" : time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(start_at)),
+        "config" : {key : value for key, value in vars(args).items() if key not in ("output", "admin_password", "password")},
+        "results" : {
+            "users" : args.users,
+            "errors" : sum(stats["errors"] for stats in results),
+            "last_error" : errors[-1] if errors else None,
+            "login_latency" : totals["login"].summary(),
+            "join_latency" : totals["join"].summary(),
+            "fanout_latency" : totals["fanout"].summary(),
+            "sent_per_second" : round(sent / args.duration, 1),
+            "delivered_per_second" : round(delivered / args.duration, 1),
+            "server_peak" : peak if process is not None else None,
+            "server_end" : end_usage or None,
+        },
+    }
+
+if __name__ == "__main__" :
+    parser = argparse.ArgumentParser(description = "Headless load generator : simulated users log in, join rooms and chat")
+    parser.add_argument("--users", type = int, default = 1000)
+    parser.add_argument("--rooms", type = int, default = 10)
+    parser.add_argument("--rate", type = float, default = 1.0, help = "the messages every user sends per second")
+    parser.add_argument("--message-size", dest = "message_size", type = int, default = 64, help = "the characters of a message")
+    parser.add_argument("--duration", type = float, default = 30.0, help = "the seconds of chatting")
+    parser.add_argument("--ramp-up", dest = "ramp_up", type = float, default = 10.0,
+                        help = "the seconds the users have to connect and join before the chatting starts")
+    parser.add_argument("--drain", type = float, default = 2.0, help = "the seconds to wait for the last messages after the run")
+    parser.add_argument("--generators", type = int, default = max(1, multiprocessing.cpu_count() // 2),
+                        help = "the load generator processes the users are spread over")
+    parser.add_argument("--connect-concurrency", dest = "connect_concurrency", type = int, default = 100,
+                        help = "the users of a generator that connect and join at the same time")
+    parser.add_argument("--host", default = "localhost")
+    parser.add_argument("--port", type = int, default = 7275)
+    parser.add_argument("--external", action = "store_true", help = "load a server that is already running instead of starting one")
+    parser.add_argument("--mode", default = "asyncio", help = "the mode of the server")
+    parser.add_argument("--workers", type = int, default = 0, help = "the worker processes of the server")
+    parser.add_argument("--db", choices = ("sqlite", "standin", "mysql"), default = "sqlite", help = "the storage of the server")
+    parser.add_argument("--server-args", dest = "server_args", nargs = argparse.REMAINDER, default = [],
+                        help = "more options for the server, for example --server-args --queue-size 1000")
+    parser.add_argument("--user-prefix", dest = "user_prefix", default = "loadgen")
+    parser.add_argument("--password", default = "loadgen123")
+    parser.add_argument("--admin-username", dest = "admin_username", default = "admin")
+    parser.add_argument("--admin-password", dest = "admin_password", default = "admin123")
+    parser.add_argument("--room-password", dest = "room_password", default = "loadgen")
+    parser.add_argument("--output", help = "also write the results to this file")
+    args = parser.parse_args()
+
+    limit = raise_open_files_limit()
+    if limit < 2 * args.users + 100 :
+        print(f"Warning : the open files limit ({limit}) is too low for {args.users} users", file = sys.stderr)
+
+    report = run(args)
+    print(json.dumps(report, indent = 2))
+    if args.output :
+        with open(args.output, "w") as output_file :
+            json.dump(report, output_file, indent = 2)
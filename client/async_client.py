@@ -0,0 +1,287 @@
+import asyncio
+import itertools
+import json
+from protocol.framing import FrameDecoder, FrameError, encode_frame, MAX_FRAME_SIZE, RECV_BUFFER_SIZE
+from protocol.binary import OPCODES, decode_event, encode_action, is_binary
+from protocol.compression import COMPRESSIONS, decompress_payload, maybe_compress
+
+RECONNECT_ATTEMPTS = 5    # the times the client tries to reconnect after losing the connection
+RECONNECT_DELAY = 0.5     # the seconds before the first reconnection attempt, doubled after every failed one
+RECONNECT_TIMEOUT = 5.0   # the seconds a reconnection attempt waits for the server to answer
+REQUEST_TIMEOUT = 30.0    # the seconds a request waits for its response
+
+# the programmatic client of the chat server, on asyncio, for the interactive client (client/client.py), bots and tests
+# every request carries a correlation ID ("id"), which the server copies into its response : any number of requests can be in flight
+# on one connection, request() returns the response to its own request whatever order the responses arrive in
+# (a response without an ID, from a server that does not echo them, goes to the oldest request still waiting, the server answers in order)
+# everything the server pushes arrives on the events queue, apart from the responses :
+#   {"event" : "message", "room_ID" : ..., "seq" : ..., "message" : ...} for a message of the room (whichever encoding it arrived in)
+#   {"event" : "notice", "text" : ...} for a plain text frame (the chatting history sent on joining, the server notices)
+#   {"event" : "rate_limited", "action" : "send_message", "scope" : ..., "retry_after" : ...} for a message the server turned away
+#   {"event" : "presence", "room_ID" : ..., "joined" : [...], "left" : [...], "count" : ...} for the users entering and leaving the room
+#   {"event" : "room_counts", "counts" : {room_ID : members}} for the member counts that changed, after list_rooms(watch = True)
+#   {"event" : "disconnected"} when the connection is lost, reconnect() then resumes the session
+# the messages the client already saw (they were part of the history sent on joining or resuming) are not put on the queue again
+# the chat messages are sent in the binary encoding when the server agreed to it, the requests stay JSON to carry their ID
+# with compression agreed on (see protocol/compression.py), the large payloads are compressed both ways
+class AsyncChatClient :
+    def __init__(self, host = "localhost", port = 7171, encodings = ("binary", "json"), max_frame_size = MAX_FRAME_SIZE,
+                 compressions = COMPRESSIONS) :
+        self.host = host
+        self.port = port
+        self.encodings = list(encodings)        # the encodings asked for in the "hello" action, in order of preference
+        self.compressions = list(compressions)  # the compressions asked for in the "hello" action, none for uncompressed frames
+        self.max_frame_size = max_frame_size    # the frame size asked for in the "hello" action
+        self.encoding = "json"                  # the encoding agreed on in the "hello" action, see protocol/binary.py
+        self.compression = None                 # the compression agreed on in the "hello" action, see protocol/compression.py
+        self.reader = None
+        self.writer = None
+        self.read_task = None
+        self.ids = itertools.count(1)           # the correlation IDs of the requests
+        self.pending = {}                       # the correlation ID -> the future of a request waiting for its response, in the order sent
+        self.events = asyncio.Queue()           # the messages, notices and disconnections pushed by the server
+        self.ready = asyncio.Event()            # set while the connection is up (and resumed, after a reconnect)
+        self.username = None
+        self.token = None                       # the last session token from the server, used to resume the session after a reconnect
+        self.room_ID = None                     # the room the client joined last
+        self.last_seq = None                    # the sequence number of the newest message of that room the client has seen
+        self.synced_seq = None                  # the newest message of the history sent on joining, older events are duplicates
+        self.history_cursor = None              # where the next page of older messages of the room starts, None if there are none
+        self.early_events = None                # while a join or resume response is awaited, the events that arrived before it
+
+    # connects to the server and negotiates the frame size and the encoding, returns the "hello" response
+    async def connect(self, timeout = None) :
+        hello = await self.open(timeout)
+        self.ready.set()
+        return hello
+
+    async def open(self, timeout) :
+        self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), timeout)
+        self.encoding = "json"
+        self.compression = None
+        decoder = FrameDecoder()
+        self.read_task = asyncio.ensure_future(self.read_loop(self.reader, self.writer, decoder))
+        hello = await self.request("hello", timeout = timeout, max_frame_size = self.max_frame_size, encodings = self.encodings,
+                                   compressions = self.compressions)
+        decoder.max_frame_size = hello["max_frame_size"]
+        self.encoding = hello.get("encoding", "json")
+        self.compression = hello.get("compression")
+        return hello
+
+    # closes the connection for good, no "disconnected" event is put on the queue
+    async def close(self) :
+        self.ready.clear()
+        if self.writer is not None :
+            self.writer.close()
+        if self.read_task is not None :
+            await asyncio.gather(self.read_task, return_exceptions = True)
+
+    # sends the request and returns its response (a dictionary), raises ConnectionResetError if the connection is lost first
+    async def request(self, action, timeout = REQUEST_TIMEOUT, **fields) :
+        request_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        try :
+            self.write({"action" : action, "id" : request_id, **fields}, binary = False)
+            return await asyncio.wait_for(future, timeout)
+        finally :
+            self.pending.pop(request_id, None)
+
+    # frames the action dictionary and writes it, in binary when it was agreed on and the action has a binary encoding
+    def write(self, action, binary = True) :
+        if self.writer is None or self.writer.is_closing() :
+            raise ConnectionResetError("the connection to the server is lost")
+        if binary and self.encoding == "binary" and action["action"] in OPCODES :
+            payload = encode_action(action)
+        else :
+            payload = json.dumps(action).encode('utf-8')
+        if self.compression is not None :
+            payload = maybe_compress(payload)
+        self.writer.write(encode_frame(payload))
+
+    # reads the frames of one connection until it is lost, and routes them to the requests or the events queue
+    async def read_loop(self, reader, writer, decoder) :
+        try :
+            while True :
+                data = await reader.read(RECV_BUFFER_SIZE)
+                if not data :
+                    break
+                for payload in decoder.feed(data) :
+                    self.dispatch(decompress_payload(payload, decoder.max_frame_size))
+        except (OSError, FrameError, ValueError) :
+            pass
+        finally :
+            writer.close()
+            self.connection_lost(writer)
+
+    def dispatch(self, payload) :
+        if is_binary(payload) :
+            self.push_event(decode_event(payload))
+        elif payload[:1] == b"{" :
+            data = json.loads(payload)
+            if "event" in data :
+                self.push_event(data)
+            else :
+                self.resolve(data)
+        else :
+            self.events.put_nowait({"event" : "notice", "text" : payload.decode('utf-8')})
+
+    def resolve(self, response) :
+        request_id = response.pop("id", None)
+        if request_id is None :
+            future = next((future for future in self.pending.values() if not future.done()), None)
+        else :
+            future = self.pending.get(request_id)
+        if future is not None and not future.done() :
+            future.set_result(response)
+
+    def push_event(self, event) :
+        if self.early_events is not None :
+            self.early_events.append(event)
+        else :
+            self.accept_event(event)
+
+    # puts a message event on the queue unless the client already saw it, and remembers the newest sequence number seen
+    # the events of concurrent senders can arrive slightly out of order, so only the history sent on joining counts as seen
+    def accept_event(self, event) :
+        if event["event"] == "message" :
+            if self.synced_seq is not None and event["seq"] <= self.synced_seq :
+                return
+            self.last_seq = max(self.last_seq or 0, event["seq"])
+        self.events.put_nowait(event)
+
+    def accept_early_events(self) :
+        events, self.early_events = self.early_events or [], None
+        for event in events :
+            self.accept_event(event)
+
+    def connection_lost(self, writer) :
+        if writer is not self.writer :
+            return
+        was_ready = self.ready.is_set()   # not while connecting or reconnecting, nor after close()
+        self.ready.clear()
+        for future in self.pending.values() :
+            if not future.done() :
+                future.set_exception(ConnectionResetError("the connection to the server is lost"))
+        if was_ready :
+            self.events.put_nowait({"event" : "disconnected"})
+
+    # returns the response, and keeps the username and the session token when the registration succeeded
+    async def register(self, username, password) :
+        response = await self.request("register", username = username, password = password)
+        if response.get("code") == 200 :
+            self.username, self.token = response["username"], response["token"]
+        return response
+
+    async def login(self, username, password) :
+        response = await self.request("login", username = username, password = password)
+        if response.get("code") == 200 :
+            self.username, self.token = response["username"], response["token"]
+        return response
+
+    # returns the rooms of the catalog, as {"room_ID" : ..., "room_name" : ..., "members" : ...} dictionaries
+    # watch true (or false) starts (or stops) the room_counts events, which keep the member counts up to date
+    async def list_rooms(self, watch = None) :
+        fields = {"watch" : watch} if watch is not None else {}
+        response = await self.request("list", **fields)
+        return response["rooms"]
+
+    # retention_age, retention_messages and retention_bytes are the retention policy of the history of the room, None for the server's
+    async def create_room(self, room_name, room_description, room_password, room_timeout = None,
+                          retention_age = None, retention_messages = None, retention_bytes = None) :
+        fields = {name : value for name, value in (("room_timeout", room_timeout), ("retention_age", retention_age),
+                                                   ("retention_messages", retention_messages), ("retention_bytes", retention_bytes))
+                  if value is not None}
+        return await self.request("create_room", room_name = room_name, room_description = room_description,
+                                  room_password = room_password, **fields)
+
+    async def delete_room(self, room_ID) :
+        return await self.request("delete_room", room_ID = room_ID)
+
+    async def stats(self) :
+        return await self.request("stats")
+
+    # joins the room, rejoining the room it was in last only asks for the messages the client missed
+    # the history of the room arrives on the events queue as notices, after the response
+    async def join_room(self, room_ID, room_password) :
+        fields = {"last_seq" : self.last_seq} if room_ID == self.room_ID and self.last_seq is not None else {}
+        self.early_events = []
+        try :
+            response = await self.request("join_room", room_ID = room_ID, room_password = room_password, **fields)
+            if response.get("code") == 200 :
+                self.room_ID = room_ID
+                self.token = response.get("token", self.token)
+                self.last_seq = self.synced_seq = response["last_seq"]
+                if "cursor" in response :
+                    self.history_cursor = response["cursor"]
+        finally :
+            self.accept_early_events()
+        return response
+
+    # restores the username and the room of the session from the session token, on a new connection
+    async def resume(self) :
+        self.early_events = []
+        try :
+            response = await self.request("resume", token = self.token, last_seq = self.last_seq)
+            if response.get("code") == 200 :
+                self.username, self.token = response["username"], response["token"]
+                self.room_ID = response["room_ID"]
+                self.last_seq = self.synced_seq = response["last_seq"]
+        finally :
+            self.accept_early_events()
+        return response
+
+    # returns the page of messages before the oldest one shown so far, and remembers where the next page starts
+    async def history(self, before = None, limit = None) :
+        fields = {"limit" : limit} if limit is not None else {}
+        response = await self.request("history", before = before if before is not None else self.history_cursor, **fields)
+        if response.get("code") == 200 :
+            self.history_cursor = response["cursor"]
+        return response
+
+    # returns the messages of the room containing every word of the query (and sent by username, if given), newest first,
+    # as {"code" : 200, "results" : [{"seq", "time", "message"}, ...], "cursor" : ...}, pass the cursor as before for the next page
+    async def search(self, query, username = None, before = None, limit = None) :
+        fields = {"limit" : limit} if limit is not None else {}
+        return await self.request("search", query = query, username = username, before = before, **fields)
+
+    # returns the users in the room (the room the client is in by default),
+    # as {"code" : 200, "room_ID" : ..., "count" : ..., "users" : [...]}, count includes the clients that did not log in
+    async def who(self, room_ID = None) :
+        return await self.request("who", room_ID = room_ID)
+
+    # sends a message to the room, there is no response : the other members receive it as a message event
+    # the server sends it under the username of the session, so the action does not carry one
+    # while the client is reconnecting, waits for the session to be resumed first
+    async def send_message(self, message) :
+        if not self.ready.is_set() :
+            await asyncio.wait_for(self.ready.wait(), RECONNECT_DELAY * 2 ** RECONNECT_ATTEMPTS + RECONNECT_ATTEMPTS * RECONNECT_TIMEOUT)
+        self.write({"action" : "send_message", "message" : message})
+
+    # leaves the room, there is no response
+    def disconnect(self) :
+        self.write({"action" : "disconnect"})
+
+    # reconnects after the connection to the server was lost and resumes the session with the last session token
+    # tries RECONNECT_ATTEMPTS times, waiting twice as long after every failed attempt
+    # returns the "resume" response (its code tells if the server accepted the token), None if the server stayed unreachable
+    async def reconnect(self) :
+        if self.token is None :
+            return None
+        delay = RECONNECT_DELAY
+        for _ in range(RECONNECT_ATTEMPTS) :
+            await asyncio.sleep(delay)
+            delay *= 2
+            try :
+                await self.open(RECONNECT_TIMEOUT)
+                response = await asyncio.wait_for(self.resume(), RECONNECT_TIMEOUT)
+            except (OSError, asyncio.TimeoutError, ValueError) :
+                if self.writer is not None :
+                    self.writer.close()
+                continue
+            if response["code"] != 200 :
+                self.token = None
+            else :
+                self.ready.set()
+            return response
+        return None
@@ -1,260 +1,288 @@
-import socket
-import json
-import threading
-import keyboard
-import time
-
-
-class ChatClient :
-    def __init__(self) :
-        self.client_sock = None                   # the client socket object to be created
-        self.username = None                      # to store the username when logged in
-        self.listener_event = threading.Event()   # the event to signal the listener thread to stop
-        self.listener_thread = None               # the listener thread object
-
-    # used to create a socket object and connect the client to the server
-    # creates a new socket object using the AF_INET address family (IPv4) and the SOCK_STREAM type (TCP)
-    # attempts to connect to the server at localhost on port 7171
-    # if the connection is successful, the method prints a confirmation message
-    # if an error occurs during the connection (the server is unavailable),
-    # the method catches the exception, prints an error message, closes the socket and exits the program
-    def create_socket(self) :
-        self.client_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_address = ('localhost', 7171)
-        try :
-            self.client_sock.connect(server_address)
-            print("Connected to the server...")
-        except socket.error as exception :
-            print(f"Error connecting to the server : {exception}")
-            self.client_sock.close()
-            exit(1)
-        return self.client_sock
-
-    # allows a new user to register with the server by sending their credentials
-    # prompts the user for a username and a password
-    # creates an action dictionary containing the registration request, and sends it to the server in JSON format
-    # then waits for the server response, which is received and printed
-    # returns the response as a Python dictionary
-    def register(self) :
-        username = input("Username : ")
-        password = input("Password : ")
-        action = {"action" : "register", "username" : username, "password" : password}
-        try :
-            self.client_sock.send(json.dumps(action).encode('utf-8'))
-            register_response = self.client_sock.recv(1024).decode('utf-8')
-            register_data = json.loads(register_response)
-            print(register_data["message"])
-            return json.loads(register_response)
-        except (socket.error, ConnectionResetError) as exception :
-            print(f"Error registering the user : {exception}")
-            self.client_sock.close()
-            exit(1)
-
-    # used to authenticate an existing user by sending their username and password to the server
-    # prompts the user for their login credentials
-    # creates an action dictionary containing the login request, and sends it to the server in JSON format
-    # the server response is then received and printed
-    # returns the response as a Python dictionary
-    def login(self) :
-        username = input("Username : ")
-        password = input("Password : ")
-        action = {"action" : "login", "username" : username, "password" : password}
-        try :
-            self.client_sock.send(json.dumps(action).encode('utf-8'))
-            login_response = self.client_sock.recv(1024).decode('utf-8')
-            login_data = json.loads(login_response)
-            print(login_data["message"])
-            return json.loads(login_response)
-        except (socket.error, ConnectionResetError) as exception :
-            print(f"Error authenticating the user : {exception}")
-            self.client_sock.close()
-            exit(1)
-
-    # requests a list of available chat rooms from the server
-    # sends an action dictionary with the action type set to "list"
-    # after sending the request, the method waits for the server response
-    # then decodes the response, extracts the room information and prints out the available rooms
-    def list_rooms(self) :
-        action = {"action" : "list"}
-        try :
-            self.client_sock.send(json.dumps(action).encode('utf-8'))
-            list_rooms_response = self.client_sock.recv(1024).decode('utf-8')
-            available_rooms = json.loads(list_rooms_response)["rooms"]
-            print("\nAvailable Rooms : ")
-            for room in available_rooms :
-                print(f"Room : {room['room_name']}, ID : {room['room_ID']}")
-            return available_rooms
-        except (socket.error, ConnectionResetError) as exception :
-            print(f"Error fetching the list of available rooms : {exception}")
-            self.client_sock.close()
-            exit(1)
-
-    # allows the user to create a new chat room
-    # prompts the user to enter the room name, description and password
-    # sends this data to the server in a JSON-encoded dictionary with the action type set to "create_room"
-    # the server response is then received and printed
-    def create_room(self) :
-        room_name = input("Enter room name : ")
-        room_description = input("Enter the description of the new room : ")
-        room_password = input("Enter the password of the new room : ")
-        action = {"action" : "create_room", "room_name" : room_name,
-                  "room_description" : room_description, "room_password" : room_password}
-        try :
-            self.client_sock.send(json.dumps(action).encode('utf-8'))
-            create_response = self.client_sock.recv(1024).decode('utf-8')
-            print("Room Creation Response : ", create_response)
-        except (socket.error, ConnectionResetError) as exception :
-            print(f"Error creating the room : {exception}")
-            self.client_sock.close()
-            exit(1)
-
-    # allows the user to delete a chat room by its ID
-    # prompts the user for the room ID to be deleted
-    # sends the ID to the server in a JSON-encoded dictionary with the action type set to "delete_room"
-    # the server response, indicating the success or failure of the deletion, is then printed
-    def delete_room(self) :
-        room_ID = input("Enter the ID of the room to delete : ")
-        action = {"action" : "delete_room", "room_ID" : room_ID}
-        try :
-            self.client_sock.send(json.dumps(action).encode('utf-8'))
-            delete_response = self.client_sock.recv(1024).decode('utf-8')
-            print("Room Deletion Response : ", delete_response)
-        except (socket.error, ConnectionResetError) as exception :
-            print(f"Error deleting the room : {exception}")
-            self.client_sock.close()
-            exit(1)
-
-    # allows the user to join an existing chat room by providing the room ID and password
-    # prompts the user to input the room ID and password
-    # then it sends this information to the server in a JSON-encoded dictionary with the action type set to "join_room"
-    # after sending the request, the method waits for the server response,
-    # which is expected to be a message indicating whether the user was successfully added to the room or not
-    def join_room(self) :
-        room_ID = input("Enter a room ID to join : ")
-        room_password = input("Enter the room password to join : ")
-        action = {"action" : "join_room", "room_ID" : room_ID, "room_password" : room_password}
-        try :
-            self.client_sock.send(json.dumps(action).encode('utf-8'))
-            join_response = self.client_sock.recv(1024).decode('utf-8')
-            join_data = json.loads(join_response)
-            print(join_data["message"])
-            return json.loads(join_response)
-        except (socket.error, ConnectionResetError) as exception :
-            print(f"Error joining the room : {exception}")
-            self.client_sock.close()
-            exit(1)
-
-    # continuously listens for incoming messages from the server in a non-blocking manner
-    # operates within a while loop, which keeps running as long as the listener_event is not set
-    # sets a timeout of 1 second using self.client_sock.settimeout(1.0)
-    # which means the client will attempt to receive data, but will not block indefinitely if no message is received
-    def listen_for_messages(self) :
-        while not self.listener_event.is_set() :
-            try :
-                self.client_sock.settimeout(1.0)
-                response = self.client_sock.recv(1024).decode('utf-8')
-                if response == "" :
-                    break
-                else :
-                    print(f"\n{response}\n", end='', flush=True)
-
-                    # Ensure the input prompt is on the same line after printing the message
-                    print("you > ", end="", flush=True)  # Reprint prompt without moving to the next line
-            except socket.timeout :
-                if self.listener_event.is_set() :
-                    break
-            except (socket.error, ConnectionResetError) as exception :
-                print(f"Error : {exception}")
-                return
-            
-    # manages the chatting session
-    # starts by clearing the listener_event and launching a listener thread to handle incoming messages
-    # the user can then input messages in a loop, if the user types "quit",
-    # the method sends a "disconnect" action to the server and prints a message that the user has left the room
-    # then sets the listener_event to stop the listener thread and waits for it to finish with join()
-    # finally, the method resets the current_room and exits the loop, returning the user to the main menu
-    def chat(self) :
-        self.listener_event.clear()
-        self.listener_thread = threading.Thread(target = self.listen_for_messages, daemon = True)
-        self.listener_thread.start()
-        
-        while True :
-            message = input("you > ")
-            print()
-            if message.lower() == 'quit' :
-                action = {"action" : "disconnect"}
-                self.client_sock.send(json.dumps(action).encode('utf-8'))
-                print("You left the room...")
-
-                # stop the listener thread by setting the event
-                self.listener_event.set()
-
-                # wait for the listener thread to finish
-                self.listener_thread.join()
-
-                break
-            else :
-                action = {"action" : "send_message", "username" : self.username, "message" : message}
-                self.client_sock.send(json.dumps(action).encode('utf-8'))
-
-    # controls the main flow of the program, guiding the user through registration or login
-    # then provides a command prompt for the user to interact with the chatroom system
-    # Registration/Authentication : the user can choose to register (r) or log in (l)
-    # Upon successful registration or login (code 200), the username and isAdmin variables are set
-    # create : only admins can create new rooms
-    # delete : only admins can delete rooms
-    # list : view a list of available rooms
-    # join : join a room (if successful, the user enters the chatting session)
-    # exit : closes the connection and exits the loop
-    # permissions : non-admin users are denied access to room creation and deletion with a "Permission Denied" message
-    def main(self) :
-        isAdmin = False
-
-        while True :
-            if self.username is None :
-                choice = input("Do you want to (r)egister or (l)ogin? ").lower()
-                if choice == 'r' :
-                    registration_response = self.register()
-                    if registration_response.get("code") == 200 :
-                        self.username = registration_response.get("username")
-                elif choice == 'l' :
-                    authentication_response = self.login()
-                    if authentication_response.get("code") == 200 :
-                        self.username = authentication_response.get("username")
-                        isAdmin = (self.username == 'admin')
-                else :
-                    print("Invalid Choice!")
-            else :
-                command = input("\nEnter a command\n\n1.List\n2.Create\n3.Delete\n4.Join\n5.Exit\n\n").lower()
-                if command == 'create' :
-                    if isAdmin :
-                        self.create_room()
-                    else :
-                        print("Permission Denied. Only Admin!")
-                elif command == 'delete' :
-                    if isAdmin :
-                        self.delete_room()
-                    else :
-                        print("Permission Denied. Only Admin!")
-                elif command == 'list' :
-                    self.list_rooms()
-                elif command == 'join' :
-                    join_resp = self.join_room()
-                    if join_resp.get("code") == 200 :
-                        self.chat()
-                elif command == 'exit' :
-                    print("Exiting...")
-                    self.client_sock.close()
-                    break
-                else :
-                    print("Invalid Command!")
-
-if __name__ == "__main__" :
-    try :
-        client = ChatClient()    # create a client instance
-        client.create_socket()   # create the socket connection
-        client.main()            # start the main interaction loop
-    except KeyboardInterrupt :
-        print("\nBye...")
-    except Exception as e :
-        print(f"Something went wrong. Shutting down... {e}")
\ No newline at end of file
+import asyncio
+import json
+import threading
+import keyboard
+from client.async_client import AsyncChatClient, RECONNECT_TIMEOUT
+
+SERVER_ADDRESS = ('localhost', 7171)
+
+# the interactive client, a thin layer over the programmatic client of client/async_client.py
+# the programmatic client runs on an asyncio event loop in a background thread, the prompts of this class run in the main thread
+# and hand it the requests with call() : the responses come back to the request that sent them, and the messages of the room
+# arrive on the events queue of the programmatic client, which the printer prints during the chatting session
+class ChatClient :
+    def __init__(self) :
+        self.api = AsyncChatClient(*SERVER_ADDRESS)   # the programmatic client, all the connection state lives there
+        self.loop = asyncio.new_event_loop()          # the event loop of the programmatic client
+        self.loop_thread = threading.Thread(target = self.loop.run_forever, daemon = True)
+        self.printer = None                           # the future of the printer, while in a chatting session
+        self.loop_thread.start()
+
+    @property
+    def username(self) :
+        return self.api.username
+
+    # runs the coroutine on the event loop of the programmatic client and returns its result
+    def call(self, coroutine) :
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    # connects the client to the server at SERVER_ADDRESS (localhost on port 7171) and negotiates the frame size and the encoding
+    # if the connection is successful, the method prints a confirmation message
+    # if an error occurs during the connection (the server is unavailable), the method prints an error message and exits the program
+    def create_socket(self) :
+        try :
+            self.call(self.api.connect(RECONNECT_TIMEOUT))
+            print("Connected to the server...")
+        except (OSError, asyncio.TimeoutError) as exception :
+            print(f"Error connecting to the server : {exception}")
+            exit(1)
+
+    # closes the connection and stops the event loop
+    def close(self) :
+        self.call(self.api.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    # sends a request with call(), a lost connection outside of the chatting session ends the program
+    def request(self, coroutine, failure) :
+        try :
+            return self.call(coroutine)
+        except (OSError, asyncio.TimeoutError) as exception :
+            print(f"{failure} : {exception}")
+            exit(1)
+
+    # allows a new user to register with the server by sending their credentials
+    # prompts the user for a username and a password, then prints the server response and returns it
+    def register(self) :
+        username = input("Username : ")
+        password = input("Password : ")
+        register_data = self.request(self.api.register(username, password), "Error registering the user")
+        print(register_data["message"])
+        return register_data
+
+    # used to authenticate an existing user by sending their username and password to the server
+    # prompts the user for their login credentials, then prints the server response and returns it
+    def login(self) :
+        username = input("Username : ")
+        password = input("Password : ")
+        login_data = self.request(self.api.login(username, password), "Error authenticating the user")
+        print(login_data["message"])
+        return login_data
+
+    # requests a list of available chat rooms from the server and prints out the available rooms
+    def list_rooms(self) :
+        available_rooms = self.request(self.api.list_rooms(), "Error fetching the list of available rooms")
+        print("\nAvailable Rooms : ")
+        for room in available_rooms :
+            print(f"Room : {room['room_name']}, ID : {room['room_ID']}, Members : {room.get('members', 0)}")
+        return available_rooms
+
+    # asks the server for its metrics (admin only) and prints them
+    def show_stats(self) :
+        stats_data = self.request(self.api.stats(), "Error fetching the server metrics")
+        if stats_data.get("code") == 200 :
+            print(json.dumps(stats_data["stats"], indent = 2))
+        else :
+            print(stats_data["message"])
+
+    # allows the user to create a new chat room
+    # prompts the user to enter the room name, description, password and optionally the inactivity timeout
+    # and the retention policy of the chatting history of the room
+    # the server response is then printed
+    def create_room(self) :
+        room_name = input("Enter room name : ")
+        room_description = input("Enter the description of the new room : ")
+        room_password = input("Enter the password of the new room : ")
+        room_timeout = optional_number("Enter the inactivity timeout of the new room in seconds (empty for the default) : ")
+        retention_age = optional_number("Keep the messages for how many seconds (empty for the default) : ")
+        retention_messages = optional_number("Keep how many of the newest messages (empty for the default) : ")
+        retention_bytes = optional_number("Keep the history to how many bytes on disk (empty for the default) : ")
+        create_response = self.request(self.api.create_room(room_name, room_description, room_password, room_timeout,
+                                                            retention_age, retention_messages, retention_bytes),
+                                       "Error creating the room")
+        print("Room Creation Response : ", create_response)
+
+    # allows the user to delete a chat room by its ID
+    # prompts the user for the room ID to be deleted, the server response indicating the success or failure of the deletion is printed
+    def delete_room(self) :
+        room_ID = input("Enter the ID of the room to delete : ")
+        delete_response = self.request(self.api.delete_room(room_ID), "Error deleting the room")
+        print("Room Deletion Response : ", delete_response)
+
+    # allows the user to join an existing chat room by providing the room ID and password
+    # when rejoining the room it was in last, the programmatic client only asks for the messages the client missed
+    # the response indicates whether the user was successfully added to the room or not
+    def join_room(self) :
+        room_ID = input("Enter a room ID to join : ")
+        room_password = input("Enter the room password to join : ")
+        join_data = self.request(self.api.join_room(room_ID, room_password), "Error joining the room")
+        print(join_data["message"])
+        if join_data.get("code") == 200 and join_data["sync"] == "resync" :
+            print("Too many messages were missed, showing the latest ones...")
+        return join_data
+
+    # prints what the server pushes during the chatting session : the messages of the room and the notices
+    # if the connection is lost, reconnects and resumes the session (see AsyncChatClient.reconnect), and stops only if that fails
+    async def print_events(self) :
+        while True :
+            event = await self.api.events.get()
+            if event["event"] == "message" :
+                print(f"\n{event['message']}\n", end = '', flush = True)
+            elif event["event"] == "notice" :
+                print(f"\n{event['text']}\n", end = '', flush = True)
+            elif event["event"] == "presence" :
+                for username in event["joined"] :
+                    print(f"\n{username} joined the room\n", end = '', flush = True)
+                for username in event["left"] :
+                    print(f"\n{username} left the room\n", end = '', flush = True)
+            elif event["event"] == "rate_limited" :
+                print(f"\nYou are sending too fast, your message was not sent (try again in {event['retry_after']:.1f} s)\n", end = '', flush = True)
+            elif event["event"] == "disconnected" :
+                print("\nConnection lost, reconnecting...")
+                resume_data = await self.api.reconnect()
+                if resume_data is None :
+                    print("Could not reconnect to the server...")
+                    return
+                print(resume_data["message"])
+                if resume_data["code"] != 200 :
+                    return
+                if resume_data["room_ID"] is None :
+                    print("The room no longer exists, type 'quit' to go back to the menu")
+            # Ensure the input prompt is on the same line after printing the message
+            print("you > ", end = "", flush = True)  # Reprint prompt without moving to the next line
+
+    # asks the server for the page of messages before the oldest one shown so far, and prints it
+    def show_older_messages(self) :
+        if self.api.history_cursor is None :
+            print("No older messages...")
+            return
+        history_data = self.call(self.api.history())
+        if history_data.get("code") != 200 :
+            print(history_data["message"])
+            return
+        print("Older Messages : ")
+        for entry in history_data["messages"] :
+            print(entry["message"])
+        if self.api.history_cursor is None :
+            print("(the beginning of the chatting history)")
+
+    # searches the messages of the room, "/search @bob lunch" looks for the messages of bob containing "lunch", newest first
+    # the words are all required, a word ending in * matches the words it starts
+    def show_search_results(self, command) :
+        words = command.split()[1:]
+        username = words.pop(0)[1:] if words and words[0].startswith("@") else None
+        search_data = self.call(self.api.search(" ".join(words), username))
+        if search_data.get("code") != 200 :
+            print(search_data["message"])
+            return
+        print("Search Results : " if search_data["results"] else "No messages found...")
+        for entry in search_data["results"] :
+            print(f"#{entry['seq']} {entry['message']}")
+        if search_data["cursor"] is not None :
+            print(f"(only the newest {len(search_data['results'])} results are shown)")
+
+    # asks the server who is in the room and prints them
+    def show_members(self) :
+        who_data = self.call(self.api.who())
+        if who_data.get("code") != 200 :
+            print(who_data["message"])
+            return
+        print(f"In the room ({who_data['count']}) : {', '.join(who_data['users'])}")
+
+    # manages the chatting session
+    # starts the printer of the messages of the room on the event loop of the programmatic client
+    # the user can then input messages in a loop, typing "/more" shows the older messages of the room,
+    # "/search [@username] words" searches them (see show_search_results), "/who" lists the users in the room,
+    # and if the user types "quit", the method sends a "disconnect" action to the server, prints a message that the user has left the room
+    # and stops the printer, returning the user to the main menu
+    # while the client is reconnecting, the messages wait for the session to be resumed (see AsyncChatClient.send_message)
+    def chat(self) :
+        self.printer = asyncio.run_coroutine_threadsafe(self.print_events(), self.loop)
+
+        try :
+            while True :
+                message = input("you > ")
+                print()
+                if message.lower() == 'quit' :
+                    self.loop.call_soon_threadsafe(self.api.disconnect)
+                    print("You left the room...")
+                    break
+                elif message == '/more' :
+                    self.show_older_messages()
+                elif message.startswith('/search') :
+                    self.show_search_results(message)
+                elif message == '/who' :
+                    self.show_members()
+                else :
+                    self.call(self.api.send_message(message))
+        except (OSError, asyncio.TimeoutError) as exception :
+            print(f"Error : {exception}")
+            exit(1)
+        finally :
+            self.printer.cancel()
+
+    # controls the main flow of the program, guiding the user through registration or login
+    # then provides a command prompt for the user to interact with the chatroom system
+    # Registration/Authentication : the user can choose to register (r) or log in (l)
+    # Upon successful registration or login (code 200), the programmatic client keeps the username and the session token
+    # create : only admins can create new rooms
+    # delete : only admins can delete rooms
+    # stats : only admins can see the server metrics
+    # list : view a list of available rooms
+    # join : join a room (if successful, the user enters the chatting session)
+    # exit : closes the connection and exits the loop
+    # permissions : non-admin users are denied access to room creation and deletion with a "Permission Denied" message
+    def main(self) :
+        while True :
+            if self.username is None :
+                choice = input("Do you want to (r)egister or (l)ogin? ").lower()
+                if choice == 'r' :
+                    self.register()
+                elif choice == 'l' :
+                    self.login()
+                else :
+                    print("Invalid Choice!")
+            else :
+                isAdmin = (self.username == 'admin')
+                command = input("\nEnter a command\n\n1.List\n2.Create\n3.Delete\n4.Join\n5.Stats\n6.Exit\n\n").lower()
+                if command == 'create' :
+                    if isAdmin :
+                        self.create_room()
+                    else :
+                        print("Permission Denied. Only Admin!")
+                elif command == 'delete' :
+                    if isAdmin :
+                        self.delete_room()
+                    else :
+                        print("Permission Denied. Only Admin!")
+                elif command == 'stats' :
+                    if isAdmin :
+                        self.show_stats()
+                    else :
+                        print("Permission Denied. Only Admin!")
+                elif command == 'list' :
+                    self.list_rooms()
+                elif command == 'join' :
+                    join_resp = self.join_room()
+                    if join_resp.get("code") == 200 :
+                        self.chat()
+                elif command == 'exit' :
+                    print("Exiting...")
+                    self.close()
+                    break
+                else :
+                    print("Invalid Command!")
+
+# prompts for a positive number, returns None if the answer is empty (or not a number)
+def optional_number(prompt) :
+    answer = input(prompt).strip()
+    return int(answer) if answer.isdigit() and int(answer) > 0 else None
+
+if __name__ == "__main__" :
+    try :
+        client = ChatClient()    # create a client instance
+        client.create_socket()   # create the socket connection
+        client.main()            # start the main interaction loop
+    except KeyboardInterrupt :
+        print("\nBye...")
+    except Exception as e :
+        print(f"Something went wrong. Shutting down... {e}")
@@ -0,0 +1,220 @@
+import threading
+import time
+from collections import deque
+
+# the parameters of the MySQL connections, shared by the server and the auth module
+DB_CONFIG = {
+    "host" : "localhost",
+    "user" : "root",
+    "password" : "root",
+    "database" : "chatroom",
+}
+
+MIN_SIZE = 4                  # the connections opened when the pool starts and kept open while idle
+MAX_SIZE = 32                 # the most connections open at the same time, further callers wait for a free one
+ACQUIRE_TIMEOUT = 5.0         # the seconds a caller waits for a free connection before PoolError is raised
+HEALTH_CHECK_INTERVAL = 30.0  # a connection idle for longer than this is pinged before it is handed out again
+
+# raised when no connection becomes free within the acquire timeout, or the pool is closed
+class PoolError(Exception) :
+    pass
+
+# opens a connection to the MySQL database of DB_CONFIG, the default connect function of the pool
+# mysql.connector is only imported here, so the pools of the other databases do not need it
+def connect_mysql() :
+    import mysql.connector
+    return mysql.connector.connect(**DB_CONFIG)
+
+# the connection handed out by the pool, used exactly like a mysql.connector connection
+# close() does not close the underlying connection, it ends the current transaction and gives the connection back to the pool
+class PooledConnection :
+    def __init__(self, pool, connection) :
+        self._pool = pool
+        self._connection = connection
+        self._acquired_at = time.monotonic()
+
+    def __getattr__(self, name) :
+        return getattr(self._connection, name)
+
+    def close(self) :
+        if self._connection is not None :
+            connection, self._connection = self._connection, None
+            if self._pool.observe is not None :
+                self._pool.observe("db.connection_held", time.monotonic() - self._acquired_at)
+            self._pool.release(connection)
+
+# a thread safe pool of database connections
+# connect is the function that opens a new connection (connect_mysql by default),
+# any DB-API connection factory works, for example sqlite3.connect for a local stand-in database
+# hands out the most recently used idle connection first, so the rarely used ones age out and get health checked
+# observe(name, seconds), when given, receives the time every acquire waited ("db.acquire")
+# and the time every connection was held before it was given back ("db.connection_held", which is mostly the queries)
+class ConnectionPool :
+    def __init__(self, connect = None, min_size = MIN_SIZE, max_size = MAX_SIZE,
+                 acquire_timeout = ACQUIRE_TIMEOUT, health_check_interval = HEALTH_CHECK_INTERVAL, observe = None) :
+        self.connect = connect or connect_mysql
+        self.observe = observe
+        self.min_size = min_size
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.health_check_interval = health_check_interval
+        self.idle = deque()                  # (connection, time it was released) pairs, the newest on the right
+        self.condition = threading.Condition()
+        self.closed = False
+        self.size = 0                        # the open connections, idle and in use, including the ones being opened
+        self.in_use = 0
+        self.waiters = 0
+        self.created = 0
+        self.acquired = 0
+        self.timeouts = 0
+        self.discarded = 0
+
+    # opens connections until min_size of them are idle, returns the number of connections that could be opened
+    def start(self) :
+        opened = []
+        for _ in range(self.min_size - self.size) :
+            try :
+                opened.append(self.acquire())
+            except Exception as exception :   # the errors of whichever driver connect uses
+                print(f"Error opening a database connection : {exception}")
+                break
+        for connection in opened :
+            connection.close()
+        return len(opened)
+
+    # returns a PooledConnection, waiting at most timeout seconds (acquire_timeout by default) for a free one
+    def acquire(self, timeout = None) :
+        started = time.monotonic()
+        deadline = started + (self.acquire_timeout if timeout is None else timeout)
+        while True :
+            with self.condition :
+                if self.closed :
+                    raise PoolError("the connection pool is closed")
+                while not self.idle and self.size >= self.max_size :
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 :
+                        self.timeouts += 1
+                        raise PoolError(f"no database connection became free within {self.acquire_timeout} seconds")
+                    self.waiters += 1
+                    try :
+                        self.condition.wait(remaining)
+                    finally :
+                        self.waiters -= 1
+                    if self.closed :
+                        raise PoolError("the connection pool is closed")
+
+                if self.idle :
+                    connection, released_at = self.idle.pop()
+                else :
+                    connection, released_at = None, None
+                    self.size += 1
+                self.in_use += 1
+
+            if connection is None :
+                try :
+                    connection = self.connect()
+                except Exception :
+                    self.forget()
+                    raise
+                with self.condition :
+                    self.created += 1
+                    self.acquired += 1
+                if self.observe is not None :
+                    self.observe("db.acquire", time.monotonic() - started)
+                return PooledConnection(self, connection)
+
+            if time.monotonic() - released_at < self.health_check_interval or self.is_healthy(connection) :
+                with self.condition :
+                    self.acquired += 1
+                if self.observe is not None :
+                    self.observe("db.acquire", time.monotonic() - started)
+                return PooledConnection(self, connection)
+            self.discard(connection)
+
+    # ends the transaction of the connection and makes it available again
+    # a connection that can not even be rolled back is broken and gets discarded, so does every connection once the pool is closed
+    def release(self, connection) :
+        try :
+            connection.rollback()
+        except Exception :
+            self.discard(connection)
+            return
+        if self.closed :
+            self.discard(connection)
+            return
+        with self.condition :
+            self.in_use -= 1
+            self.idle.append((connection, time.monotonic()))
+            self.condition.notify()
+
+    def is_healthy(self, connection) :
+        try :
+            if hasattr(connection, 'ping') :
+                connection.ping(reconnect = False)
+            else :
+                connection.cursor().execute("SELECT 1")
+            return True
+        except Exception :
+            return False
+
+    # closes a connection that is in use and frees its place in the pool
+    def discard(self, connection) :
+        try :
+            connection.close()
+        except Exception :
+            pass
+        with self.condition :
+            self.discarded += 1
+        self.forget()
+
+    def forget(self) :
+        with self.condition :
+            self.size -= 1
+            self.in_use -= 1
+            self.condition.notify()
+
+    # closes the idle connections, the ones in use are closed when they are released
+    def close(self) :
+        with self.condition :
+            idle, self.idle = list(self.idle), deque()
+            self.size -= len(idle)
+            self.closed = True
+            self.condition.notify_all()
+        for connection, _ in idle :
+            try :
+                connection.close()
+            except Exception :
+                pass
+
+    # returns the current state of the pool
+    def metrics(self) :
+        with self.condition :
+            return {
+                "size" : self.size,
+                "idle" : len(self.idle),
+                "in_use" : self.in_use,
+                "waiters" : self.waiters,
+                "created" : self.created,
+                "acquired" : self.acquired,
+                "timeouts" : self.timeouts,
+                "discarded" : self.discarded,
+            }
+
+pool = None   # the pool shared by the server and the auth module, created by configure_pool or on first use
+pool_lock = threading.Lock()
+
+# replaces the shared pool with one built from the given settings (see ConnectionPool) and returns it
+def configure_pool(**settings) :
+    global pool
+    with pool_lock :
+        if pool is not None :
+            pool.close()
+        pool = ConnectionPool(**settings)
+        return pool
+
+def get_pool() :
+    global pool
+    with pool_lock :
+        if pool is None :
+            pool = ConnectionPool()
+        return pool
@@ -0,0 +1,127 @@
+import sqlite3
+import tempfile
+
+# a stand-in for the MySQL database, for benchmarks and local runs without a MySQL server (see benchmarks/loadgen.py)
+# the chatroom tables of dump.sql in a SQLite file, queried inside the server process through the usual connection pool :
+# configure_pool(connect = standin.connect) hands out standin connections, which accept the MySQL queries of the server
+# (%s placeholders, dictionary cursors) and raise the errors below, named like the ones of mysql.connector
+# (a query naming a column the table does not have raises a ProgrammingError with the errno MySQL gives it),
+# so that MySQLStorage uses this module as its driver instead of mysql.connector (see storage/mysql_storage.py)
+# the database file is created by create_database before the server starts (and before the workers of the cluster mode are forked,
+# so that they all share it), it starts with the admin user and the test room of dump.sql
+SCHEMA = """
+create table if not exists users (
+    user_ID integer primary key autoincrement,
+    username varchar(60) not null unique,
+    password varchar(60) not null
+);
+create table if not exists rooms (
+    room_ID integer primary key autoincrement,
+    room_name varchar(60) not null,
+    room_description varchar(240),
+    room_password varchar(60),
+    room_timeout int,
+    retention_age int,
+    retention_messages int,
+    retention_bytes bigint,
+    created_at timestamp default current_timestamp
+);
+insert or ignore into users (user_ID, username, password) values (1, 'admin', 'admin123');
+insert or ignore into rooms (room_ID, room_name, room_description, room_password) values (1, 'test', 'Welcome to our Chatroom!', 'test5');
+"""
+BUSY_TIMEOUT = 30.0   # the seconds a query waits for another connection (or process) that is writing
+UNKNOWN_COLUMN = 1054   # the MySQL error of a query naming a column the table does not have (ER_BAD_FIELD_ERROR)
+UNKNOWN_COLUMN_MESSAGES = ("no such column", "has no column named")   # the SQLite errors of such a query
+
+database_path = None
+
+class Error(Exception) :
+    def __init__(self, message = None, errno = None) :
+        super().__init__(message)
+        self.errno = errno
+
+class IntegrityError(Error) :
+    pass
+
+class ProgrammingError(Error) :
+    pass
+
+# creates the stand-in database in the file at path (a new temporary file by default) and returns its path
+# the usernames are unique, which register_user relies on to refuse a username that is already in use
+def create_database(path = None) :
+    global database_path
+    if path is None :
+        path = tempfile.NamedTemporaryFile(prefix = "chatroom_standin_", suffix = ".db", delete = False).name
+    connection = sqlite3.connect(path)
+    connection.execute("PRAGMA journal_mode = WAL")
+    connection.executescript(SCHEMA)
+    connection.commit()
+    connection.close()
+    database_path = path
+    return path
+
+# a cursor of a standin connection, the rows of a query are fetched as soon as it is executed
+class StandinCursor :
+    def __init__(self, connection, dictionary = False) :
+        self.cursor = connection.cursor()
+        self.dictionary = dictionary
+        self.rows = []
+        self.rowcount = -1
+        self.lastrowid = None
+
+    def execute(self, query, params = ()) :
+        try :
+            self.cursor.execute(query.replace("%s", "?"), params)
+        except sqlite3.IntegrityError as exception :
+            raise IntegrityError(str(exception))
+        except sqlite3.OperationalError as exception :
+            if any(message in str(exception) for message in UNKNOWN_COLUMN_MESSAGES) :
+                raise ProgrammingError(str(exception), UNKNOWN_COLUMN)
+            raise Error(str(exception))
+        except sqlite3.Error as exception :
+            raise Error(str(exception))
+        self.rowcount = self.cursor.rowcount
+        self.lastrowid = self.cursor.lastrowid
+        if self.cursor.description is None :
+            self.rows = []
+        elif self.dictionary :
+            columns = [column[0] for column in self.cursor.description]
+            self.rows = [dict(zip(columns, row)) for row in self.cursor.fetchall()]
+        else :
+            self.rows = self.cursor.fetchall()
+
+    def fetchone(self) :
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchall(self) :
+        rows, self.rows = self.rows, []
+        return rows
+
+    def close(self) :
+        self.cursor.close()
+
+# a connection to the stand-in database, used through the connection pool like a mysql.connector connection
+class StandinConnection :
+    def __init__(self, path) :
+        self.connection = sqlite3.connect(path, timeout = BUSY_TIMEOUT, check_same_thread = False)
+
+    def cursor(self, dictionary = False) :
+        return StandinCursor(self.connection, dictionary)
+
+    def commit(self) :
+        self.connection.commit()
+
+    def rollback(self) :
+        self.connection.rollback()
+
+    def ping(self, reconnect = False) :
+        self.connection.execute("SELECT 1")
+
+    def close(self) :
+        self.connection.close()
+
+# opens a connection to the database made by create_database, the connect function of the pool
+def connect() :
+    if database_path is None :
+        raise Error("the stand-in database was not created")
+    return StandinConnection(database_path)
@@ -16,6 +16,10 @@ room_ID int auto_increment primary key,
 room_name varchar(60) not null,
 room_description varchar(240),
 room_password varchar(60),
+room_timeout int,
+retention_age int,
+retention_messages int,
+retention_bytes bigint,
 created_at timestamp default current_timestamp
 );
 
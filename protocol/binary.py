@@ -0,0 +1,132 @@
+import json
+import math
+import struct
+from protocol.framing import FrameError
+
+# the compact binary encoding of the chat protocol, an alternative to JSON payloads that a client asks for in the "hello" action
+# a binary payload is a one byte opcode followed by the fields of the opcode, in a fixed order and without names :
+#   short strings (usernames, passwords, room IDs...) : a 2 byte big-endian length and the UTF-8 bytes
+#   long strings (chat messages) : a 4 byte big-endian length and the UTF-8 bytes
+#   sequence numbers and other integers : 8 bytes big-endian, NO_VALUE when the (optional) field is missing
+#   durations in seconds (the room timeout) : an 8 byte big-endian double, NaN when the (optional) field is missing,
+#   a whole number decodes to an int, the way JSON would give it
+# the fields the server already knows from the session are left out, a binary "send_message" carries the message alone
+# the opcodes are all below 0x20, so a payload tells its encoding by its first byte : "{" for JSON, an opcode for binary,
+# anything else is a plain text frame (the chatting history and the notices), which both encodings share
+# the server accepts either encoding on any connection, but only sends the message events in binary to the clients that negotiated it
+# the other responses stay JSON : they are rare next to the messages, and keep their free-form fields
+ENCODINGS = ("json", "binary")
+NO_VALUE = 0xFFFFFFFFFFFFFFFF
+
+SHORT_LENGTH = struct.Struct(">H")
+LONG_LENGTH = struct.Struct(">I")
+NUMBER = struct.Struct(">Q")
+REAL = struct.Struct(">d")
+
+# the field kinds : "s" short string, "S" long string, "n" integer, "o" optional integer, "f" optional number
+ACTIONS = {
+    0x01 : ("register", (("username", "s"), ("password", "s"))),
+    0x02 : ("login", (("username", "s"), ("password", "s"))),
+    0x03 : ("resume", (("token", "s"), ("last_seq", "o"))),
+    0x04 : ("join_room", (("room_ID", "s"), ("room_password", "s"), ("last_seq", "o"))),
+    0x05 : ("create_room", (("room_name", "s"), ("room_description", "s"), ("room_password", "s"), ("room_timeout", "f"),
+                            ("retention_age", "o"), ("retention_messages", "o"), ("retention_bytes", "o"))),
+    0x06 : ("delete_room", (("room_ID", "s"),)),
+    0x07 : ("list", ()),
+    0x08 : ("history", (("before", "o"), ("limit", "o"))),
+    0x09 : ("send_message", (("message", "S"),)),
+    0x0A : ("stats", ()),
+    0x0B : ("disconnect", ()),
+    0x0C : ("search", (("query", "s"), ("username", "s"), ("before", "o"), ("limit", "o"))),
+    0x0D : ("who", (("room_ID", "s"),)),
+}
+OPCODES = {name : (opcode, fields) for opcode, (name, fields) in ACTIONS.items()}
+
+MESSAGE_EVENT = 0x10
+MESSAGE_EVENT_FIELDS = (("room_ID", "s"), ("seq", "n"), ("message", "S"))
+
+# raised for a binary payload that does not follow its opcode, the connection is closed like for any invalid frame
+class BinaryError(FrameError) :
+    pass
+
+def is_binary(payload) :
+    return len(payload) > 0 and payload[0] < 0x20
+
+def encode_fields(opcode, fields, values) :
+    parts = [bytes((opcode,))]
+    try :
+        for name, kind in fields :
+            value = values.get(name)
+            if kind == "n" or kind == "o" :
+                parts.append(NUMBER.pack(NO_VALUE if value is None else value))
+            elif kind == "f" :
+                parts.append(REAL.pack(math.nan if value is None else value))
+            else :
+                data = str(value if value is not None else "").encode('utf-8')
+                parts.append((SHORT_LENGTH if kind == "s" else LONG_LENGTH).pack(len(data)))
+                parts.append(data)
+    except struct.error as exception :
+        raise ValueError(f"can not encode the {name} field : {exception}")
+    return b"".join(parts)
+
+def decode_fields(payload, fields) :
+    values = {}
+    offset = 1
+    try :
+        for name, kind in fields :
+            if kind == "n" or kind == "o" :
+                (value,) = NUMBER.unpack_from(payload, offset)
+                offset += NUMBER.size
+                if value == NO_VALUE :
+                    value = None
+            elif kind == "f" :
+                (value,) = REAL.unpack_from(payload, offset)
+                offset += REAL.size
+                if math.isnan(value) :
+                    value = None
+                elif value.is_integer() :
+                    value = int(value)
+            else :
+                length_header = SHORT_LENGTH if kind == "s" else LONG_LENGTH
+                (length,) = length_header.unpack_from(payload, offset)
+                offset += length_header.size
+                if offset + length > len(payload) :
+                    raise BinaryError(f"the {name} field runs past the end of the payload")
+                value = bytes(payload[offset : offset + length]).decode('utf-8')
+                offset += length
+            values[name] = value
+    except (struct.error, UnicodeDecodeError) as exception :
+        raise BinaryError(f"malformed binary payload : {exception}")
+    if offset != len(payload) :
+        raise BinaryError(f"{len(payload) - offset} unexpected bytes after the fields")
+    return values
+
+# returns the binary payload of the action dictionary (the same dictionary a JSON client would send)
+def encode_action(action) :
+    if action["action"] not in OPCODES :
+        raise ValueError(f"the {action['action']} action has no binary encoding")
+    opcode, fields = OPCODES[action["action"]]
+    return encode_fields(opcode, fields, action)
+
+# returns the action dictionary of a payload in either encoding, as handle_action expects it
+def decode_action(payload) :
+    if not is_binary(payload) :
+        return json.loads(payload)
+    if payload[0] not in ACTIONS :
+        raise BinaryError(f"unknown opcode {payload[0]}")
+    name, fields = ACTIONS[payload[0]]
+    values = decode_fields(payload, fields)
+    values["action"] = name
+    return values
+
+# returns the binary payload of the {"event" : "message", ...} event
+def encode_message_event(room_ID, seq, message) :
+    return encode_fields(MESSAGE_EVENT, MESSAGE_EVENT_FIELDS, {"room_ID" : room_ID, "seq" : seq, "message" : message})
+
+# returns the event dictionary of a binary event payload, the same dictionary a JSON event decodes to
+def decode_event(payload) :
+    if payload[0] != MESSAGE_EVENT :
+        raise BinaryError(f"unknown event opcode {payload[0]}")
+    values = decode_fields(payload, MESSAGE_EVENT_FIELDS)
+    values["event"] = "message"
+    return values
@@ -0,0 +1,65 @@
+import zlib
+from protocol.framing import FrameError
+
+# the compression of the frame payloads, which a client asks for in the "hello" action (see handle_hello)
+# a compressed payload is the COMPRESSED marker byte followed by the raw deflate stream of the original payload
+# (a JSON, binary or plain text payload, which the receiver then reads as usual), the marker is below 0x20 like the binary opcodes
+# every payload is compressed on its own, with DICTIONARY as the preset dictionary of both sides : a frame can then be compressed once
+# and sent as it is to any number of clients (see server/history_blocks.py), and the dictionary makes up for the short history
+# of small frames, which would otherwise compress poorly on their own
+# the payloads below COMPRESSION_THRESHOLD bytes are sent uncompressed, deflate saves next to nothing on them
+COMPRESSIONS = ("zlib",)
+COMPRESSED = 0x1F
+COMPRESSION_THRESHOLD = 256
+COMPRESSION_LEVEL = 6
+# a raw deflate stream, without the zlib header and checksum (the frames and TCP already delimit and check it)
+# the payloads are small, so a 4 KiB window and a small memory level compress them as well as the defaults, for half the setup time
+# (the decompressor accepts any window, a peer compressing with a larger one is still understood)
+WBITS = -12
+DECOMPRESS_WBITS = -15
+MEM_LEVEL = 5
+
+# the strings the payloads of the chat protocol are made of, the likeliest last (deflate reaches the end of the dictionary cheapest)
+DICTIONARY = (
+    b"the and you that have for not with this but are was what can just like all about there will know would get"
+    b" when out your think one time good yes see from going they how some people really because well right now\n"
+    b"Chatting History : \nMissed Messages : \nNo Chatting History\n"
+    b'{"code": 400, "message": "{"code": 200, "message": "Joined room  successfully!", "last_seq": , "sync": "full", "cursor": '
+    b'{"code": 200, "room_ID": "", "messages": [{"seq": , "time": , "message": "'
+    b'{"rooms": [{"room_ID": , "room_name": "'
+    b'{"event": "message", "room_ID": "", "seq": , "message": "'
+    b" >> \n >> "
+)
+
+# raised for a compressed payload that does not decompress, or decompresses to more than the negotiated frame size
+class CompressionError(FrameError) :
+    pass
+
+def is_compressed(payload) :
+    return len(payload) > 0 and payload[0] == COMPRESSED
+
+# returns the compressed payload
+def compress_payload(payload) :
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, WBITS, MEM_LEVEL, zdict = DICTIONARY)
+    return bytes((COMPRESSED,)) + compressor.compress(payload) + compressor.flush()
+
+# returns the payload compressed if it is at least threshold bytes long and compressing saves anything, the payload itself otherwise
+def maybe_compress(payload, threshold = COMPRESSION_THRESHOLD) :
+    if len(payload) < threshold :
+        return payload
+    compressed = compress_payload(payload)
+    return compressed if len(compressed) < len(payload) else payload
+
+# returns the original payload of a compressed payload, an uncompressed payload is returned as it is
+# the decompressed payload is held to max_size bytes like any frame, a small compressed frame can not expand without limit
+def decompress_payload(payload, max_size) :
+    if not is_compressed(payload) :
+        return payload
+    decompressor = zlib.decompressobj(DECOMPRESS_WBITS, zdict = DICTIONARY)
+    try :
+        data = decompressor.decompress(memoryview(payload)[1:], max_size)
+    except zlib.error as exception :
+        raise CompressionError(f"malformed compressed payload : {exception}")
+    if not decompressor.eof or decompressor.unconsumed_tail :
+        raise CompressionError(f"compressed payload is truncated or exceeds the maximum of {max_size} bytes")
+    return data
@@ -0,0 +1,64 @@
+import struct
+
+# every message on the wire is a frame : a 4 byte big-endian payload length followed by the payload itself
+# this keeps the boundaries of the actions even if several of them arrive in one TCP segment, or one of them spans many segments
+HEADER = struct.Struct(">I")
+HEADER_SIZE = HEADER.size
+
+DEFAULT_MAX_FRAME_SIZE = 64 * 1024      # the largest payload accepted before the peers have negotiated anything
+MAX_FRAME_SIZE = 1024 * 1024            # the largest payload the server ever agrees to in the "hello" negotiation
+RECV_BUFFER_SIZE = 64 * 1024            # the size of the buffer a connection reads the socket into
+
+# raised when the peer sends a frame that is larger than the negotiated maximum
+# the connection can not be resynchronized after that, so it should be closed
+class FrameError(ValueError) :
+    pass
+
+# returns the payload (bytes or str, which is encoded as UTF-8) prefixed with its length header
+def encode_frame(payload) :
+    if isinstance(payload, str) :
+        payload = payload.encode('utf-8')
+    return HEADER.pack(len(payload)) + payload
+
+# returns the frame size both peers agree on : the smaller of the requested size and what this side allows
+# a missing or invalid request keeps the default size
+def negotiate_frame_size(requested, limit = MAX_FRAME_SIZE) :
+    if not isinstance(requested, int) or requested <= 0 :
+        return DEFAULT_MAX_FRAME_SIZE
+    return min(requested, limit)
+
+# incremental decoder of the frames coming from a stream socket
+# feed() accepts whatever the socket returned (bytes, bytearray or memoryview) and returns the complete payloads in order
+# a partial frame stays in the buffer until the rest of it arrives
+# the buffer is reused between calls : consumed bytes are only compacted away once they make up half of it
+class FrameDecoder :
+    __slots__ = ('buffer', 'offset', 'max_frame_size')
+
+    def __init__(self, max_frame_size = DEFAULT_MAX_FRAME_SIZE) :
+        self.buffer = bytearray()                # the received bytes that have not been decoded yet (from offset on)
+        self.offset = 0                          # the position of the first byte not consumed yet
+        self.max_frame_size = max_frame_size     # the largest payload accepted, frames above it raise a FrameError
+
+    def feed(self, data) :
+        self.buffer += data
+        payloads = []
+        buffer = self.buffer
+        end = len(buffer)
+
+        while end - self.offset >= HEADER_SIZE :
+            (length,) = HEADER.unpack_from(buffer, self.offset)
+            if length > self.max_frame_size :
+                raise FrameError(f"frame of {length} bytes exceeds the maximum of {self.max_frame_size} bytes")
+            start = self.offset + HEADER_SIZE
+            if end - start < length :
+                break
+            payloads.append(bytes(buffer[start : start + length]))
+            self.offset = start + length
+
+        if self.offset == end :
+            del buffer[:]
+            self.offset = 0
+        elif self.offset > len(buffer) // 2 :
+            del buffer[:self.offset]
+            self.offset = 0
+        return payloads
@@ -0,0 +1,132 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from protocol.framing import FrameError, RECV_BUFFER_SIZE
+from protocol.binary import decode_action
+from protocol.compression import decompress_payload
+from server.outbound import OutboundQueue
+
+EXECUTOR_WORKERS = 32  # the number of threads that run the blocking (database and file) work of the actions
+
+# wraps the asyncio stream writer of a client, so that it can be used wherever the server expects a client socket
+# sends go into an OutboundQueue (see server/outbound.py) that the write_loop task of this connection drains
+# sendall() and close() are thread safe, the handlers that run in the executor (join_room, broadcast_message...) use them too
+# a slow peer only stalls its own write_loop, its queue then follows the configured overflow policy
+class AsyncClientSocket :
+    def __init__(self, writer, loop) :
+        self.writer = writer                  # the asyncio stream writer of the connection
+        self.loop = loop                      # the event loop that owns the writer
+        self.ready = asyncio.Event()          # set (on the loop) when the queue has something to write or is closed
+        self.finished = threading.Event()     # set once write_loop has flushed the queue and closed the writer
+        self.queue = OutboundQueue(self.wake_writer, self.abort)
+        self.compression = None               # the compression agreed on in the "hello" action, None for uncompressed frames
+
+    def wake_writer(self) :
+        self.loop.call_soon_threadsafe(self.ready.set)
+
+    # queues the data, raises ConnectionResetError if the connection is closed (or was just closed for being too slow)
+    def sendall(self, data) :
+        if not self.queue.put(data) :
+            raise ConnectionResetError("the connection is closed")
+
+    # stops accepting data, write_loop flushes what is already queued and then closes the connection
+    def close(self) :
+        self.queue.close()
+
+    # closes the connection without writing what is still queued
+    def abort(self) :
+        self.queue.close(abort = True)
+        self.loop.call_soon_threadsafe(self.writer.transport.abort)
+
+    async def write_loop(self) :
+        try :
+            while not self.queue.finished() :
+                await self.ready.wait()
+                self.ready.clear()
+                batch = self.queue.take()
+                if batch :
+                    self.writer.writelines(batch)
+                    await self.writer.drain()
+        except (ConnectionError, OSError) :
+            self.queue.close(abort = True)
+        finally :
+            self.writer.close()
+            self.finished.set()
+
+    # waits until write_loop has flushed the queue and closed the connection, at most timeout seconds
+    def join(self, timeout = None) :
+        self.finished.wait(timeout)
+
+# serves a single client connection as a task on the event loop
+# feeds whatever arrives to the frame decoder of the session, then decodes every complete frame (from JSON or binary)
+# and passes it to handle_action together with the session state of this connection
+# the actions listed in blocking_actions are run in the executor, the rest of them run directly on the event loop
+# the actions of one connection are processed one at a time and in order, exactly like in the threaded mode
+# once the connection ends, remove_client takes the session out of its room
+async def handle_connection(reader, writer, handle_action, blocking_actions, new_session, remove_client, executor) :
+    loop = asyncio.get_running_loop()
+    client_socket = AsyncClientSocket(writer, loop)
+    write_task = loop.create_task(client_socket.write_loop())
+    session = new_session(client_socket)
+    print(f"\nConnection from {writer.get_extra_info('peername')}")
+
+    while True :
+        try :
+            received = await reader.read(RECV_BUFFER_SIZE)
+            if not received :
+                break
+
+            for payload in session.decoder.feed(received) :
+                data = decode_action(decompress_payload(payload, session.decoder.max_frame_size))
+                if data["action"] in blocking_actions :
+                    await loop.run_in_executor(executor, handle_action, client_socket, data, session)
+                else :
+                    handle_action(client_socket, data, session)
+
+        except (ConnectionAbortedError, ConnectionResetError) as exception :
+            print(f"Connection error with client {session.username if session.username else 'unknown'} : {exception}")
+            break
+        except FrameError as exception :
+            print(f"Invalid frame from client {session.username if session.username else 'unknown'} : {exception}")
+            break
+        except Exception as exception :
+            print(f"Error handling client {session.username if session.username else 'unknown'} : {exception}")
+            break
+
+    remove_client(session)
+    client_socket.close()
+    await write_task
+
+# starts an asyncio event loop in a background thread and listens on the given port
+# waits until the listening socket is ready, then returns a function that stops accepting new connections
+# the loop keeps running after that, so that the connections can still flush what is queued for them
+# with reuse_port, several processes can listen on the same port and the kernel spreads the connections between them
+def start_async_listener(port, backlog, handle_action, blocking_actions, new_session, remove_client, reuse_port = False) :
+    loop = asyncio.new_event_loop()
+    executor = ThreadPoolExecutor(max_workers = EXECUTOR_WORKERS, thread_name_prefix = "chat-executor")
+    ready = threading.Event()
+    listener = {}
+
+    def run() :
+        asyncio.set_event_loop(loop)
+        try :
+            listener['server'] = loop.run_until_complete(asyncio.start_server(
+                lambda reader, writer : handle_connection(reader, writer, handle_action, blocking_actions, new_session, remove_client, executor),
+                host = '0.0.0.0', port = port, reuse_address = True, reuse_port = reuse_port or None, backlog = backlog))
+            print(f"Started listening on 0.0.0.0 : {port}")
+        except OSError as exception :
+            print(f"Error listening on port {port} : {exception}")
+            return
+        finally :
+            ready.set()
+        loop.run_forever()
+
+    threading.Thread(target = run, daemon = True).start()
+    ready.wait()
+
+    def close_listener() :
+        if 'server' in listener :
+            loop.call_soon_threadsafe(listener['server'].close)
+        executor.shutdown(wait = False)
+
+    return close_listener
@@ -0,0 +1,332 @@
+import itertools
+import json
+import os
+import queue
+import socket
+import threading
+from protocol.framing import FrameDecoder, encode_frame, RECV_BUFFER_SIZE
+from server.search import match_expression, SEARCH_PAGE_SIZE
+
+# the local pub/sub layer of the cluster mode (see start_cluster in server/server.py)
+# the supervisor process runs the Broker, every worker process is connected to it with a BrokerClient over a Unix domain socket
+# the broker owns the history log, so there is a single writer and a single sequence number per room for all the workers :
+# a worker publishes every message of its clients, the broker numbers it, appends it to the history
+# and delivers it to the other workers that have members in the room (the ones that subscribed to the room)
+# the broker also relays the changes of the room catalog and of the presence of the users, and answers the history reads
+# and the searches of the workers
+# every message on the socket is a frame (see protocol/framing.py) holding a JSON object with an "op" field,
+# requests carry an "id" that the broker copies into its reply
+BROKER_FRAME_SIZE = 64 * 1024 * 1024     # the largest frame on the broker socket, history pages of many messages can be big
+CALL_TIMEOUT = 30.0                      # the seconds a worker waits for the reply of the broker
+
+def broker_path(port) :
+    return os.path.join("/tmp", f"chatroom-broker-{port}.sock")
+
+# adds the presence changes {room_ID : {username : change of sessions}}, times sign, to the presence rooms, dropping the users left with none
+def add_presence(rooms, changes, sign = 1) :
+    for room_ID, users in changes.items() :
+        room = rooms.setdefault(room_ID, {})
+        for username, delta in users.items() :
+            sessions = room.get(username, 0) + sign * delta
+            if sessions :
+                room[username] = sessions
+            else :
+                room.pop(username, None)
+        if not room :
+            del rooms[room_ID]
+
+# a framed JSON connection, shared by the threads of a process, sending is serialized by a lock
+class Link :
+    def __init__(self, sock) :
+        self.sock = sock
+        self.lock = threading.Lock()
+        self.decoder = FrameDecoder(BROKER_FRAME_SIZE)
+
+    def send(self, message) :
+        frame = encode_frame(json.dumps(message))
+        with self.lock :
+            self.sock.sendall(frame)
+
+    # yields the messages arriving on the connection until it is closed
+    def receive(self) :
+        while True :
+            try :
+                data = self.sock.recv(RECV_BUFFER_SIZE)
+            except OSError :
+                return
+            if not data :
+                return
+            for payload in self.decoder.feed(data) :
+                yield json.loads(payload)
+
+    def close(self) :
+        try :
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError :
+            pass
+        self.sock.close()
+
+# the broker of the supervisor process, history is the HistoryLog of the cluster and search_index its SearchIndex
+# listen() binds the socket before the workers are forked, so they can connect right away, start() begins serving them
+class Broker :
+    def __init__(self, path, history, search_index) :
+        self.path = path
+        self.history = history
+        self.search_index = search_index
+        self.on_catalog = None              # when set, on_catalog(change) also receives the room catalog changes of the workers
+        self.server_socket = None
+        self.links = []
+        self.subscriptions = {}             # room_ID -> the links of the workers with members in the room
+        self.presence = {}                  # link -> {room_ID : {username : sessions}}, the users each worker has in the rooms
+        self.presence_lock = threading.Lock()  # orders the presence changes, so every worker applies them in the same order
+        self.publish_lock = threading.Lock()  # orders the publications and the subscriptions, so every room is delivered in order
+        self.counters = {'published' : 0, 'delivered' : 0}
+
+    def listen(self) :
+        if os.path.exists(self.path) :
+            os.unlink(self.path)
+        self.server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server_socket.bind(self.path)
+        self.server_socket.listen(128)
+
+    def start(self) :
+        threading.Thread(target = self.accept_workers, daemon = True).start()
+
+    def accept_workers(self) :
+        while True :
+            try :
+                sock, _ = self.server_socket.accept()
+            except OSError :
+                return
+            link = Link(sock)
+            with self.presence_lock :
+                self.links.append(link)
+                self.presence[link] = {}
+                changes = {}
+                for rooms in self.presence.values() :
+                    add_presence(changes, rooms)
+                if changes :
+                    link.send({"op" : "presence", "changes" : changes})
+            threading.Thread(target = self.serve, args = (link,), daemon = True).start()
+
+    # handles the requests of one worker, in the order it sent them
+    def serve(self, link) :
+        for request in link.receive() :
+            try :
+                self.handle(link, request)
+            except Exception as exception :
+                print(f"Broker error handling {request.get('op')} : {exception}")
+                if "id" in request :
+                    link.send({"id" : request["id"], "error" : str(exception)})
+        with self.publish_lock :
+            for links in self.subscriptions.values() :
+                links.discard(link)
+        # the users of a worker that went away leave their rooms
+        with self.presence_lock :
+            self.links.remove(link)
+            gone = {}
+            add_presence(gone, self.presence.pop(link, {}), -1)
+            if gone :
+                self.relay_presence(link, gone)
+
+    def handle(self, link, request) :
+        op = request["op"]
+        if op == "publish" :
+            room_ID = request["room_ID"]
+            with self.publish_lock :
+                seq = self.history.append(room_ID, request["message"])
+                link.send({"id" : request["id"], "seq" : seq})
+                delivery = {"op" : "deliver", "room_ID" : room_ID, "seq" : seq,
+                            "message" : request["message"], "sender" : request["sender"]}
+                for subscriber in self.subscriptions.get(room_ID, ()) :
+                    if subscriber is not link :
+                        subscriber.send(delivery)
+                        self.counters['delivered'] += 1
+                self.counters['published'] += 1
+
+        elif op == "subscribe" :
+            with self.publish_lock :
+                self.subscriptions.setdefault(request["room_ID"], set()).add(link)
+
+        elif op == "unsubscribe" :
+            with self.publish_lock :
+                links = self.subscriptions.get(request["room_ID"])
+                if links is not None :
+                    links.discard(link)
+                    if not links :
+                        del self.subscriptions[request["room_ID"]]
+
+        elif op == "catalog" :
+            if self.on_catalog is not None :
+                self.on_catalog(request)
+            for other in list(self.links) :
+                if other is not link :
+                    other.send(request)
+
+        elif op == "presence" :
+            with self.presence_lock :
+                add_presence(self.presence.setdefault(link, {}), request["changes"])
+                self.relay_presence(link, request["changes"])
+
+        elif op == "records" :
+            records = self.history.records(request["room_ID"], request["after_seq"], request["before_seq"], request["limit"])
+            link.send({"id" : request["id"], "records" : records})
+
+        elif op == "seqs" :
+            with self.publish_lock :
+                link.send({"id" : request["id"], "first_seq" : self.history.first_seq(request["room_ID"]),
+                           "last_seq" : self.history.last_seq(request["room_ID"])})
+
+        elif op == "search" :
+            results, cursor = self.search_index.search(request["room_ID"], request["query"], request["username"],
+                                                       request["before"], request["limit"])
+            link.send({"id" : request["id"], "results" : results, "cursor" : cursor})
+
+        elif op == "metrics" :
+            link.send({"id" : request["id"], "metrics" : self.history.metrics(), "search" : self.search_index.metrics()})
+
+    # sends the presence changes to the workers other than link, must be called with presence_lock held
+    def relay_presence(self, link, changes) :
+        for other in list(self.links) :
+            if other is not link :
+                try :
+                    other.send({"op" : "presence", "changes" : changes})
+                except OSError :
+                    pass
+
+    def metrics(self) :
+        with self.publish_lock :
+            return {**self.counters, 'workers' : len(self.links), 'subscribed_rooms' : len(self.subscriptions)}
+
+    def close(self) :
+        self.server_socket.close()
+        for link in list(self.links) :
+            link.close()
+        if os.path.exists(self.path) :
+            os.unlink(self.path)
+
+# the connection of a worker process to the broker
+# the requests are queued and written by a thread of their own, in order, so that a worker never blocks on the broker socket
+# while it holds clients_lock (the broker may itself be waiting for this worker to read its deliveries)
+# on_deliver(sender, room_ID, seq, message) is called for the messages published in the subscribed rooms, by this worker too :
+# the reader thread calls it for the messages of this worker as it reads the reply of their publish request, the broker sends
+# the replies and the deliveries of a room in the order of their sequence numbers, so every room is delivered in order
+# on_catalog(change) for the room catalog changes of the other workers, and on_close() once the broker is gone
+# on_presence(changes), when set, receives the presence changes of the other workers (see Presence.apply_remote in server/presence.py)
+class BrokerClient :
+    def __init__(self, path, on_deliver, on_catalog, on_close, on_presence = None) :
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        self.link = Link(sock)
+        self.on_deliver = on_deliver
+        self.on_catalog = on_catalog
+        self.on_close = on_close
+        self.on_presence = on_presence
+        self.ids = itertools.count(1)
+        self.replies = {}                  # request id -> [threading.Event, the reply once it arrived, on_reply or None]
+        self.replies_lock = threading.Lock()
+        self.outgoing = queue.SimpleQueue()   # the requests waiting to be written, None stops the writer
+        threading.Thread(target = self.read_loop, daemon = True).start()
+        threading.Thread(target = self.write_loop, daemon = True).start()
+
+    def write_loop(self) :
+        while True :
+            request = self.outgoing.get()
+            if request is None :
+                return
+            try :
+                self.link.send(request)
+            except OSError :
+                return
+
+    def read_loop(self) :
+        for message in self.link.receive() :
+            if "id" in message :
+                with self.replies_lock :
+                    waiter = self.replies.pop(message["id"], None)
+                if waiter is not None :
+                    waiter[1] = message
+                    if waiter[2] is not None and "error" not in message :
+                        waiter[2](message)
+                    waiter[0].set()
+            elif message["op"] == "deliver" :
+                self.on_deliver(message["sender"], message["room_ID"], message["seq"], message["message"])
+            elif message["op"] == "catalog" :
+                self.on_catalog(message)
+            elif message["op"] == "presence" and self.on_presence is not None :
+                self.on_presence(message["changes"])
+        self.on_close()
+
+    # sends the request and returns the reply of the broker, raises ConnectionError if none arrives within CALL_TIMEOUT
+    # on_reply(reply), when given, is called by the reader thread with the reply, before any message the broker sent after it
+    def call(self, op, on_reply = None, **fields) :
+        request_id = next(self.ids)
+        waiter = [threading.Event(), None, on_reply]
+        with self.replies_lock :
+            self.replies[request_id] = waiter
+        self.outgoing.put({"op" : op, "id" : request_id, **fields})
+        if not waiter[0].wait(CALL_TIMEOUT) :
+            with self.replies_lock :
+                self.replies.pop(request_id, None)
+            raise ConnectionError(f"the broker did not answer the {op} request")
+        if "error" in waiter[1] :
+            raise ConnectionError(f"the broker failed the {op} request : {waiter[1]['error']}")
+        return waiter[1]
+
+    # sends a request that has no reply
+    def send(self, op, **fields) :
+        self.outgoing.put({"op" : op, **fields})
+
+    # hands the message to the broker and returns the sequence number it got, the message is delivered through on_deliver
+    def publish(self, room_ID, message, sender) :
+        deliver = lambda reply : self.on_deliver(sender, room_ID, reply["seq"], message)
+        return self.call("publish", on_reply = deliver, room_ID = room_ID, message = message, sender = sender)["seq"]
+
+    def subscribe(self, room_ID) :
+        self.send("subscribe", room_ID = room_ID)
+
+    def unsubscribe(self, room_ID) :
+        self.send("unsubscribe", room_ID = room_ID)
+
+    def close(self) :
+        self.outgoing.put(None)
+        self.link.close()
+
+# the history log as seen by a worker : the reads of HistoryLog, answered by the broker that owns the log
+# the messages are published through BrokerClient.publish rather than appended
+class RemoteHistory :
+    def __init__(self, client) :
+        self.client = client
+
+    def records(self, room_ID, after_seq = 0, before_seq = None, limit = None) :
+        reply = self.client.call("records", room_ID = room_ID, after_seq = after_seq, before_seq = before_seq, limit = limit)
+        return [tuple(record) for record in reply["records"]]
+
+    def first_seq(self, room_ID) :
+        return self.client.call("seqs", room_ID = room_ID)["first_seq"]
+
+    def last_seq(self, room_ID) :
+        return self.client.call("seqs", room_ID = room_ID)["last_seq"]
+
+    def metrics(self) :
+        return self.client.call("metrics")["metrics"]
+
+    def close(self) :
+        pass
+
+# the search index as seen by a worker : the searches are answered by the broker, next to the history log it indexes
+# the query is checked here first, so a search with nothing to look for raises SearchError without a round trip
+class RemoteSearch :
+    def __init__(self, client) :
+        self.client = client
+
+    def search(self, room_ID, query = "", username = None, before = None, limit = SEARCH_PAGE_SIZE) :
+        match_expression(query, username)
+        reply = self.client.call("search", room_ID = room_ID, query = query, username = username, before = before, limit = limit)
+        return [tuple(result) for result in reply["results"]], reply["cursor"]
+
+    def metrics(self) :
+        return self.client.call("metrics")["search"]
+
+    def close(self, timeout = None) :
+        pass
@@ -0,0 +1,246 @@
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from server.history import HistoryLog, write_archive
+
+COMPACT_INTERVAL = 60.0              # the seconds between two passes of the compactor over the rooms
+ROTATE_AGE = 24 * 3600               # the seconds after which the segment a room writes to is sealed and archived, even if it is not full
+COMPACT_RATE = 32 * 1024 * 1024      # the bytes per second the compactor reads and writes at most
+COMPACT_NICE = 10                    # the niceness of the compactor thread, where the platform gives threads a priority of their own
+TRIM_SLACK = 0.1                     # a segment is rewritten without its expired messages once they are this fraction of the kept ones
+MAX_TRIM_SLACK = 1000                # ... or this many of them, whichever is smaller (the expired whole segments are always dropped)
+READ_ALL = 1 << 63
+
+# enforces the retention policies of the rooms on the history log (see server/history.py) in the background
+# a policy is a (max_age, max_messages, max_bytes) tuple : the seconds a message is kept, the newest messages kept,
+# and the disk bytes the segments of the room take (whole segments are dropped, the one being written is never) -- None for no limit
+# every interval seconds the compactor goes over the rooms :
+# - the segments the policy no longer keeps any message of are removed
+# - a segment with expired messages is rewritten into an archive of the others, once enough of them expired (see TRIM_SLACK)
+# - the other sealed .log segments are rewritten into archives as they are
+# - the segment a room writes to is sealed first when it holds expired messages, or once its first message is ROTATE_AGE old
+# - the rooms that were deleted lose their segments, their directory and their history file of the old format
+# the compactor only touches sealed segments, which the writer never appends to, and swaps them under the lock of the log
+# (see HistoryLog.replace_segments), so the appends and the reads of the history never wait on it
+# it runs at a lower priority and reads and writes at most rate bytes per second, the live traffic gets the disk first
+# retention_for(room_ID) returns the policy of the room, its None fields falling back to the retention of the compactor
+# is_deleted(room_ID) returns True for a room that no longer exists, it is only asked about the rooms it has history for
+# a history kept in a table (the SQLiteHistory of storage/sqlite_storage.py) has no segments : its expired messages are deleted
+# by the writer of the history instead (see trim_room)
+class HistoryCompactor :
+    def __init__(self, history, retention = (None, None, None), retention_for = None, is_deleted = None,
+                 interval = COMPACT_INTERVAL, rotate_age = ROTATE_AGE, rate = COMPACT_RATE) :
+        self.history = history
+        self.retention = retention         # the policy of the rooms that have none of their own
+        self.retention_for = retention_for
+        self.is_deleted = is_deleted
+        self.interval = interval
+        self.rotate_age = rotate_age
+        self.rate = rate
+        self.on_trim = None                # when set, on_trim(room_ID, first_seq) is called once the messages of the room below first_seq are gone
+                                           # (all of them, for a deleted room, with first_seq None)
+        self.legacy_path = None            # when set, legacy_path(room_ID) returns the history file of the old format of the room
+        self.stopped = threading.Event()
+        self.thread = None
+        self.lock = threading.Lock()       # guards the counters
+        self.counters = {'passes' : 0, 'archived' : 0, 'rewritten' : 0, 'removed_segments' : 0, 'dropped_messages' : 0,
+                         'dropped_rooms' : 0, 'freed_bytes' : 0, 'errors' : 0}
+
+    def start(self) :
+        self.thread = threading.Thread(target = self.run, daemon = True)
+        self.thread.start()
+
+    def run(self) :
+        lower_priority()
+        while not self.stopped.wait(self.interval) :
+            self.compact()
+
+    # returns the policy of the room
+    def room_retention(self, room_ID) :
+        own = self.retention_for(room_ID) if self.retention_for is not None else None
+        return tuple(default if limit is None else limit for limit, default in zip(own or (None, None, None), self.retention))
+
+    # makes one pass over the rooms of the history log
+    def compact(self) :
+        for room_ID in self.history.rooms() :
+            if self.stopped.is_set() :
+                return
+            try :
+                if self.is_deleted is not None and self.is_deleted(room_ID) :
+                    self.drop_room(room_ID)
+                elif isinstance(self.history, HistoryLog) :
+                    self.compact_room(room_ID)
+                else :
+                    self.trim_room(room_ID)
+            except (OSError, ValueError, sqlite3.Error) as exception :
+                print(f"Error compacting the chatting history of room {room_ID} : {exception}")
+                self.count('errors')
+        self.count('passes')
+
+    def compact_room(self, room_ID) :
+        segments = self.history.room_segments_of(room_ID)
+        if not segments :
+            return
+        now = time.time()
+        last_seq = self.history.last_seq(room_ID)
+        first_seq = segments[0].first_seq
+        keep_from = self.keep_from(segments, self.room_retention(room_ID), last_seq, now)
+
+        active = segments[-1]
+        if not active.sealed :
+            first = active.read(active.first_seq, active.first_seq + 1)
+            if keep_from > active.first_seq or (first and first[0][1] <= now - self.rotate_age) :
+                if not self.history.seal(room_ID) :
+                    return
+                segments = self.history.room_segments_of(room_ID)
+
+        for position, segment in enumerate(segments) :
+            if not segment.sealed or self.stopped.is_set() :
+                break
+            following = segments[position + 1] if position + 1 < len(segments) else None
+            if following is not None and following.first_seq <= keep_from :
+                if not self.replace(room_ID, segment, None) :
+                    break
+                self.count('removed_segments')
+                continue
+            if segment.archived and segment.first_seq >= keep_from :
+                continue
+            records = segment.read(segment.first_seq, READ_ALL)
+            kept = [record for record in records if record[0] >= keep_from]
+            last = records[-1][0] if records else getattr(segment, 'last_seq', segment.first_seq - 1)
+            size = segment.size()
+            archive = write_archive(self.history.room_directory(room_ID), kept, segment, last)
+            if not self.replace(room_ID, segment, archive) :
+                break
+            self.count('rewritten' if len(kept) < len(records) or segment.archived else 'archived')
+            self.throttle(size + archive.size())
+
+        trimmed_to = self.history.first_seq(room_ID)
+        if trimmed_to > first_seq :
+            self.count('dropped_messages', trimmed_to - first_seq)
+            if self.on_trim is not None :
+                self.on_trim(room_ID, trimmed_to)
+
+    # applies the policy of the room to a history kept in a table, whose messages are deleted in place
+    # the same slack as for the segments keeps the deletes in batches, rather than a few messages on every pass
+    def trim_room(self, room_ID) :
+        max_age, max_messages, max_bytes = self.room_retention(room_ID)
+        first_seq = self.history.first_seq(room_ID)
+        last_seq = self.history.last_seq(room_ID)
+        keep_from = first_seq
+        if max_messages is not None :
+            keep_from = max(keep_from, last_seq + 1 - max_messages)
+        if max_bytes is not None :
+            keep_from = max(keep_from, self.history.first_within(room_ID, max_bytes))
+        if max_age is not None :
+            keep_from = max(keep_from, self.history.first_newer(room_ID, time.time() - max_age))
+        keep_from = min(keep_from, last_seq + 1)
+        if keep_from - first_seq < max(1, min(MAX_TRIM_SLACK, int((last_seq + 1 - keep_from) * TRIM_SLACK))) :
+            return
+        self.history.trim(room_ID, keep_from)
+        trimmed_to = self.history.first_seq(room_ID)
+        if trimmed_to > first_seq :
+            self.count('dropped_messages', trimmed_to - first_seq)
+            if self.on_trim is not None :
+                self.on_trim(room_ID, trimmed_to)
+
+    # returns the sequence number of the oldest message of the room the policy keeps
+    # rewriting a segment for a few expired messages is not worth it : below the slack, only the whole expired segments are dropped
+    def keep_from(self, segments, retention, last_seq, now) :
+        max_age, max_messages, max_bytes = retention
+        keep_from = segments[0].first_seq
+        if max_messages is not None :
+            keep_from = max(keep_from, last_seq + 1 - max_messages)
+        if max_bytes is not None :
+            sizes = [segment.size() for segment in segments]
+            total = sum(sizes)
+            for size, following in zip(sizes, segments[1:]) :
+                if total <= max_bytes :
+                    break
+                total -= size
+                keep_from = max(keep_from, following.first_seq)
+        if max_age is not None :
+            keep_from = max(keep_from, self.first_newer(segments, now - max_age))
+        keep_from = min(keep_from, last_seq + 1)
+
+        boundary = max(segment.first_seq for segment in segments if segment.first_seq <= keep_from)
+        if keep_from - boundary < max(1, min(MAX_TRIM_SLACK, int((last_seq + 1 - keep_from) * TRIM_SLACK))) :
+            keep_from = boundary
+        return keep_from
+
+    # returns the sequence number of the first message of the segments sent at cutoff or later (the next one if there is none)
+    # the first message of the following segment tells whether a whole segment is older, only the segment where cutoff falls is read
+    def first_newer(self, segments, cutoff) :
+        keep_from = segments[0].first_seq
+        for position, segment in enumerate(segments) :
+            following = segments[position + 1] if position + 1 < len(segments) else None
+            if following is not None :
+                first = following.read(following.first_seq, following.first_seq + 1)
+                if first and first[0][1] < cutoff :
+                    keep_from = following.first_seq
+                    continue
+            for seq, timestamp, _ in segment.read(keep_from, READ_ALL) :
+                if timestamp >= cutoff :
+                    return seq
+                keep_from = seq + 1
+            if following is not None :
+                return following.first_seq
+        return keep_from
+
+    # swaps the segment of the room for the archive (or drops it, without an archive) and removes its file
+    # the readers that are reading the segment read the history again (see HistoryLog.records)
+    # returns False if the room lost the segment meanwhile (it was deleted), the archive is removed then
+    def replace(self, room_ID, segment, archive) :
+        if not self.history.replace_segments(room_ID, [segment], [archive] if archive is not None else []) :
+            if archive is not None :
+                os.remove(archive.path)
+            return False
+        freed = segment.size()
+        if archive is None or archive.path != segment.path :
+            os.remove(segment.path)
+        self.count('freed_bytes', freed - (archive.size() if archive is not None else 0))
+        return True
+
+    # removes the history of a deleted room
+    def drop_room(self, room_ID) :
+        segments = self.history.drop_room(room_ID)
+        freed = sum(segment.size() for segment in segments)
+        if isinstance(self.history, HistoryLog) :
+            shutil.rmtree(self.history.room_directory(room_ID), ignore_errors = True)
+        if self.legacy_path is not None :
+            legacy = self.legacy_path(room_ID)
+            if os.path.exists(legacy) :
+                freed += os.path.getsize(legacy)
+                os.remove(legacy)
+        if self.on_trim is not None :
+            self.on_trim(room_ID, None)
+        self.count('dropped_rooms')
+        self.count('freed_bytes', freed)
+        print(f"Removed the chatting history of the deleted room {room_ID}")
+
+    # sleeps as long as moving that many bytes takes at the rate of the compactor
+    def throttle(self, size) :
+        if self.rate :
+            self.stopped.wait(size / self.rate)
+
+    def count(self, name, amount = 1) :
+        with self.lock :
+            self.counters[name] += amount
+
+    def close(self, timeout = None) :
+        self.stopped.set()
+        if self.thread is not None :
+            self.thread.join(timeout)
+
+    def metrics(self) :
+        with self.lock :
+            return dict(self.counters)
+
+# lowers the priority of the calling thread, a thread has a niceness of its own on Linux
+def lower_priority(niceness = COMPACT_NICE) :
+    try :
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), niceness)
+    except (AttributeError, OSError) :
+        pass
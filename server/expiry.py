@@ -0,0 +1,63 @@
+import heapq
+
+# decides when the rooms expire : a room expires once nothing happened in it for its timeout
+# keeps one entry per room in a min-heap ordered by deadline, so finding the rooms that are due only looks at the top of the heap
+# touching a room only records the time (a dictionary write), the heap entry is not moved :
+# when an entry comes due, the deadline is recomputed from the last activity and the room is either expired or pushed back
+# so a busy room costs one heap operation per timeout, not one per message
+# timeout_for(room_ID) returns the timeout of the room in seconds, or None for the default timeout
+# not thread safe on its own, the server only uses it while holding clients_lock
+class ExpiryScheduler :
+    def __init__(self, timeout, timeout_for = None) :
+        self.timeout = timeout             # the timeout of the rooms that have none of their own
+        self.timeout_for = timeout_for
+        self.activity = {}                 # room_ID -> the time of the last activity in the room
+        self.deadlines = {}                # room_ID -> the deadline of the heap entry of the room
+        self.heap = []                     # (deadline, str(room_ID), room_ID), the string orders the ties between room IDs of any type
+                                           # the entries that no longer match deadlines are skipped
+
+    def room_timeout(self, room_ID) :
+        timeout = self.timeout_for(room_ID) if self.timeout_for is not None else None
+        return self.timeout if timeout is None else timeout
+
+    def schedule(self, room_ID, deadline) :
+        self.deadlines[room_ID] = deadline
+        heapq.heappush(self.heap, (deadline, str(room_ID), room_ID))
+
+    # records activity in the room at the given time, starts tracking the room if it was not tracked yet
+    def touch(self, room_ID, now) :
+        self.activity[room_ID] = now
+        if room_ID not in self.deadlines :
+            self.schedule(room_ID, now + self.room_timeout(room_ID))
+
+    # stops tracking the room, its heap entry is dropped once it comes due (or reused if the room is touched again before)
+    def forget(self, room_ID) :
+        self.activity.pop(room_ID, None)
+
+    # returns the rooms whose deadline has passed at the given time and stops tracking them
+    def pop_expired(self, now) :
+        expired = []
+        while self.heap and self.heap[0][0] <= now :
+            deadline, _, room_ID = heapq.heappop(self.heap)
+            if self.deadlines.get(room_ID) != deadline :
+                continue
+            if room_ID not in self.activity :
+                del self.deadlines[room_ID]
+                continue
+            actual = self.activity[room_ID] + self.room_timeout(room_ID)
+            if actual > now :
+                self.schedule(room_ID, actual)
+            else :
+                del self.activity[room_ID], self.deadlines[room_ID]
+                expired.append(room_ID)
+        return expired
+
+    # returns the earliest deadline of the heap (possibly of an entry that will be skipped), None if no room is tracked
+    def next_deadline(self) :
+        return self.heap[0][0] if self.heap else None
+
+    def __contains__(self, room_ID) :
+        return room_ID in self.activity
+
+    def __len__(self) :
+        return len(self.activity)
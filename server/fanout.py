@@ -0,0 +1,90 @@
+import queue
+import threading
+import time
+
+FANOUT_WORKERS = 4        # the threads that deliver the messages of the large rooms, 0 to deliver every message from the sender's thread
+SHARD_THRESHOLD = 256     # the members a room needs before its messages go to the fanout workers
+ORDER_STRIPES = 64        # the locks that keep the messages of a room in order (see ordered), shared by the rooms that hash alike
+
+# delivers the messages of the large rooms from a pool of worker threads, so that the sender of a message to a room
+# of thousands of members does not wait for the frame to be queued to every one of them
+# the room index splits the members of a large room into as many shards as there are workers (see RoomIndex in server/rooms.py),
+# submit() hands shard i of the room to worker i, so the sender's thread only copies the shards and queues them
+# a member always falls into the same shard of its room and every worker delivers its shards in the order they were submitted,
+# so every member receives the messages of the room in the order they were submitted, whichever worker delivers them
+# the rooms below the threshold (the rooms that were never large) are delivered directly from the sender's thread as before :
+# a few sends are cheaper than waking up a worker, and they are done before the next message of the room can be submitted
+# ordered(room_ID) is the lock the sender holds while it numbers a message and submits it, so the order of submission is
+# the order of the sequence numbers
+# the workers only queue the frames to the outbound queues of the members (see server/outbound.py), they never wait on a socket
+class FanoutEngine :
+    def __init__(self, workers = FANOUT_WORKERS) :
+        self.workers = workers
+        self.queues = []                      # the queue of (submission time, shard, send) tasks of every worker
+        self.threads = []
+        self.closed = False
+        self.order_locks = [threading.Lock() for _ in range(ORDER_STRIPES)]
+        self.lock = threading.Lock()          # guards the counters
+        self.counters = {'direct' : 0, 'sharded' : 0, 'shards' : 0, 'errors' : 0}
+        self.observe = None                   # when set, observe(name, seconds) receives the time from the submission to the end of every shard ("fanout.shard")
+
+    def start(self) :
+        for number in range(self.workers) :
+            tasks = queue.SimpleQueue()
+            thread = threading.Thread(target = self.run, args = (tasks,), daemon = True, name = f"fanout-{number}")
+            self.queues.append(tasks)
+            self.threads.append(thread)
+            thread.start()
+
+    def run(self, tasks) :
+        while True :
+            task = tasks.get()
+            if task is None :
+                break
+            submitted, shard, send = task
+            try :
+                send(shard)
+            except Exception as exception :
+                print(f"Error delivering a message : {exception}")
+                self.count('errors')
+            if self.observe is not None :
+                self.observe("fanout.shard", time.perf_counter() - submitted)
+
+    # returns the lock that orders the messages of the room
+    def ordered(self, room_ID) :
+        return self.order_locks[hash(room_ID) % ORDER_STRIPES]
+
+    # delivers the message through send(members) : to the members of a small room (shards None) right away,
+    # to every shard of a large room from its worker
+    # once the engine is closed (or without workers), the shards are delivered right away too
+    def submit(self, members, shards, send) :
+        if shards is None or not self.queues or self.closed :
+            if shards is None :
+                send(members)
+            else :
+                for shard in shards :
+                    send(shard)
+            self.count('direct')
+            return
+        submitted = time.perf_counter()
+        for number, shard in enumerate(shards) :
+            if shard :
+                self.queues[number % len(self.queues)].put((submitted, shard, send))
+        self.count('sharded')
+        self.count('shards', len(shards))
+
+    def count(self, name, amount = 1) :
+        with self.lock :
+            self.counters[name] += amount
+
+    # delivers what is already queued, then stops the workers, waiting at most timeout seconds for each
+    def close(self, timeout = None) :
+        self.closed = True
+        for tasks in self.queues :
+            tasks.put(None)
+        for thread in self.threads :
+            thread.join(timeout)
+
+    def metrics(self) :
+        with self.lock :
+            return {**self.counters, 'workers' : len(self.threads), 'backlog' : sum(tasks.qsize() for tasks in self.queues)}
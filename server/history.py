@@ -0,0 +1,531 @@
+import bisect
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+
+# the chatting history of every room, kept as an append-only log of sequence-numbered records
+# every room has its own directory of segment files, named after the sequence number of their first record :
+#   <directory>/<room_ID>/00000000000000000001.arc, 00000000000000052311.log, ...
+# the writer appends to the last segment of a room until it is sealed (it reached SEGMENT_SIZE, or seal() was called),
+# a sealed segment never changes again : the compactor (see server/compaction.py) rewrites the sealed .log segments
+# into compressed .arc archives and drops the old records the retention policy of the room no longer keeps
+# a record is a RECORD header (payload length, sequence number, timestamp, CRC32 of the header fields and the payload)
+# followed by the message encoded as UTF-8, a torn or corrupt record ends the segment and is cut off when the log starts
+#
+# append() only numbers the message and queues it, so the senders never wait on the disk
+# a single writer thread drains the queue in batches and writes them to the segments (group commit) :
+# a batch is committed, flushed and fsynced once flush_interval seconds have passed since its first message,
+# or as soon as flush_bytes of messages are waiting, whichever comes first
+#
+# the sequence numbers of a room have no gaps, so a page of history is a range of sequence numbers
+# every segment has a sparse index in memory, the byte offset of every INDEX_INTERVAL-th record,
+# so a page is read from the memory-mapped segment starting at the nearest indexed record :
+# the cost of a page depends on its size, not on the length of the history
+RECORD = struct.Struct(">IQdI")
+CHECKED = struct.Struct(">IQd")      # the fields of RECORD covered by the CRC, before the CRC itself
+
+HISTORY_DIR = "history"
+FLUSH_INTERVAL = 0.05                # the seconds a message can wait before its batch is committed
+FLUSH_BYTES = 1024 * 1024            # the message bytes that make the writer commit a batch early
+SEGMENT_SIZE = 16 * 1024 * 1024      # a segment reaching this size is closed and the next record starts a new one
+MAX_OPEN_SEGMENTS = 256              # the segments the writer keeps open at the same time
+INDEX_INTERVAL = 64                  # the records between two entries of the sparse index of a segment
+SEAL_TIMEOUT = 30.0                  # the seconds seal() waits for the writer
+
+# an archive is ARCHIVE_MAGIC, then the records compressed with zlib in chunks of ARCHIVE_CHUNK records,
+# then the chunk index (an ARCHIVE_ENTRY per chunk : its first sequence number, offset and length) and the ARCHIVE_FOOTER :
+# the first sequence number of the segment file the archive replaces and whether that was an archive too,
+# the last sequence number of the archive, the offset of the chunk index and the number of chunks
+# a page only decompresses the chunks it overlaps, found through the chunk index
+ARCHIVE_MAGIC = b"CHATARC1"
+ARCHIVE_CHUNK = INDEX_INTERVAL
+ARCHIVE_ENTRY = struct.Struct(">QQI")
+ARCHIVE_FOOTER = struct.Struct(">Q?QQI")
+ARCHIVE_LEVEL = 6
+
+# returns the record of the message as bytes
+def encode_record(seq, timestamp, message) :
+    payload = message.encode('utf-8')
+    crc = zlib.crc32(payload, zlib.crc32(CHECKED.pack(len(payload), seq, timestamp)))
+    return RECORD.pack(len(payload), seq, timestamp, crc) + payload
+
+# yields the (offset, seq, timestamp, payload) of the records of the data (bytes or a memory map), starting at the given offset
+# stops at the first incomplete or corrupt record, everything from there on is considered lost
+def iter_records(data, offset = 0) :
+    end = len(data)
+    while end - offset >= RECORD.size :
+        length, seq, timestamp, crc = RECORD.unpack_from(data, offset)
+        start = offset + RECORD.size
+        if end - start < length :
+            return
+        payload = data[start : start + length]
+        if zlib.crc32(payload, zlib.crc32(CHECKED.pack(length, seq, timestamp))) != crc :
+            return
+        yield offset, seq, timestamp, payload
+        offset = start + length
+
+# returns the (seq, timestamp, message) records of the data, the number of bytes they take and their sparse index
+def decode_records(data, first_seq) :
+    records = []
+    offsets = []
+    end = 0
+    for offset, seq, timestamp, payload in iter_records(data) :
+        if (seq - first_seq) % INDEX_INTERVAL == 0 :
+            offsets.append((seq, offset))
+        records.append((seq, timestamp, bytes(payload).decode('utf-8')))
+        end = offset + RECORD.size + len(payload)
+    return records, end, offsets
+
+# flushes the data of the file to the disk, without its metadata (like the modification time) where the platform allows it
+sync = getattr(os, 'fdatasync', os.fsync)
+
+def segment_name(first_seq) :
+    return f"{first_seq:020d}.log"
+
+def archive_name(first_seq) :
+    return f"{first_seq:020d}.arc"
+
+# a segment file of a room, along with its sparse index : the (seq, byte offset) of every INDEX_INTERVAL-th record
+# the index of an old segment is built the first time the segment is read, the writer keeps the index of the open ones up to date
+class Segment :
+    __slots__ = ('first_seq', 'path', 'offsets', 'sealed')
+    archived = False
+
+    def __init__(self, first_seq, path, offsets = None, sealed = False) :
+        self.first_seq = first_seq     # the sequence number of the first record of the segment
+        self.path = path
+        self.offsets = offsets         # None until the segment was scanned
+        self.sealed = sealed           # set once the writer no longer appends to the segment
+
+    # returns the records with a sequence number from start up to (not including) end
+    def read(self, start, end) :
+        try :
+            file = open(self.path, "rb")
+        except FileNotFoundError :
+            return []
+        with file :
+            if os.fstat(file.fileno()).st_size == 0 :
+                return []
+            with mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ) as data :
+                if self.offsets is None :
+                    self.offsets = [(seq, offset) for offset, seq, _, _ in iter_records(data)
+                                    if (seq - self.first_seq) % INDEX_INTERVAL == 0]
+                position = bisect.bisect_right(self.offsets, (start, len(data))) - 1
+                records = []
+                for _, seq, timestamp, payload in iter_records(data, self.offsets[position][1] if position >= 0 else 0) :
+                    if seq >= end :
+                        break
+                    if seq >= start :
+                        records.append((seq, timestamp, payload.decode('utf-8')))
+                return records
+
+    # the bytes the segment takes on disk
+    def size(self) :
+        try :
+            return os.path.getsize(self.path)
+        except FileNotFoundError :
+            return 0
+
+# an archive of a room, written by write_archive, always sealed
+class ArchivedSegment :
+    __slots__ = ('first_seq', 'path', 'source', 'last_seq', 'chunks')
+    archived = True
+    sealed = True
+
+    def __init__(self, path) :
+        self.path = path
+        with open(path, "rb") as file :
+            if file.read(len(ARCHIVE_MAGIC)) != ARCHIVE_MAGIC :
+                raise ValueError(f"{path} is not an archive")
+            file.seek(-ARCHIVE_FOOTER.size, os.SEEK_END)
+            source_seq, source_archived, self.last_seq, index_offset, count = ARCHIVE_FOOTER.unpack(file.read(ARCHIVE_FOOTER.size))
+            file.seek(index_offset)
+            index = file.read(count * ARCHIVE_ENTRY.size)
+        self.source = (source_seq, source_archived)   # the segment file this archive replaced
+        self.chunks = [ARCHIVE_ENTRY.unpack_from(index, number * ARCHIVE_ENTRY.size) for number in range(count)]
+        self.first_seq = self.chunks[0][0] if self.chunks else self.last_seq + 1
+
+    # returns the records with a sequence number from start up to (not including) end
+    def read(self, start, end) :
+        position = max(bisect.bisect_right(self.chunks, (start, float("inf"), 0)) - 1, 0)
+        records = []
+        try :
+            file = open(self.path, "rb")
+        except FileNotFoundError :
+            return []
+        with file :
+            for chunk_seq, offset, length in self.chunks[position:] :
+                if chunk_seq >= end :
+                    break
+                file.seek(offset)
+                for _, seq, timestamp, payload in iter_records(zlib.decompress(file.read(length))) :
+                    if seq >= end :
+                        break
+                    if seq >= start :
+                        records.append((seq, timestamp, payload.decode('utf-8')))
+        return records
+
+    # the bytes the archive takes on disk
+    def size(self) :
+        try :
+            return os.path.getsize(self.path)
+        except FileNotFoundError :
+            return 0
+
+# writes the (seq, timestamp, message) records, in order, into a new archive in the directory, replacing the segment source
+# (the write goes to a temporary file that is synced and renamed, so an archive on disk is always complete), returns the ArchivedSegment
+# without records, the archive only keeps last_seq, the sequence number of the newest message of a room whose history all expired
+def write_archive(directory, records, source, last_seq = None) :
+    last_seq = records[-1][0] if records else last_seq
+    path = os.path.join(directory, archive_name(records[0][0] if records else last_seq + 1))
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as file :
+        file.write(ARCHIVE_MAGIC)
+        offset = len(ARCHIVE_MAGIC)
+        entries = []
+        for number in range(0, len(records), ARCHIVE_CHUNK) :
+            chunk = records[number : number + ARCHIVE_CHUNK]
+            data = zlib.compress(b"".join(encode_record(seq, timestamp, message) for seq, timestamp, message in chunk), ARCHIVE_LEVEL)
+            file.write(data)
+            entries.append(ARCHIVE_ENTRY.pack(chunk[0][0], offset, len(data)))
+            offset += len(data)
+        file.write(b"".join(entries))
+        file.write(ARCHIVE_FOOTER.pack(source.first_seq, source.archived, last_seq, offset, len(entries)))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, path)
+    return ArchivedSegment(path)
+
+class HistoryLog :
+    def __init__(self, directory = HISTORY_DIR, flush_interval = FLUSH_INTERVAL, flush_bytes = FLUSH_BYTES,
+                 segment_size = SEGMENT_SIZE) :
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.segment_size = segment_size
+        self.condition = threading.Condition()   # guards everything below, the writer waits on it for new messages
+        self.next_seq = {}                  # room_ID -> the sequence number of the next message of the room
+        self.room_segments = {}             # room_ID -> the Segment objects of the room, oldest first
+        self.pending = deque()              # the (room_ID, seq, timestamp, message) entries not taken by the writer yet
+        self.pending_bytes = 0
+        self.writing = []                   # the batch the writer is currently writing, still served to the readers from memory
+        self.segments = OrderedDict()       # room_ID -> [open file, its size, Segment], least recently written first, only used by the writer
+        self.seal_requests = {}             # room_ID -> the threading.Event set once the writer sealed the last segment of the room
+        self.closed = False
+        self.writer_thread = None
+        self.counters = {'appended' : 0, 'written' : 0, 'batches' : 0, 'fsyncs' : 0, 'largest_batch' : 0}
+        self.observe = None                 # when set, observe(name, seconds) receives the time of every batch write ("history.write_batch")
+        self.on_commit = None               # when set, on_commit(batch) receives the (room_ID, seq, timestamp, message) entries of every written batch
+
+    def room_directory(self, room_ID) :
+        return os.path.join(self.directory, str(room_ID))
+
+    # returns the segments and archives of the room found on disk, oldest first, all of them sealed
+    # the compactor writes an archive before it removes the segment the archive replaces, a crash in between leaves both :
+    # the replaced segment is removed here, along with the temporary file of an archive that was not finished
+    def load_segments(self, room_ID) :
+        room_directory = self.room_directory(room_ID)
+        try :
+            names = sorted(os.listdir(room_directory))
+        except FileNotFoundError :
+            return []
+        segments = []
+        for name in names :
+            path = os.path.join(room_directory, name)
+            if name.endswith(".arc") :
+                segments.append(ArchivedSegment(path))
+            elif name.endswith(".log") :
+                segments.append(Segment(int(name[:-len(".log")]), path, sealed = True))
+            elif name.endswith(".tmp") :
+                os.remove(path)
+        replaced = {segment.source for segment in segments if segment.archived}
+        for segment in [segment for segment in segments if (segment.first_seq, segment.archived) in replaced] :
+            os.remove(segment.path)
+            segments.remove(segment)
+        return segments
+
+    # recovers the next sequence number of every room from the last segment, cutting off a torn tail, then starts the writer
+    # the writer continues the last segment of a room, unless it is an archive
+    def start(self) :
+        os.makedirs(self.directory, exist_ok = True)
+        for room_ID in os.listdir(self.directory) :
+            if not os.path.isdir(self.room_directory(room_ID)) :
+                continue   # the files next to the rooms, like the search index
+            segments = self.load_segments(room_ID)
+            if not segments :
+                continue
+            last = segments[-1]
+            if last.archived :
+                self.next_seq[room_ID] = last.last_seq + 1
+            else :
+                with open(last.path, "r+b") as segment :
+                    records, valid_size, last.offsets = decode_records(segment.read(), last.first_seq)
+                    segment.truncate(valid_size)
+                last.sealed = False
+                self.next_seq[room_ID] = records[-1][0] + 1 if records else last.first_seq
+            self.room_segments[room_ID] = segments
+        self.writer_thread = threading.Thread(target = self.write_loop, daemon = True)
+        self.writer_thread.start()
+
+    # imports the history file of the old format (one message per line) of a room that has no log yet
+    # the messages get the modification time of the file as their timestamp, the file itself is left in place
+    # returns the number of imported messages
+    def import_legacy(self, room_ID, path) :
+        room_ID = str(room_ID)
+        if room_ID in self.next_seq or not os.path.exists(path) :
+            return 0
+        with open(path, "r") as chat_file :
+            lines = chat_file.read().splitlines()
+        timestamp = os.path.getmtime(path)
+        os.makedirs(self.room_directory(room_ID), exist_ok = True)
+        path = os.path.join(self.room_directory(room_ID), segment_name(1))
+        with open(path, "wb") as segment :
+            data = b"".join(encode_record(seq, timestamp, line) for seq, line in enumerate(lines, 1))
+            segment.write(data)
+            segment.flush()
+            os.fsync(segment.fileno())
+        with self.condition :
+            self.room_segments[room_ID] = [Segment(1, path, decode_records(data, 1)[2])]
+            self.next_seq[room_ID] = len(lines) + 1
+        return len(lines)
+
+    # numbers the message and queues it for the writer, returns its sequence number without waiting for the disk
+    def append(self, room_ID, message, timestamp = None) :
+        room_ID = str(room_ID)
+        with self.condition :
+            seq = self.next_seq.get(room_ID, 1)
+            self.next_seq[room_ID] = seq + 1
+            self.pending.append((room_ID, seq, time.time() if timestamp is None else timestamp, message))
+            self.pending_bytes += len(message)
+            self.counters['appended'] += 1
+            if self.pending_bytes >= self.flush_bytes or len(self.pending) == 1 :
+                self.condition.notify()
+        return seq
+
+    # returns the rooms that have messages
+    def rooms(self) :
+        with self.condition :
+            return list(self.next_seq)
+
+    # returns the last sequence number given out in the room, 0 for a room without messages
+    def last_seq(self, room_ID) :
+        with self.condition :
+            return self.next_seq.get(str(room_ID), 1) - 1
+
+    # returns the sequence number of the oldest message of the room that is still kept, 1 for a room without messages
+    def first_seq(self, room_ID) :
+        with self.condition :
+            segments = self.room_segments.get(str(room_ID))
+            return segments[0].first_seq if segments else 1
+
+    # returns the segments of the room, oldest first
+    def room_segments_of(self, room_ID) :
+        with self.condition :
+            return list(self.room_segments.get(str(room_ID), ()))
+
+    # returns the (seq, timestamp, message) records of the room with a sequence number above after_seq and below before_seq,
+    # oldest first, only the newest limit of them if a limit is given
+    # the messages the writer has not committed yet are included, so a reader sees every message that was appended
+    def records(self, room_ID, after_seq = 0, before_seq = None, limit = None) :
+        room_ID = str(room_ID)
+        while True :
+            with self.condition :
+                end = self.next_seq.get(room_ID, 1)
+                if before_seq is not None :
+                    end = min(end, before_seq)
+                start = after_seq + 1
+                if limit is not None :
+                    start = max(start, end - limit)
+                unwritten = [(seq, timestamp, message) for entry_room, seq, timestamp, message in (*self.writing, *self.pending)
+                             if entry_room == room_ID and start <= seq < end]
+                current = self.room_segments.get(room_ID)
+                segments = list(current or ())
+
+            # the records the writer has not committed are served from memory, the others from the segments
+            disk_end = unwritten[0][0] if unwritten else end
+            records = []
+            if start < disk_end and segments :
+                first = max(bisect.bisect_right([segment.first_seq for segment in segments], start) - 1, 0)
+                for segment in segments[first:] :
+                    if segment.first_seq >= disk_end :
+                        break
+                    records.extend(segment.read(start, disk_end))
+            # the compactor replaces the segments list of a room when it swaps segments (see replace_segments),
+            # and removes the old files right after : if that happened meanwhile, one of the segments read may have been gone
+            with self.condition :
+                if self.room_segments.get(room_ID) is current :
+                    return records + unwritten
+
+    # asks the writer to seal the last segment of the room, and waits (at most timeout seconds) until it did
+    # the writer starts a new segment for the next message of the room, the sealed ones are left to the compactor
+    # returns False if the writer did not seal the segment in time, or is closed
+    def seal(self, room_ID, timeout = SEAL_TIMEOUT) :
+        with self.condition :
+            if self.closed :
+                return False
+            done = self.seal_requests.setdefault(str(room_ID), threading.Event())
+            self.condition.notify()
+        return done.wait(timeout)
+
+    # swaps the sealed segments old of the room, consecutive and oldest first, for the segments new (none to drop them)
+    # the segments the writer started meanwhile are kept, the caller removes the files of the old segments afterwards
+    # returns False, swapping nothing, if the room no longer has the old segments
+    def replace_segments(self, room_ID, old, new) :
+        room_ID = str(room_ID)
+        with self.condition :
+            segments = self.room_segments.get(room_ID, [])
+            for position, segment in enumerate(segments) :
+                if segment is old[0] :
+                    self.room_segments[room_ID] = segments[:position] + list(new) + segments[position + len(old):]
+                    return True
+            return False
+
+    # forgets a room that was deleted, returns its segments, whose files the caller removes
+    # the next message of the room, if any, starts its history over
+    def drop_room(self, room_ID) :
+        room_ID = str(room_ID)
+        self.seal(room_ID)
+        with self.condition :
+            self.next_seq.pop(room_ID, None)
+            return self.room_segments.pop(room_ID, [])
+
+    # waits for messages and commits them in batches until the log is closed and everything is written
+    def write_loop(self) :
+        while True :
+            with self.condition :
+                while not self.pending and not self.closed and not self.seal_requests :
+                    self.condition.wait()
+                seal_requests = self.seal_requests
+                self.seal_requests = {}
+            self.seal_segments(seal_requests)
+
+            with self.condition :
+                if not self.pending and not self.closed :
+                    continue
+                # the first message of the batch is here, give the others flush_interval seconds to join it
+                deadline = time.monotonic() + self.flush_interval
+                while self.pending_bytes < self.flush_bytes and not self.closed :
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 :
+                        break
+                    self.condition.wait(remaining)
+                if not self.pending and self.closed :
+                    break
+                self.writing = list(self.pending)
+                self.pending.clear()
+                self.pending_bytes = 0
+
+            started = time.monotonic()
+            try :
+                self.write_batch(self.writing)
+                if self.on_commit is not None :
+                    self.on_commit(self.writing)
+            except OSError as exception :
+                print(f"Error writing the chatting history : {exception}")
+            if self.observe is not None :
+                self.observe("history.write_batch", time.monotonic() - started)
+
+            with self.condition :
+                self.counters['written'] += len(self.writing)
+                self.counters['batches'] += 1
+                self.counters['largest_batch'] = max(self.counters['largest_batch'], len(self.writing))
+                self.writing = []
+
+        for room_ID in list(self.segments) :
+            self.close_segment(room_ID)
+        with self.condition :
+            seal_requests = self.seal_requests
+            self.seal_requests = {}
+        self.seal_segments(seal_requests)
+
+    # closes the open segment of every room asked for and marks its last segment sealed, then wakes up the callers of seal()
+    def seal_segments(self, seal_requests) :
+        for room_ID, done in seal_requests.items() :
+            try :
+                if room_ID in self.segments :
+                    self.close_segment(room_ID)
+            except OSError as exception :
+                print(f"Error sealing the chatting history of room {room_ID} : {exception}")
+            with self.condition :
+                segments = self.room_segments.get(room_ID)
+                if segments :
+                    segments[-1].sealed = True
+            done.set()
+
+    # writes the records of the batch into the segments of their rooms, then flushes and syncs every segment it touched
+    # the records are grouped by room first, so every room of the batch is written (and synced) once, whatever the interleaving
+    def write_batch(self, batch) :
+        rooms = {}
+        for room_ID, seq, timestamp, message in batch :
+            rooms.setdefault(room_ID, []).append((seq, encode_record(seq, timestamp, message)))
+
+        synced = 0
+        for room_ID, records in rooms.items() :
+            for seq, record in records :
+                segment = self.segment_for(room_ID, seq, len(record))
+                if (seq - segment[2].first_seq) % INDEX_INTERVAL == 0 :
+                    segment[2].offsets.append((seq, segment[1]))
+                segment[0].write(record)
+                segment[1] += len(record)
+            segment[0].flush()
+            sync(segment[0].fileno())
+            synced += 1
+        with self.condition :
+            self.counters['fsyncs'] += synced
+
+    # returns the open segment of the room the record of the given size goes into, as an [open file, size, Segment] list
+    # continues the last segment of the room unless the record does not fit in it (the segment is sealed then) or it is sealed,
+    # then starts a new segment
+    # at most MAX_OPEN_SEGMENTS segments stay open, the least recently written one is closed to make room for another
+    def segment_for(self, room_ID, seq, size) :
+        segment = self.segments.get(room_ID)
+        if segment is not None :
+            self.segments.move_to_end(room_ID)
+            if segment[1] == 0 or segment[1] + size <= self.segment_size :
+                return segment
+            self.close_segment(room_ID)
+            with self.condition :
+                segment[2].sealed = True
+            last = None
+        else :
+            with self.condition :
+                segments = self.room_segments.get(room_ID)
+                last = segments[-1] if segments else None
+                if last is not None and not last.sealed and os.path.getsize(last.path) + size > self.segment_size :
+                    last.sealed = True
+                if last is not None and last.sealed :
+                    last = None
+
+        if last is None :
+            os.makedirs(self.room_directory(room_ID), exist_ok = True)
+            last = Segment(seq, os.path.join(self.room_directory(room_ID), segment_name(seq)), [])
+            with self.condition :
+                self.room_segments.setdefault(room_ID, []).append(last)
+        if len(self.segments) >= MAX_OPEN_SEGMENTS :
+            self.close_segment(next(iter(self.segments)))
+        file = open(last.path, "ab")
+        segment = self.segments[room_ID] = [file, file.tell(), last]
+        return segment
+
+    def close_segment(self, room_ID) :
+        file, _, _ = self.segments.pop(room_ID)
+        file.flush()
+        sync(file.fileno())
+        file.close()
+
+    # commits everything that was appended, stops the writer and closes the segments
+    def close(self, timeout = None) :
+        with self.condition :
+            self.closed = True
+            self.condition.notify()
+        if self.writer_thread is not None :
+            self.writer_thread.join(timeout)
+
+    # returns a copy of the counters, along with the messages waiting to be written
+    def metrics(self) :
+        with self.condition :
+            return {**self.counters, 'pending' : len(self.pending) + len(self.writing)}
@@ -0,0 +1,63 @@
+import threading
+from collections import OrderedDict
+from protocol.compression import compress_payload
+
+HISTORY_BLOCK = 32           # the messages of a block : block b holds the messages numbered b * HISTORY_BLOCK + 1 to (b + 1) * HISTORY_BLOCK
+MAX_CACHED_BLOCKS = 4096     # the compressed blocks kept, the least recently sent are dropped first
+
+# the chatting history of the rooms in compressed blocks, for the clients that negotiated compression (see protocol/compression.py)
+# a message never changes once the history log numbered it, so a block holding all HISTORY_BLOCK of its messages is compressed
+# the first time a client needs it, and then sent as it is to every client that joins the room or catches up on it
+# only the partial blocks at the ends of the history sent are compressed again for every client
+# the blocks of the messages the retention trims, and of the rooms that are deleted (whose numbering restarts at 1), are forgotten
+class HistoryBlocks :
+    def __init__(self, max_blocks = MAX_CACHED_BLOCKS) :
+        self.max_blocks = max_blocks
+        self.lock = threading.Lock()
+        self.blocks = OrderedDict()   # (room_ID, block) -> (the compressed payload, the uncompressed size), least recently used first
+        self.hits = 0
+        self.misses = 0
+
+    # splits the (seq, timestamp, message) records, in order, into runs of the same block
+    # returns (block, records) pairs, block being None for a run that does not hold the whole block
+    def split(self, records) :
+        runs = []
+        for record in records :
+            block = (record[0] - 1) // HISTORY_BLOCK
+            if runs and runs[-1][0] == block :
+                runs[-1][1].append(record)
+            else :
+                runs.append((block, [record]))
+        return [(block if len(run) == HISTORY_BLOCK else None, run) for block, run in runs]
+
+    # returns the compressed payload of the full block of the room and its uncompressed size, compressing the records if it is not kept yet
+    def payload(self, room_ID, block, records) :
+        key = (str(room_ID), block)
+        with self.lock :
+            cached = self.blocks.get(key)
+            if cached is not None :
+                self.blocks.move_to_end(key)
+                self.hits += 1
+                return cached
+            self.misses += 1
+
+        text = "".join(message + "\n" for _, _, message in records).encode('utf-8')
+        cached = (compress_payload(text), len(text))
+        with self.lock :
+            self.blocks[key] = cached
+            while len(self.blocks) > self.max_blocks :
+                self.blocks.popitem(last = False)
+        return cached
+
+    # forgets the blocks of the room holding messages below first_seq, all of them with first_seq None (the room was deleted)
+    def forget(self, room_ID, first_seq = None) :
+        room_ID = str(room_ID)
+        with self.lock :
+            for key in [key for key in self.blocks if key[0] == room_ID] :
+                if first_seq is None or key[1] * HISTORY_BLOCK < first_seq - 1 :
+                    del self.blocks[key]
+
+    def metrics(self) :
+        with self.lock :
+            return {"cached_blocks" : len(self.blocks), "cached_bytes" : sum(len(payload) for payload, _ in self.blocks.values()),
+                    "hits" : self.hits, "misses" : self.misses}
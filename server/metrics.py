@@ -0,0 +1,88 @@
+import math
+import threading
+import time
+
+# the counters and latency histograms of the server, read by the "stats" action and the "stats" console command
+# recording is cheap enough for every action : a histogram is a fixed list of counts with logarithmic buckets
+# (BUCKETS_PER_DOUBLING per power of two of microseconds, so a percentile is within about 19% of the true value)
+# and recording takes one lock, never an allocation
+BUCKETS_PER_DOUBLING = 4
+BUCKET_COUNT = 36 * BUCKETS_PER_DOUBLING   # up to 2 ** 36 microseconds (about 19 hours), longer latencies go into the last bucket
+PERCENTILES = {"p50" : 0.50, "p90" : 0.90, "p99" : 0.99, "p999" : 0.999}
+
+# the latencies of one operation
+class Histogram :
+    __slots__ = ('counts', 'count', 'total', 'largest', 'lock')
+
+    def __init__(self) :
+        self.counts = [0] * BUCKET_COUNT
+        self.count = 0
+        self.total = 0.0
+        self.largest = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, seconds) :
+        microseconds = seconds * 1e6
+        bucket = min(int(math.log2(microseconds) * BUCKETS_PER_DOUBLING), BUCKET_COUNT - 1) if microseconds > 1 else 0
+        with self.lock :
+            self.counts[bucket] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.largest :
+                self.largest = seconds
+
+    # returns the count, the mean, the percentiles (the upper bound of the bucket they fall into) and the largest latency in milliseconds
+    def summary(self) :
+        with self.lock :
+            counts, count, total, largest = list(self.counts), self.count, self.total, self.largest
+        summary = {"count" : count, "mean_ms" : round(total / count * 1000, 3) if count else 0.0}
+        for name, fraction in PERCENTILES.items() :
+            summary[f"{name}_ms"] = round(percentile(counts, count, fraction, largest) * 1000, 3)
+        summary["max_ms"] = round(largest * 1000, 3)
+        return summary
+
+def percentile(counts, count, fraction, largest) :
+    if not count :
+        return 0.0
+    rank = fraction * count
+    seen = 0
+    for bucket, bucket_count in enumerate(counts) :
+        seen += bucket_count
+        if seen >= rank :
+            return min(2 ** ((bucket + 1) / BUCKETS_PER_DOUBLING) / 1e6, largest)
+    return largest
+
+# the named counters and histograms, created on first use
+class Metrics :
+    def __init__(self) :
+        self.started = time.time()
+        self.lock = threading.Lock()   # guards the creation of the counters and histograms, and the counters
+        self.counters = {}
+        self.histograms = {}
+
+    def histogram(self, name) :
+        histogram = self.histograms.get(name)
+        if histogram is None :
+            with self.lock :
+                histogram = self.histograms.setdefault(name, Histogram())
+        return histogram
+
+    # records the latency of the named operation, in seconds
+    def observe(self, name, seconds) :
+        self.histogram(name).record(seconds)
+
+    def count(self, name, amount = 1) :
+        with self.lock :
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def snapshot(self) :
+        with self.lock :
+            counters = dict(self.counters)
+            histograms = dict(self.histograms)
+        return {
+            "uptime_s" : round(time.time() - self.started, 1),
+            "counters" : counters,
+            "latency" : {name : histograms[name].summary() for name in sorted(histograms)},
+        }
+
+metrics = Metrics()   # the metrics of the server process
@@ -0,0 +1,198 @@
+import socket
+import threading
+from collections import deque
+
+# what happens to a new message when the outbound queue of a client is full
+# drop_oldest : the oldest queued message is discarded to make room for the new one
+# disconnect  : the client is considered stalled and its connection is closed
+# coalesce    : the queued messages are merged into a single write (frames are self-delimiting, so they can be concatenated)
+#               until the queued bytes reach max_bytes, then the client is disconnected
+OVERFLOW_POLICIES = ("drop_oldest", "disconnect", "coalesce")
+
+IOV_MAX = 512                 # the most buffers handed to a single sendmsg call
+
+max_items = 1024              # the number of messages a client can have waiting to be written
+max_bytes = 4 * 1024 * 1024   # the number of bytes a client can have waiting to be written under the coalesce policy
+overflow_policy = "drop_oldest"
+
+# the counters of all outbound queues together
+# enqueued : messages accepted, delayed : messages that had to wait behind a backlog of the same client
+# dropped : messages discarded, coalesced : messages merged into a previous write, disconnected : clients closed for being too slow
+counters = {'enqueued' : 0, 'delayed' : 0, 'dropped' : 0, 'coalesced' : 0, 'disconnected' : 0}
+counters_lock = threading.Lock()
+
+# changes the size limits and the overflow policy of the queues created from now on
+def configure(queue_size = None, queue_bytes = None, policy = None) :
+    global max_items, max_bytes, overflow_policy
+    if policy is not None and policy not in OVERFLOW_POLICIES :
+        raise ValueError(f"unknown overflow policy {policy}")
+    if queue_size is not None :
+        max_items = queue_size
+    if queue_bytes is not None :
+        max_bytes = queue_bytes
+    if policy is not None :
+        overflow_policy = policy
+
+def count(name, amount = 1) :
+    with counters_lock :
+        counters[name] += amount
+
+# returns a copy of the counters
+def snapshot_counters() :
+    with counters_lock :
+        return dict(counters)
+
+# a bounded queue of the payloads waiting to be written to one client
+# put() never blocks : a full queue is handled by the overflow policy instead
+# on_ready is called whenever the queue goes from empty to non-empty (or is closed), to wake up the writer of the connection
+# on_overflow is called when the policy decides to disconnect the client
+class OutboundQueue :
+    __slots__ = ('items', 'size', 'lock', 'closed', 'on_ready', 'on_overflow', 'max_items', 'max_bytes', 'policy')
+
+    def __init__(self, on_ready, on_overflow) :
+        self.items = deque()          # the payloads waiting to be written, in order
+        self.size = 0                 # the number of bytes in items
+        self.lock = threading.Lock()
+        self.closed = False           # no more payloads are accepted once closed
+        self.on_ready = on_ready
+        self.on_overflow = on_overflow
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.policy = overflow_policy
+
+    # queues the payload and returns True, or returns False if the queue is closed or the client was disconnected
+    def put(self, data) :
+        with self.lock :
+            if self.closed :
+                return False
+            was_empty = not self.items
+            overflow = False
+
+            if len(self.items) >= self.max_items :
+                if self.policy == "drop_oldest" :
+                    self.size -= len(self.items.popleft())
+                    count('dropped')
+                elif self.policy == "coalesce" and self.size + len(data) <= self.max_bytes :
+                    merged = b"".join(self.items) + data
+                    count('coalesced', len(self.items))
+                    self.items.clear()
+                    self.items.append(merged)
+                    self.size = len(merged)
+                    count('enqueued')
+                    return True
+                else :
+                    overflow = True
+
+            if not overflow :
+                self.items.append(data)
+                self.size += len(data)
+
+        if overflow :
+            self.close(abort = True)
+            count('disconnected')
+            self.on_overflow()
+            return False
+        count('enqueued')
+        if was_empty :
+            self.on_ready()
+        else :
+            count('delayed')
+        return True
+
+    # removes and returns all the queued payloads
+    def take(self) :
+        with self.lock :
+            batch = list(self.items)
+            self.items.clear()
+            self.size = 0
+            return batch
+
+    # returns True once the queue is closed and everything queued before has been taken
+    def finished(self) :
+        with self.lock :
+            return self.closed and not self.items
+
+    # stops accepting payloads, the already queued ones are still written unless abort is set
+    def close(self, abort = False) :
+        with self.lock :
+            if abort and self.items :
+                count('dropped', len(self.items))
+                self.items.clear()
+                self.size = 0
+            already_closed = self.closed
+            self.closed = True
+        if not already_closed :
+            self.on_ready()
+
+# the client socket of the threaded mode : sends go into an OutboundQueue that a writer thread of this connection drains
+# so that the sending thread (another client broadcasting, for example) never blocks on a slow peer
+# close() lets the writer flush whatever is already queued before it closes the socket
+class QueuedClientSocket :
+    def __init__(self, sock) :
+        self.sock = sock
+        self.ready = threading.Event()
+        self.queue = OutboundQueue(self.ready.set, self.abort)
+        self.compression = None   # the compression agreed on in the "hello" action, None for uncompressed frames
+        self.writer_thread = threading.Thread(target = self.write_loop, daemon = True)
+        self.writer_thread.start()
+
+    def recv_into(self, buffer) :
+        return self.sock.recv_into(buffer)
+
+    # queues the data, raises ConnectionResetError if the connection is closed (or was just closed for being too slow)
+    def sendall(self, data) :
+        if not self.queue.put(data) :
+            raise ConnectionResetError("the connection is closed")
+
+    def close(self) :
+        self.queue.close()
+
+    # closes the connection without writing what is still queued, also wakes up a writer stuck in sendall
+    def abort(self) :
+        self.queue.close(abort = True)
+        try :
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError :
+            pass
+
+    def write_loop(self) :
+        try :
+            while not self.queue.finished() :
+                self.ready.wait()
+                self.ready.clear()
+                self.write_batch(self.queue.take())
+        except OSError :
+            self.queue.close(abort = True)
+        finally :
+            # shutting down first wakes up the reader thread of the connection if it is still waiting in recv_into
+            try :
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError :
+                pass
+            self.sock.close()
+
+    # writes the queued payloads with as few system calls as possible
+    # the payloads are shared between all the recipients of a broadcast, so they are never joined or copied :
+    # sendmsg gathers them straight from the shared buffers, and a partially sent buffer continues from a memoryview of it
+    def write_batch(self, batch) :
+        if not hasattr(self.sock, 'sendmsg') :
+            for data in batch :
+                self.sock.sendall(data)
+            return
+
+        views = [memoryview(data) for data in batch]
+        start = 0
+        while start < len(views) :
+            sent = self.sock.sendmsg(views[start : start + IOV_MAX])
+            while sent :
+                size = views[start].nbytes
+                if sent >= size :
+                    sent -= size
+                    start += 1
+                else :
+                    views[start] = views[start][sent:]
+                    sent = 0
+
+    # waits until the writer has flushed the queue and closed the socket, at most timeout seconds
+    def join(self, timeout = None) :
+        self.writer_thread.join(timeout)
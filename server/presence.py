@@ -0,0 +1,152 @@
+import threading
+
+PRESENCE_INTERVAL = 0.5    # the most seconds a presence change waits before it is sent, the changes of that time go out together
+MAX_WHO_USERS = 1000       # the most usernames a "who" response lists
+
+# who is in which room, kept in memory : the "who" action and the member counts of the "list" action are served from it
+# the room index reports every session entering and leaving a room (see RoomIndex.on_enter and on_leave in server/rooms.py),
+# which covers the joins, the disconnects and the rooms closed for inactivity alike
+# a room counts its users : a user connected twice to a room counts once, a client that joined without logging in counts as one user
+# the changes are not sent as they happen : every interval seconds the flusher compares the users of the rooms that changed
+# with the users it announced last time, and hands the difference of every room to on_change(changes, counts, watchers) in one call,
+# changes being room_ID -> (joined, left, count), counts the new member counts of those rooms and watchers the sessions watching them
+# a user leaving and coming back within the interval is no change at all, and a busy lobby costs one event per interval
+# in the cluster mode every worker sends the changes of its own sessions to the others through the broker (on_local_changes),
+# and keeps theirs apart (apply_remote), so the counts cover the whole cluster
+class Presence :
+    def __init__(self, interval = PRESENCE_INTERVAL) :
+        self.interval = interval
+        self.lock = threading.Lock()   # guards everything below
+        self.local = {}                # str(room_ID) -> {username : the sessions of the user in the room}, for this process
+        self.remote = {}               # str(room_ID) -> {username : sessions}, for the other workers of the cluster
+        self.entered = {}              # session -> (str(room_ID), username) it entered with, so it leaves with the same even if it logs in again
+        self.deltas = {}               # str(room_ID) -> {username : change of sessions}, the local changes not sent to the broker yet
+        self.dirty = set()             # the rooms that changed since the last flush
+        self.announced = {}            # str(room_ID) -> the users announced by the last flush
+        self.watchers = set()          # the sessions that want the member counts of all the rooms as they change
+        self.counts = {}               # str(room_ID) -> the member count, as of the last flush, replaced and never modified
+        self.version = 0               # incremented whenever the flush changes counts
+        self.on_change = None          # when set, on_change(changes, counts, watchers) receives the changes of every flush
+        self.on_local_changes = None   # when set, on_local_changes(deltas) receives the local changes of every flush
+        self.stopped = threading.Event()
+
+    def start(self) :
+        threading.Thread(target = self.run, daemon = True).start()
+
+    def run(self) :
+        while not self.stopped.wait(self.interval) :
+            self.flush()
+
+    def enter(self, session, room_ID) :
+        key = (str(room_ID), session.username)
+        with self.lock :
+            self.entered[session] = key
+            self.add(self.local, key[0], key[1], 1)
+            room_deltas = self.deltas.setdefault(key[0], {})
+            room_deltas[key[1]] = room_deltas.get(key[1], 0) + 1
+
+    def leave(self, session, room_ID) :
+        with self.lock :
+            key = self.entered.pop(session, None)
+            if key is None :
+                return
+            self.add(self.local, key[0], key[1], -1)
+            room_deltas = self.deltas.setdefault(key[0], {})
+            room_deltas[key[1]] = room_deltas.get(key[1], 0) - 1
+
+    # applies the changes of the sessions of the other workers, {room_ID : {username : change of sessions}}
+    def apply_remote(self, changes) :
+        with self.lock :
+            for room_ID, users in changes.items() :
+                for username, delta in users.items() :
+                    self.add(self.remote, room_ID, username or None, delta)
+
+    # must be called with the lock held
+    def add(self, rooms, room_ID, username, delta) :
+        users = rooms.setdefault(room_ID, {})
+        sessions = users.get(username, 0) + delta
+        if sessions > 0 :
+            users[username] = sessions
+        else :
+            users.pop(username, None)
+            if not users :
+                del rooms[room_ID]
+        self.dirty.add(room_ID)
+
+    # returns the users in the room (local and remote) and their sessions, must be called with the lock held
+    def users(self, room_ID) :
+        users = dict(self.remote.get(room_ID, {}))
+        for username, sessions in self.local.get(room_ID, {}).items() :
+            users[username] = users.get(username, 0) + sessions
+        return users
+
+    # returns the member count of a room from its users : the anonymous sessions (no username) count one each
+    @staticmethod
+    def count(users) :
+        return len(users) - 1 + users[None] if None in users else len(users)
+
+    # returns the live member count of the room, and up to limit of the usernames in it, sorted
+    def who(self, room_ID, limit = MAX_WHO_USERS) :
+        with self.lock :
+            users = self.users(str(room_ID))
+        return self.count(users), sorted(username for username in users if username is not None)[:limit]
+
+    # returns the member counts of the rooms as of the last flush, along with their version
+    def member_counts(self) :
+        return self.version, self.counts
+
+    def watch(self, session, watching = True) :
+        with self.lock :
+            if watching :
+                self.watchers.add(session)
+            else :
+                self.watchers.discard(session)
+
+    # forgets the session, once its connection is gone
+    def unwatch(self, session) :
+        self.watch(session, False)
+
+    # sends the changes since the last flush
+    def flush(self) :
+        with self.lock :
+            dirty, self.dirty = self.dirty, set()
+            deltas, self.deltas = self.deltas, {}
+            changes = {}
+            for room_ID in dirty :
+                users = self.users(room_ID)
+                present = {username for username in users if username is not None}
+                announced = self.announced.get(room_ID, set())
+                count = self.count(users)
+                if present == announced and count == self.counts.get(room_ID, 0) :
+                    continue
+                changes[room_ID] = (sorted(present - announced), sorted(announced - present), count)
+                if present :
+                    self.announced[room_ID] = present
+                else :
+                    self.announced.pop(room_ID, None)
+            if changes :
+                counts = dict(self.counts)
+                for room_ID, (_, _, count) in changes.items() :
+                    if count :
+                        counts[room_ID] = count
+                    else :
+                        counts.pop(room_ID, None)
+                self.counts = counts
+                self.version += 1
+            watchers = list(self.watchers)
+
+        deltas = {room_ID : {username or "" : delta for username, delta in users.items() if delta}
+                  for room_ID, users in deltas.items()}
+        deltas = {room_ID : users for room_ID, users in deltas.items() if users}
+        if deltas and self.on_local_changes is not None :
+            self.on_local_changes(deltas)
+        if changes and self.on_change is not None :
+            self.on_change(changes, {room_ID : count for room_ID, (_, _, count) in changes.items()}, watchers)
+
+    def close(self) :
+        self.stopped.set()
+
+    def metrics(self) :
+        with self.lock :
+            return {"rooms" : len(set(self.local) | set(self.remote)), "sessions" : len(self.entered), "watchers" : len(self.watchers),
+                    "version" : self.version}
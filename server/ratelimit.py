@@ -0,0 +1,130 @@
+import threading
+import time
+
+# the admission control of the client actions, checked by handle_action before an action runs
+# every limit is a token bucket : it holds up to burst tokens and refills at rate tokens per second, an action takes a token
+# and is rejected when there is none left, along with the seconds until there will be one (retry_after)
+# a rejected action costs no more than the check, it never reaches the database, the history or the members of a room
+# - every connection has a bucket for all of its actions, so a single connection can not flood the server with "list" or "history"
+# - every user has a bucket for the messages it sends, shared by all of its connections
+# - every room has a bucket for the messages sent to it, shared by all of its members : the fanout and the history writes
+#   of a room are bounded whoever sends
+# - at most max_db_actions of the DB_ACTIONS run at the same time, the others wait db_timeout seconds at most for a slot
+#   and are rejected then, so a storm of logins is turned away instead of queueing up on the database pool
+# a rate of 0 disables the limit
+# the buckets only hold their tokens and the time they were last refilled, they are refilled when they are checked :
+# a check is a few float operations under a lock, no thread or timer runs for the buckets
+# in the cluster mode every worker process has buckets of its own, so the user and room limits apply per worker
+CONNECTION_RATE = 50.0         # the actions per second of a connection
+CONNECTION_BURST = 100
+USER_MESSAGE_RATE = 10.0       # the messages per second of a user
+USER_MESSAGE_BURST = 30
+ROOM_MESSAGE_RATE = 500.0      # the messages per second of a room
+ROOM_MESSAGE_BURST = 1000
+MAX_DB_ACTIONS = 32            # the DB-bound actions running at the same time, as many as the database pool has connections
+DB_ADMISSION_TIMEOUT = 1.0     # the seconds a DB-bound action waits for a slot before it is rejected
+DB_RETRY_AFTER = 1.0           # the retry_after of the DB-bound actions rejected for want of a slot
+MAX_IDLE_BUCKETS = 10000       # the user or room buckets kept before the ones that refilled completely are dropped
+
+DB_ACTIONS = frozenset(("register", "login", "create_room", "delete_room"))
+MESSAGE_ACTIONS = frozenset(("send_message",))
+UNLIMITED_ACTIONS = frozenset(("disconnect",))   # leaving a room only frees resources
+
+class TokenBucket :
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, burst, now) :
+        self.tokens = burst
+        self.updated = now
+
+    # takes a token, returns 0 if there was one, the seconds until there is one otherwise
+    # the limit of the bucket is passed in, so that a bucket is two floats whatever the number of clients
+    def take(self, rate, burst, now) :
+        tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if tokens >= 1 :
+            self.tokens = tokens - 1
+            return 0.0
+        self.tokens = tokens
+        return (1 - tokens) / rate
+
+    # returns True if the bucket refilled completely, it is no different from a new one then
+    def full(self, rate, burst, now) :
+        return self.tokens + (now - self.updated) * rate >= burst
+
+class AdmissionControl :
+    def __init__(self) :
+        self.lock = threading.Lock()   # guards the buckets and the counters
+        self.users = {}                # username -> the TokenBucket of the messages of the user
+        self.rooms = {}                # str(room_ID) -> the TokenBucket of the messages of the room
+        self.prune_at = {'user' : MAX_IDLE_BUCKETS, 'room' : MAX_IDLE_BUCKETS}
+        self.counters = {'admitted' : 0, 'rejected_connection' : 0, 'rejected_user' : 0, 'rejected_room' : 0, 'rejected_database' : 0}
+        self.configure()
+
+    # changes the limits, to be called before the server starts
+    def configure(self, connection = (CONNECTION_RATE, CONNECTION_BURST), user = (USER_MESSAGE_RATE, USER_MESSAGE_BURST),
+                  room = (ROOM_MESSAGE_RATE, ROOM_MESSAGE_BURST), max_db_actions = MAX_DB_ACTIONS, db_timeout = DB_ADMISSION_TIMEOUT) :
+        self.limits = {'connection' : connection, 'user' : user, 'room' : room}   # scope -> (rate, burst)
+        self.db_slots = threading.BoundedSemaphore(max_db_actions) if max_db_actions else None
+        self.db_timeout = db_timeout
+
+    # checks the action of the session against its connection bucket, and a message against the buckets of its user and its room
+    # returns None if the action is admitted, the (scope, retry_after) of the limit it hit otherwise
+    def admit(self, session, action) :
+        if action in UNLIMITED_ACTIONS :
+            return None
+        now = time.monotonic()
+        with self.lock :
+            rate, burst = self.limits['connection']
+            if rate :
+                if session.bucket is None :
+                    session.bucket = TokenBucket(burst, now)
+                wait = session.bucket.take(rate, burst, now)
+                if wait :
+                    return self.reject('connection', wait)
+            if action in MESSAGE_ACTIONS :
+                if session.username is not None :
+                    wait = self.take('user', self.users, session.username, now)
+                    if wait :
+                        return self.reject('user', wait)
+                if session.room_ID is not None :
+                    wait = self.take('room', self.rooms, str(session.room_ID), now)
+                    if wait :
+                        return self.reject('room', wait)
+            self.counters['admitted'] += 1
+        return None
+
+    # takes a token from the bucket of the key, creating the bucket if needed, returns the seconds to wait (0 if there was a token)
+    # the buckets that refilled completely are dropped once there are many of them, they cost nothing to create again
+    def take(self, scope, buckets, key, now) :
+        rate, burst = self.limits[scope]
+        if not rate :
+            return 0.0
+        bucket = buckets.get(key)
+        if bucket is None :
+            if len(buckets) >= self.prune_at[scope] :
+                for full in [key for key, bucket in buckets.items() if bucket.full(rate, burst, now)] :
+                    del buckets[full]
+                self.prune_at[scope] = max(MAX_IDLE_BUCKETS, 2 * len(buckets))
+            bucket = buckets[key] = TokenBucket(burst, now)
+        return bucket.take(rate, burst, now)
+
+    def reject(self, scope, wait) :
+        self.counters[f'rejected_{scope}'] += 1
+        return scope, round(wait, 3)
+
+    # takes a slot of the DB-bound actions, waiting db_timeout seconds at most, returns False if no slot became free
+    def acquire_db_slot(self) :
+        if self.db_slots is None or self.db_slots.acquire(timeout = self.db_timeout) :
+            return True
+        with self.lock :
+            self.counters['rejected_database'] += 1
+        return False
+
+    def release_db_slot(self) :
+        if self.db_slots is not None :
+            self.db_slots.release()
+
+    def metrics(self) :
+        with self.lock :
+            return {**self.counters, 'user_buckets' : len(self.users), 'room_buckets' : len(self.rooms)}
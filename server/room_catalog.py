@@ -0,0 +1,104 @@
+import json
+import threading
+import time
+from protocol.framing import encode_frame
+
+RETENTION_COLUMNS = ("retention_age", "retention_messages", "retention_bytes")   # the retention policy of a room (see server/compaction.py)
+
+# an in-memory copy of the rooms table, so that the "list" and "join_room" actions never wait on the database
+# load_rooms returns every room as a dictionary with room_ID, room_name, room_password, room_timeout and the RETENTION_COLUMNS
+# the rooms only change through handle_create_room and handle_delete_room, which update the catalog as they write to the database
+# the list response is serialized and framed once, then reused until the catalog or the member counts change
+# with a ttl (in seconds) a background thread also reloads the catalog periodically, picking up changes made elsewhere
+class RoomCatalog :
+    def __init__(self, load_rooms, ttl = None) :
+        self.load_rooms = load_rooms
+        self.ttl = ttl
+        self.lock = threading.Lock()            # guards rooms and the cached list frame
+        self.update_lock = threading.Lock()     # serializes the reloads and the updates, so a reload never undoes a newer update
+        self.rooms = {}            # str(room_ID) -> the room dictionary, in the order of the database
+                                   # replaced on every change and never modified in place, so it can be read without the lock
+        self.list_frame_cache = None
+        self.list_frame_version = None
+        self.loaded_at = None      # the time of the last reload, None until the catalog is loaded
+        self.member_counts = None  # when set, member_counts() returns a version and the {str(room_ID) : members} of the rooms with members
+                                   # (see server/presence.py), a new version for every change of the counts
+
+    # reloads every room from the database
+    def refresh(self) :
+        with self.update_lock :
+            rooms = {str(room['room_ID']) : room for room in self.load_rooms()}
+            with self.lock :
+                self.rooms = rooms
+                self.list_frame_cache = None
+                self.loaded_at = time.time()
+
+    # loads the catalog unless it is already loaded, returns False if the database could not be reached
+    def ensure_loaded(self) :
+        if self.loaded_at is not None :
+            return True
+        try :
+            self.refresh()
+            return True
+        except Exception as exception :
+            print(f"Error loading the room catalog : {exception}")
+            return False
+
+    # starts the thread that reloads the catalog every ttl seconds, does nothing without a ttl
+    def start(self) :
+        self.ensure_loaded()
+        if self.ttl :
+            threading.Thread(target = self.refresh_loop, daemon = True).start()
+
+    def refresh_loop(self) :
+        while True :
+            time.sleep(self.ttl)
+            try :
+                self.refresh()
+            except Exception as exception :
+                print(f"Error refreshing the room catalog : {exception}")
+
+    # returns True if the room exists and the password is the password of the room
+    def check_password(self, room_ID, room_password) :
+        self.ensure_loaded()
+        room = self.rooms.get(str(room_ID))
+        return room is not None and room['room_password'] is not None and room['room_password'] == room_password
+
+    # returns the inactivity timeout of the room in seconds, None if the room has none of its own (or does not exist)
+    def room_timeout(self, room_ID) :
+        room = self.rooms.get(str(room_ID))
+        return room.get('room_timeout') if room is not None else None
+
+    # returns the retention policy of the room as a (max_age, max_messages, max_bytes) tuple, None for the limits it has none of its own of
+    def retention(self, room_ID) :
+        room = self.rooms.get(str(room_ID)) or {}
+        return tuple(room.get(column) for column in RETENTION_COLUMNS)
+
+    def add(self, room) :
+        with self.update_lock, self.lock :
+            self.rooms = {**self.rooms, str(room['room_ID']) : room}
+            self.list_frame_cache = None
+
+    def remove(self, room_ID) :
+        with self.update_lock, self.lock :
+            if str(room_ID) in self.rooms :
+                self.rooms = {key : room for key, room in self.rooms.items() if key != str(room_ID)}
+                self.list_frame_cache = None
+
+    # returns the framed response of the "list" action : {"rooms" : [{"room_name" : ..., "room_ID" : ..., "members" : ...}, ...]}
+    # "members" is only there with member_counts
+    def list_frame(self) :
+        self.ensure_loaded()
+        version, counts = self.member_counts() if self.member_counts is not None else (None, None)
+        with self.lock :
+            if self.list_frame_cache is None or self.list_frame_version != version :
+                rooms = [{"room_name" : room['room_name'], "room_ID" : room['room_ID']} for room in self.rooms.values()]
+                if counts is not None :
+                    for room in rooms :
+                        room["members"] = counts.get(str(room["room_ID"]), 0)
+                self.list_frame_cache = encode_frame(json.dumps({"rooms" : rooms}))
+                self.list_frame_version = version
+            return self.list_frame_cache
+
+    def __contains__(self, room_ID) :
+        return str(room_ID) in self.rooms
@@ -0,0 +1,106 @@
+from protocol.framing import FrameDecoder
+
+# the state of one client connection, shared between the consecutive actions of the connection
+# slotted, so that every connected client costs a few pointers instead of a whole dictionary
+class ClientSession :
+    __slots__ = ('client_socket', 'username', 'authenticated', 'room_ID', 'decoder', 'encoding', 'bucket')
+
+    def __init__(self, client_socket) :
+        self.client_socket = client_socket    # the socket (or AsyncClientSocket) the client is connected with
+        self.username = None                  # set by the register and login actions
+        self.authenticated = False            # True once a login or resume action succeeded, only then are session tokens issued
+        self.room_ID = None                   # the room the client is currently in, None outside of rooms
+        self.decoder = FrameDecoder()         # decodes the frames arriving from the client
+        self.encoding = "json"                # the encoding of the message events sent to the client, see protocol/binary.py
+        self.bucket = None                    # the TokenBucket of the actions of the connection, see server/ratelimit.py
+
+# maps every room to the sessions that are currently in it
+# lets broadcast_message and check_inactivity reach the members of a room without scanning every connected client
+# not thread safe on its own, the server only uses it while holding clients_lock
+# on_open(room_ID) and on_close(room_ID), when set, are called as the first session enters a room and as the last one leaves it
+# on_enter(session, room_ID) and on_leave(session, room_ID), when set, are called for every session entering and leaving a room
+# a room that grows past shard_threshold members also gets its members split into shard_count shards (see server/fanout.py) :
+# a session always falls into the same shard of the room (by its hash), so the worker that delivers that shard is always the same
+# the shards are kept in step with the room from then on, until the room is empty, even if it shrinks below the threshold again
+class RoomIndex :
+    def __init__(self, shard_count = 0, shard_threshold = 0) :
+        self.rooms = {}   # room_ID -> set of the sessions in the room
+        self.shards = {}  # room_ID -> the list of shard_count sets of the sessions in the room, for the rooms that were ever large
+        self.shard_count = shard_count
+        self.shard_threshold = shard_threshold
+        self.on_open = None
+        self.on_close = None
+        self.on_enter = None
+        self.on_leave = None
+
+    # moves the session into the room, leaving the room it was in before (if any)
+    def join(self, session, room_ID) :
+        if session.room_ID is not None and session.room_ID != room_ID :
+            self.leave(session)
+        if room_ID not in self.rooms :
+            self.rooms[room_ID] = set()
+            if self.on_open is not None :
+                self.on_open(room_ID)
+        if session.room_ID != room_ID and self.on_enter is not None :
+            self.on_enter(session, room_ID)
+        members = self.rooms[room_ID]
+        members.add(session)
+        session.room_ID = room_ID
+        shards = self.shards.get(room_ID)
+        if shards is not None :
+            shards[hash(session) % self.shard_count].add(session)
+        elif self.shard_count > 1 and len(members) > self.shard_threshold :
+            shards = self.shards[room_ID] = [set() for _ in range(self.shard_count)]
+            for member in members :
+                shards[hash(member) % self.shard_count].add(member)
+
+    # removes the session from its room, the room entry is dropped once it is empty
+    def leave(self, session) :
+        members = self.rooms.get(session.room_ID)
+        if members is not None :
+            if session in members and self.on_leave is not None :
+                self.on_leave(session, session.room_ID)
+            members.discard(session)
+            shards = self.shards.get(session.room_ID)
+            if shards is not None :
+                shards[hash(session) % self.shard_count].discard(session)
+            if not members :
+                del self.rooms[session.room_ID]
+                self.shards.pop(session.room_ID, None)
+                if self.on_close is not None :
+                    self.on_close(session.room_ID)
+        session.room_ID = None
+
+    # returns the sessions in the room (an empty tuple for an unknown room), the caller must not modify it
+    def members(self, room_ID) :
+        return self.rooms.get(room_ID, ())
+
+    # returns the shards of the members of the room (a list of sets), None for a room that is not sharded, the caller must not modify them
+    def member_shards(self, room_ID) :
+        return self.shards.get(room_ID)
+
+    # removes the room and returns the sessions that were in it, all of them leave the room
+    def pop_room(self, room_ID) :
+        members = self.rooms.pop(room_ID, set())
+        self.shards.pop(room_ID, None)
+        for session in members :
+            if self.on_leave is not None :
+                self.on_leave(session, room_ID)
+            session.room_ID = None
+        if members and self.on_close is not None :
+            self.on_close(room_ID)
+        return members
+
+    def clear(self) :
+        for room_ID, members in self.rooms.items() :
+            for session in members :
+                if self.on_leave is not None :
+                    self.on_leave(session, room_ID)
+                session.room_ID = None
+            if self.on_close is not None :
+                self.on_close(room_ID)
+        self.rooms.clear()
+        self.shards.clear()
+
+    def __len__(self) :
+        return len(self.rooms)
@@ -0,0 +1,224 @@
+import os
+import sqlite3
+import threading
+from collections import deque
+
+# the full-text index of the chatting history, behind the "search" action (see handle_search in server/server.py)
+# an SQLite FTS5 table in the directory of the history log : one row per message, with the username and the text of the message
+# indexed in separate columns, so that a search can be limited to the messages of a user
+# the rowid of a row is the room ID shifted left by ROOM_SHIFT bits plus the sequence number of the message : the messages of a room
+# are a single rowid range, and FTS5 walks the matches of a term from the newest message of that range backwards,
+# so a page of results costs the same in a room of a hundred messages and in a room of millions, and the cursor is a rowid bound
+# the history log hands every batch it wrote to add() (see HistoryLog.on_commit), the indexer thread indexes them in one transaction,
+# and on start the index catches up with the messages the log has and the index does not (a new index is built from the whole log)
+# the messages the history compactor drops (see server/compaction.py) are dropped from the index too, through forget()
+SEARCH_FILE = "search.db"
+ROOM_SHIFT = 40                  # the bits of the sequence numbers in a rowid, so up to 2 ** 40 messages in a room
+MAX_ROOM_ID = (1 << (63 - ROOM_SHIFT)) - 1   # the rowids are signed 64 bit integers, the messages of the rooms above this are not indexed
+CATCH_UP_CHUNK = 10000           # the messages read from the history log and indexed in one transaction while catching up
+SEARCH_PAGE_SIZE = 20            # the default number of results of the "search" action
+MAX_SEARCH_PAGE = 100            # the most results a single "search" action returns
+SCHEMA = """
+create virtual table if not exists messages using fts5(username, text, time unindexed, tokenize = 'unicode61 remove_diacritics 2');
+create table if not exists indexed (room_ID text primary key, last_seq integer not null);
+"""
+
+# raised for a search that has nothing to look for
+class SearchError(ValueError) :
+    pass
+
+# splits a message of the history ("username >> text") into the username and the text
+def split_message(message) :
+    username, separator, text = message.partition(" >> ")
+    return (username, text) if separator else ("", message)
+
+# returns the FTS5 query of the search : every word of the query (a word ending in * matches any word it starts), and the username
+# the words are quoted, so that the query syntax of FTS5 never reaches the users, and the words without any letter or digit are dropped
+def match_expression(query, username = None) :
+    terms = []
+    for word in (query or "").split() :
+        prefix = word.endswith("*")
+        word = word.rstrip("*")
+        if any(character.isalnum() for character in word) :
+            terms.append('"' + word.replace('"', '""') + '"' + ("*" if prefix else ""))
+    parts = ["text : (" + " AND ".join(terms) + ")"] if terms else []
+    if username :
+        parts.append('username : "' + username.replace('"', '""') + '"')
+    if not parts :
+        raise SearchError("Nothing to search for!")
+    return " AND ".join(parts)
+
+def room_rowid(room_ID, seq) :
+    return (int(room_ID) << ROOM_SHIFT) + seq
+
+# True if the messages of the room fit in the rowids of the index
+def indexable(room_ID) :
+    return str(room_ID).isdigit() and int(room_ID) <= MAX_ROOM_ID
+
+class SearchIndex :
+    def __init__(self, path = None) :
+        self.path = path                         # the index file, SEARCH_FILE in the directory of the history log by default
+        self.history = None
+        self.connection = None                   # the connection of the indexer thread, the searches use one per thread (see reader)
+        self.local = threading.local()
+        self.condition = threading.Condition()   # guards pending, closed and the counters, the indexer waits on it for new batches
+        self.pending = deque()                   # the (room_ID, seq, timestamp, message) entries waiting to be indexed
+        self.forgotten = {}                      # room_ID -> the first_seq passed to forget(), waiting for the indexer
+        self.closed = False
+        self.last_seq = {}                       # room_ID -> the newest message of the room in the index, only used by the indexer
+        self.unindexable = set()                 # the rooms whose messages were skipped for want of rowids, reported once each
+        self.indexer_thread = None
+        self.counters = {'indexed' : 0, 'batches' : 0, 'caught_up' : 0, 'searches' : 0, 'forgotten' : 0, 'skipped' : 0}
+
+    # opens the index and starts the indexer, which first catches up with the history log
+    def start(self, history) :
+        self.history = history
+        if self.path is None :
+            self.path = os.path.join(history.directory, SEARCH_FILE)
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok = True)
+        self.connection = sqlite3.connect(self.path, check_same_thread = False)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.executescript(SCHEMA)
+        self.last_seq = dict(self.connection.execute("SELECT room_ID, last_seq FROM indexed"))
+        self.indexer_thread = threading.Thread(target = self.index_loop, daemon = True)
+        self.indexer_thread.start()
+
+    # queues the written entries of the history log for the indexer
+    def add(self, batch) :
+        with self.condition :
+            self.pending.extend(batch)
+            self.condition.notify()
+
+    # drops the messages of the room below first_seq from the index, all of them with first_seq None (the room was deleted)
+    def forget(self, room_ID, first_seq = None) :
+        with self.condition :
+            if self.forgotten.get(str(room_ID), 0) is not None :
+                self.forgotten[str(room_ID)] = first_seq
+            self.condition.notify()
+
+    def index_loop(self) :
+        try :
+            self.catch_up()
+        except (sqlite3.Error, OSError) as exception :
+            print(f"Error indexing the chatting history : {exception}")
+        while True :
+            with self.condition :
+                while not self.pending and not self.forgotten and not self.closed :
+                    self.condition.wait()
+                if not self.pending and not self.forgotten and self.closed :
+                    break
+                batch = list(self.pending)
+                self.pending.clear()
+                forgotten = self.forgotten
+                self.forgotten = {}
+            # the drops first : the messages of a deleted room that follow its drop are numbered from 1 again and must stay,
+            # the ones of the batch below a trim are left out, they were dropped from the history along with the others
+            try :
+                self.drop_rows(forgotten)
+                self.index_batch([entry for entry in batch if entry[1] >= (forgotten.get(entry[0]) or 0)])
+            except sqlite3.Error as exception :
+                print(f"Error indexing the chatting history : {exception}")
+        self.connection.close()
+
+    # indexes the messages of the history log that are newer than the index, room by room, CATCH_UP_CHUNK sequence numbers at a time
+    # a room starts at its oldest kept message (the retention may have trimmed the ones the index never saw),
+    # and a chunk with no messages left in it is skipped rather than taken for the end of the room
+    def catch_up(self) :
+        for room_ID in self.history.rooms() :
+            after = max(self.last_seq.get(room_ID, 0), self.history.first_seq(room_ID) - 1)
+            while after < self.history.last_seq(room_ID) :
+                records = self.history.records(room_ID, after_seq = after, before_seq = after + 1 + CATCH_UP_CHUNK)
+                after += CATCH_UP_CHUNK
+                if records :
+                    self.index_batch([(room_ID, seq, timestamp, message) for seq, timestamp, message in records])
+                    with self.condition :
+                        self.counters['caught_up'] += len(records)
+
+    # indexes the entries in one transaction, skipping the ones already indexed (the catch up and the batches can overlap)
+    # and the ones of the rooms beyond MAX_ROOM_ID, which are reported once per room
+    def index_batch(self, batch) :
+        rows = []
+        newest = {}
+        skipped = 0
+        for room_ID, seq, timestamp, message in batch :
+            if seq <= newest.get(room_ID, self.last_seq.get(room_ID, 0)) :
+                continue
+            if not indexable(room_ID) :
+                if room_ID not in self.unindexable :
+                    self.unindexable.add(room_ID)
+                    print(f"The messages of room {room_ID} are not indexed, the search index holds the rooms up to {MAX_ROOM_ID}")
+                skipped += 1
+                continue
+            newest[room_ID] = seq
+            username, text = split_message(message)
+            rows.append((room_rowid(room_ID, seq), username, text, timestamp))
+        if skipped :
+            with self.condition :
+                self.counters['skipped'] += skipped
+        if not rows :
+            return
+        with self.connection :
+            self.connection.executemany("INSERT INTO messages (rowid, username, text, time) VALUES (?, ?, ?, ?)", rows)
+            self.connection.executemany("INSERT OR REPLACE INTO indexed (room_ID, last_seq) VALUES (?, ?)", newest.items())
+        self.last_seq.update(newest)
+        with self.condition :
+            self.counters['indexed'] += len(rows)
+            self.counters['batches'] += 1
+
+    # deletes the rows forget() was asked for, the rows of a room are a single rowid range
+    def drop_rows(self, forgotten) :
+        if not forgotten :
+            return
+        with self.connection :
+            for room_ID, first_seq in forgotten.items() :
+                if not indexable(room_ID) :
+                    continue
+                high = room_rowid(room_ID, ((1 << ROOM_SHIFT) if first_seq is None else first_seq) - 1)
+                self.connection.execute("DELETE FROM messages WHERE rowid BETWEEN ? AND ?", (room_rowid(room_ID, 0), high))
+                if first_seq is None :
+                    self.connection.execute("DELETE FROM indexed WHERE room_ID = ?", (room_ID,))
+        for room_ID, first_seq in forgotten.items() :
+            if first_seq is None :
+                self.last_seq.pop(room_ID, None)
+        with self.condition :
+            self.counters['forgotten'] += len(forgotten)
+
+    # returns the read-only connection of the calling thread, WAL lets the searches run while the indexer writes
+    def reader(self) :
+        connection = getattr(self.local, "connection", None)
+        if connection is None :
+            connection = self.local.connection = sqlite3.connect(f"file:{self.path}?mode=ro", uri = True, check_same_thread = False)
+        return connection
+
+    # returns the messages of the room matching the query (and sent by username, if given) with a sequence number below before,
+    # as (seq, timestamp, message) records, newest first, and the cursor of the next page (None if there are no more results)
+    # raises SearchError if there is nothing to search for
+    def search(self, room_ID, query = "", username = None, before = None, limit = SEARCH_PAGE_SIZE) :
+        expression = match_expression(query, username)
+        with self.condition :
+            self.counters['searches'] += 1
+        if not indexable(room_ID) :
+            return [], None
+        low = room_rowid(room_ID, 0)
+        high = room_rowid(room_ID, (1 << ROOM_SHIFT) - 1 if before is None else max(before - 1, 0))
+        sql = "SELECT rowid, username, text, time FROM messages WHERE messages MATCH ? AND rowid BETWEEN ? AND ?"
+        params = [expression, low, high]
+        if username :
+            sql += " AND username = ?"   # the column match also accepts the usernames with the same words (bob_smith and bob-smith)
+            params.append(username)
+        rows = self.reader().execute(sql + " ORDER BY rowid DESC LIMIT ?", (*params, limit + 1)).fetchall()
+        results = [(rowid - low, timestamp, f"{username} >> {text}" if username else text) for rowid, username, text, timestamp in rows[:limit]]
+        cursor = results[-1][0] if len(rows) > limit else None
+        return results, cursor
+
+    # indexes what is still queued, then stops the indexer
+    def close(self, timeout = None) :
+        with self.condition :
+            self.closed = True
+            self.condition.notify()
+        if self.indexer_thread is not None :
+            self.indexer_thread.join(timeout)
+
+    def metrics(self) :
+        with self.condition :
+            return {**self.counters, 'pending' : len(self.pending)}
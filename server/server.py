@@ -1,312 +1,1105 @@
-import socket
-import threading
-import time
-import mysql.connector
-import json
-from auth.chat_auth import register_user, authenticate_user
-
-clients = {}  # stores the clients and their corresponding info
-clients_lock = threading.Lock()
-room_last_activity = {}  # tracks the last activity time for each room
-is_running = True  # a global flag to control the server state
-ROOM_TIMEOUT = 3600  # a timeout in seconds for inactivity
-
-# creates a TCP socket, binds it to the specified port, and starts listening for incoming connections
-# configured to reuse the address (SO_REUSEADDR)
-# listens on all available network interfaces (0.0.0.0) and the specified port
-# returns the socket object for further use
-def create_socket(port) :
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    host = '0.0.0.0'
-    server_address = (host, port)
-    s.bind(server_address)
-    s.listen(5)
-    print(f"Started listening on {host} : {port}")
-    return s
-
-# establishes and returns a connection to the MySQL database with the given parameters
-# host = "localhost", user = "root", password = "root" and database = "chatroom"
-# uses mysql.connector.connect() to handle the connection
-def get_db_connection() :
-    return mysql.connector.connect(
-        host = "localhost",
-        user = "root",
-        password = "root",
-        database = "chatroom"
-    )
-
-# broadcasts a message to all clients in the specified room, except the sender
-# updates the last activity time of the current room, and then appends the message to a file specific to the room
-# sends the message to all other clients in the same room, handling any exceptions if a client cannot be reached
-def broadcast_message(username, message, room_ID) :
-    with clients_lock :
-        room_last_activity[room_ID] = time.time()
-
-    with open(f"{room_ID}.txt", "a") as chat_file :
-        chat_file.write(message + "\n")
-
-    with clients_lock :
-        for client_socket, client_info in clients.items() :
-            if client_info['room_ID'] == room_ID and client_info['username'] != username :
-                try :
-                    client_socket.send(message.encode('utf-8'))
-                except Exception as exception :
-                    print(f"Error sending the message to {client_info['username']} : {exception}")
-
-# handles user registration, calling the register_user function to attempt the user registration
-# if successful, the method sends a success message with a 200 code
-# if failure, the method sends an error message with a 400 code
-def handle_registration(client_socket, username, password) :
-    if register_user(username, password) :
-        client_socket.send(json.dumps({"code" : 200, "username" : username, "message" : "Registered Successfully!"}).encode())
-    else :
-        client_socket.send(json.dumps({"code" : 400, "message" : "Registration Failed!"}).encode())
-
-# handles user login, calling the authenticate_user function to verify the provided credentials
-# if successful, the method sends a success message with a 200 code
-# if failure, the method sends an error message with a 400 code
-def handle_login(client_socket, username, password) :
-    if authenticate_user(username, password) :
-        client_socket.send(json.dumps({"code" : 200, "username" : username, "message" : "Authentication Successful!"}).encode())
-    else :
-        client_socket.send(json.dumps({"code" : 400, "message" : "Authentication Failed!"}).encode())
-
-# retrieves and returns a list of all available chat rooms from the database
-# queries the rooms table, fetching the names and IDs of the existing rooms
-# the result is returned as a list of dictionaries
-def list_rooms() :
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary = True)
-    cursor.execute("SELECT room_name, room_ID FROM rooms")
-    rooms = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    return rooms
-
-# allows a user to join a chat room by verifying the room ID and password
-# checks the rooms table in the database to find the room with the provided room_ID and room_password
-# if the room exists, the client is added to the clients dictionary, and the last activity time of the room is updated
-# the client receives a success message with a 200 code and a confirmation of joining the room
-# then attempts to load and send the chatting history of the room (from a file named after the room ID)
-# if the room file exists, the chatting history is sent; otherwise, the user is informed
-# if the room does not exist or the credentials are wrong, the client receives an error message with a 400 code
-def join_room(client_socket, username, room_ID, room_password) :
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary = True)
-    cursor.execute("SELECT * FROM rooms WHERE room_ID = %s AND room_password = %s", (room_ID, room_password))
-    room = cursor.fetchone()
-    cursor.close()
-    conn.close()
-
-    if room is not None :
-        with clients_lock :
-            clients[client_socket] = {'username' : username, 'room_ID' : room_ID}
-
-        with clients_lock :
-            room_last_activity[room_ID] = time.time()
-
-        client_socket.send(json.dumps({"code" : 200, "message" : f"Joined room {room_ID} successfully!"}).encode())
-        print(f"{username} joined room {room_ID}.")
-    else :
-        client_socket.send(json.dumps({"code" : 400, "message" : "Invalid room ID or password!"}).encode())
-        return
-
-    try :
-        with open(f"{room_ID}.txt", "r") as chat_file :
-            chat_history = chat_file.read()
-            if chat_history :
-                client_socket.send(f"Chatting History : \n{chat_history}\n".encode())
-            else :
-                client_socket.send(f"No Chatting History\n".encode())
-    except FileNotFoundError :
-        client_socket.send(f"No Chatting History\n".encode())
-
-# creates a new room in the database with the provided room_name, room_description and room_password
-# attempts to insert the room data into the rooms table
-# if successful, the method sends a 200 success message to the client
-# if the room already exists (due to an IntegrityError), the method sends a 400 failure message to the client
-def handle_create_room(client_socket, room_name, room_description, room_password) :
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try :
-        cursor.execute("INSERT INTO rooms (room_name, room_description, room_password) VALUES (%s, %s, %s)",
-                       (room_name, room_description, room_password))
-        conn.commit()
-        client_socket.send(json.dumps({"code" : 200, "message" : "Room Creation Successful!"}).encode())
-    except mysql.connector.IntegrityError :
-        client_socket.send(json.dumps({"code" : 400, "message" : "Room Creation Failed!"}).encode())
-    finally :
-        cursor.close()
-        conn.close()
-
-# deletes a room from the database based on the provided room_ID
-# attempts to delete the room from the rooms table
-# if successful, the method sends a 200 success message to the client
-# if no room is deleted (invalid room_ID), the method sends a 400 failure message to the client
-def handle_delete_room(client_socket, room_ID) :
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM rooms WHERE room_ID = %s", (room_ID,))
-    conn.commit()
-    if cursor.rowcount > 0 :
-        client_socket.send(json.dumps({"code" : 200, "message" : "Room Deletion Successful!"}).encode())
-    else:
-        client_socket.send(json.dumps({"code" : 400, "message" : "Room Deletion Failed!"}).encode())
-    cursor.close()
-    conn.close()
-
-# processes the client actions received over the socket, listening for commands like
-# registering, logging in, joining rooms, creating or deleting rooms, listing rooms, sending messages and disconnecting
-# Registration/Authentication : calls the handle_registration or handle_login functions based on the action
-# Room Operations : joining rooms (join_room), creating rooms (handle_create_room) and deleting rooms (handle_delete_room)
-# Message Sending : sends messages in the room using the broadcast_message function if the client is in a room
-# Listing Available Rooms : returns a list of available rooms with the list_rooms functions
-# Disconnecting : cleans up by removing the client from the clients dictionary and deleting the room activity data
-# if any error occurs (connection issues), the client is disconnected from the server
-def handle_client(client_socket) :
-    username = None
-    room_ID = None
-
-    while True :
-        try :
-            action = client_socket.recv(1024).decode('utf-8')
-            if not action :
-                break
-
-            data = json.loads(action)
-
-            if data["action"] == "register" :
-                username = data["username"]
-                password = data["password"]
-                handle_registration(client_socket, username, password)
-
-            elif data["action"] == "login" :
-                username = data["username"]
-                password = data["password"]
-                handle_login(client_socket, username, password)
-
-            elif data["action"] == "join_room" :
-                room_ID = data["room_ID"]
-                room_password = data["room_password"]
-                join_room(client_socket, username, room_ID, room_password)
-
-            elif data["action"] == "create_room" :
-                room_name = data["room_name"]
-                room_description = data["room_description"]
-                room_password = data["room_password"]
-                handle_create_room(client_socket, room_name, room_description, room_password)
-
-            elif data["action"] == "delete_room" :
-                room_ID = data["room_ID"]
-                handle_delete_room(client_socket, room_ID)
-
-            elif data["action"] == "list" :
-                rooms = list_rooms()
-                client_socket.send(json.dumps({"rooms" : rooms}).encode())
-
-            elif data["action"] == "send_message" :
-                message = data["message"]
-                if room_ID :
-                    formatted_message = f"{data["username"]} >> {message}"
-                    broadcast_message(username, formatted_message, room_ID)
-
-            elif data["action"] == "disconnect" :
-                print(f"{username} disconnected...")
-                # quit_message = f"{username} left the room..."
-                # broadcast_message(username,quit_message,room_ID)
-                with clients_lock :
-                    if client_socket in clients :
-                        del clients[client_socket]
-                        if room_ID in room_last_activity :
-                            del room_last_activity[room_ID]
-
-        except (ConnectionAbortedError, ConnectionResetError) as exception :
-            print(f"Connection error with client {username if username else 'unknown'} : {exception}")
-            break
-        except Exception as exception :
-            print(f"Error handling client {username if username else 'unknown'} : {exception}")
-            break
-
-# checks for inactive rooms and disconnects users from rooms that have been inactive for too long
-# continuously runs in a loop, checking the room_last_activity dictionary for the last activity timestamp of each room
-# if the time since the last activity exceeds a defined timeout (ROOM_TIMEOUT)
-# the function sends a disconnect message to all users in the room and removes them from the clients dictionary
-def check_inactivity() :
-    while is_running :
-        current_time = time.time()
-        with clients_lock :
-            for room_ID, last_activity in list(room_last_activity.items()) :
-                if current_time - last_activity > ROOM_TIMEOUT :
-                    print(f"Room {room_ID} has been inactive for too long. Disconnecting its users...")
-                    for client_socket, client_info in list(clients.items()) :
-                        if client_info['room_ID'] == room_ID :
-                            try :
-                                client_socket.send(f"Room {room_ID} has been inactive for too long. You are being disconnected...\n".encode())
-                                client_socket.close()
-                            except Exception as exception :
-                                print(f"Error sending the message to {client_info['username']} : {exception}")
-                            del clients[client_socket]
-                    del room_last_activity[room_ID]
-        time.sleep(5)
-
-# starts the server, accepting client connections and handling them in separate threads
-# it also monitors for inactivity and allows the server to be shut down
-# the server socket is created on port 7171, and the server begins listening for incoming client connections
-# client handling : a new thread is spawned for each client, calling handle_client to process their requests
-# another thread runs check_inactivity to manage the room activity
-# the server listens for a "shutdown" command, when issued --
-# closes the server socket, notifies all connected clients, disconnects them and clears the clients dictionary
-def start_server() :
-    global is_running
-    port = 7171
-    server_socket = create_socket(port)
-    print("Server started, waiting for connections...")
-
-    def accept_clients() :
-        global is_running
-        while is_running :
-            try :
-                client_sock, addr = server_socket.accept()
-                print(f"\nConnection from {addr}")
-                threading.Thread(target = handle_client, args = (client_sock,)).start()
-            except OSError :
-                if not is_running :
-                    break
-
-    threading.Thread(target = accept_clients, daemon = True).start()
-    threading.Thread(target = check_inactivity, daemon = True).start()
-
-    while True :
-        command = input("Enter 'shutdown' to stop the server : ").strip().lower()
-        if command == "shutdown" :
-            is_running = False
-            server_socket.close()
-            print("Server is shutting down...")
-
-            log_shutdown_time()
-
-            with clients_lock :
-                for client_socket in list(clients.keys()) :
-                    try :
-                        client_socket.send("Server is shutting down. You will be disconnected...\n".encode())
-                    except Exception as exception :
-                        print(f"Error notifying the client : {exception}")
-                    finally :
-                        client_socket.close()
-                clients.clear()
-            print("All clients have been disconnected...")
-            break
-
-def log_shutdown_time() :
-    current_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-    with open("logs.txt", "a") as log_file :
-        log_file.write(f"SERVER was closed at {current_time}.\n")
-
-if __name__ == "__main__" :
-    try :
-        start_server()
-    except KeyboardInterrupt :
-        print("\nServer shut down by a keyboard interrupt...\n")
-    except Exception as e :
+import math
+import os
+import signal
+import socket
+import threading
+import time
+import json
+import argparse
+from auth.chat_auth import register_user, authenticate_user
+from auth import chat_auth, passwords
+from auth import session_tokens
+from auth.session_tokens import issue_token, verify_token
+from protocol.framing import FrameError, encode_frame, negotiate_frame_size, HEADER_SIZE, RECV_BUFFER_SIZE
+from protocol.binary import decode_action, encode_message_event
+from protocol.compression import decompress_payload, maybe_compress, COMPRESSIONS
+from server.rooms import ClientSession, RoomIndex
+from server.fanout import FanoutEngine, FANOUT_WORKERS, SHARD_THRESHOLD
+from server import outbound
+from server.room_catalog import RoomCatalog, RETENTION_COLUMNS
+from server.expiry import ExpiryScheduler
+from server.metrics import metrics
+from server.ratelimit import AdmissionControl, DB_ACTIONS, DB_RETRY_AFTER
+from server.presence import Presence
+from server import ratelimit
+from server.history import HistoryLog, HISTORY_DIR, FLUSH_INTERVAL, FLUSH_BYTES
+from server.history_blocks import HistoryBlocks
+from server.compaction import HistoryCompactor, COMPACT_INTERVAL, ROTATE_AGE
+from server.search import SearchIndex, SearchError, SEARCH_PAGE_SIZE, MAX_SEARCH_PAGE
+from server.cluster import Broker, BrokerClient, RemoteHistory, RemoteSearch, broker_path
+from db.pool import MIN_SIZE, MAX_SIZE, ACQUIRE_TIMEOUT
+from storage.backends import configure_storage, get_storage, STORAGE_BACKENDS
+
+clients = {}  # stores the clients that are in a room and their corresponding session
+fanout = FanoutEngine()  # delivers the messages of the large rooms from its worker threads (see server/fanout.py)
+room_index = RoomIndex(fanout.workers, SHARD_THRESHOLD)  # maps every room to the sessions in it, kept in step with clients
+presence = Presence()  # the users of every room and the member counts, kept in step with room_index (see server/presence.py)
+room_index.on_enter = presence.enter
+room_index.on_leave = presence.leave
+clients_lock = threading.Lock()
+history = HistoryLog()  # the chatting history of every room, written by its own writer thread (see server/history.py), opened by the storage
+history_blocks = HistoryBlocks()  # the compressed blocks of the history, sent to the clients that negotiated compression
+search_index = SearchIndex()  # the full-text index of the history, fed by the history writer (see server/search.py)
+admission = AdmissionControl()  # the rate limits of the connections, users and rooms, and the cap on the DB-bound actions
+broker = None  # the BrokerClient of a worker process in the cluster mode (see start_cluster), None when the server runs alone
+is_running = True  # a global flag to control the server state
+ROOM_TIMEOUT = 3600  # a timeout in seconds for inactivity, for the rooms that have no room_timeout of their own
+EXPIRY_CHECK_INTERVAL = 1  # the most seconds check_inactivity sleeps, so it notices the rooms with shorter timeouts
+LISTEN_BACKLOG = 1024  # the number of pending connections the listening socket can queue
+SERVER_MODES = ("threaded", "asyncio")  # the available ways of serving the client connections
+SHUTDOWN_FLUSH_TIMEOUT = 5  # the time in seconds the clients' writers get to flush the shutdown notice
+HISTORY_PAGE_SIZE = 50  # the number of recent messages sent when joining a room, and the default page of the "history" action
+MAX_HISTORY_PAGE = 500  # the most messages a single "history" action returns
+MAX_SYNC_GAP = 1000  # the most missed messages sent to a rejoining client, a client further behind gets the recent history instead
+
+# the actions that block on the database or on the room history files
+# in the asyncio mode these are run in an executor, so that they never stall the event loop
+# "list" is served from the room catalog and "send_message" only queues the message for the history writer, neither needs one
+BLOCKING_ACTIONS = {"register", "login", "resume", "join_room", "create_room", "delete_room", "history", "search"}
+# a worker of the cluster mode also waits on the broker for the sequence number of every message it sends
+# and for the history metrics of the "stats" action
+CLUSTER_BLOCKING_ACTIONS = BLOCKING_ACTIONS | {"send_message", "stats"}
+# the actions handle_action knows, their latencies are recorded under "action.<action>" (the others under "action.unknown")
+ACTIONS = {"hello", "register", "login", "resume", "join_room", "create_room", "delete_room", "list", "who", "history", "search",
+           "send_message", "stats", "disconnect"}
+ADMIN_USERNAME = "admin"  # the only user allowed to use the "stats" action
+STATS_TOP_ROOMS = 20  # the rooms with the most clients that the "stats" action lists one by one
+
+# creates a TCP socket, binds it to the specified port, and starts listening for incoming connections
+# configured to reuse the address (SO_REUSEADDR), and the port (SO_REUSEPORT) if several processes are to listen on it
+# listens on all available network interfaces (0.0.0.0) and the specified port
+# returns the socket object for further use
+def create_socket(port, reuse_port = False) :
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port :
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    host = '0.0.0.0'
+    server_address = (host, port)
+    s.bind(server_address)
+    s.listen(LISTEN_BACKLOG)
+    print(f"Started listening on {host} : {port}")
+    return s
+
+# frames the payload (see protocol/framing.py) and sends all of it to the client
+# client sockets are QueuedClientSocket or AsyncClientSocket objects, sending only queues the frame for the writer of the connection
+# the JSON responses to an action that carries an "id" (a correlation ID, an integer or a string) carry the same "id",
+# so that a client can keep several requests in flight and match every response to its request (see client/async_client.py)
+# the payload is compressed if the client negotiated compression and the payload is large enough (see protocol/compression.py)
+def send_frame(client_socket, payload) :
+    if isinstance(client_socket, CorrelatedSocket) and payload[:1] == b"{" :
+        payload = client_socket.id_prefix + payload[1:]
+    if client_socket.compression is not None :
+        payload = maybe_compress(payload)
+    client_socket.sendall(encode_frame(payload))
+
+# the client socket handed to the handlers of an action with a correlation ID, send_frame adds the ID to the responses
+# everything else (the outbound queue, the plain text frames of the history) goes to the client socket untouched,
+# and the room index keeps the client socket itself (session.client_socket), the message events carry no ID
+class CorrelatedSocket :
+    __slots__ = ('client_socket', 'id_prefix')
+
+    def __init__(self, client_socket, request_id) :
+        self.client_socket = client_socket
+        self.id_prefix = b'{"id": ' + json.dumps(request_id).encode('utf-8') + b', '   # no response is an empty object
+
+    def sendall(self, data) :
+        self.client_socket.sendall(data)
+
+    def __getattr__(self, name) :
+        return getattr(self.client_socket, name)
+
+# broadcasts a message to all clients in the specified room, except the sender
+# updates the last activity time of the current room, and then appends the message to the history of the room
+# appending only queues the message for the history writer, the sender never waits for the disk
+# sends the message to all other clients in the same room (found through room_index), handling any exceptions if a client cannot be reached
+# the recipients are collected while holding clients_lock, but the message is sent after releasing it
+# sending only queues the message for the writer of every recipient, so a slow client never holds up the sender or the room
+# the message is encoded and framed once per encoding and compression, every recipient gets the same immutable frame, whatever the size of the room
+# the recipients receive it as a {"event" : "message", "room_ID" : ..., "seq" : ..., "message" : ...} event (or its binary encoding),
+# seq being the sequence number the history log gave the message, which the clients use to ask for what they missed
+# in a worker of the cluster mode, the message is published to the broker instead, which numbers it, appends it to the history
+# and passes it on to the other workers (see server/cluster.py), the members connected to this worker get it from deliver_message
+# as the broker client reads the reply, in the order of the sequence numbers with the messages of the other workers
+def broadcast_message(username, message, room_ID) :
+    with clients_lock :
+        room_expiry.touch(room_ID, time.time())
+
+    if broker is None :
+        # the fanout workers deliver the messages of a room in the order they are submitted, so number and submit them in one go
+        with fanout.ordered(room_ID) :
+            seq = history.append(room_ID, message)
+            deliver_message(username, room_ID, seq, message)
+    else :
+        broker.publish(room_ID, message, username)
+
+# sends the message numbered seq to the members of the room connected to this process, except its sender
+# a small room is served right here, the shards of a large room are handed to the fanout workers (see server/fanout.py)
+# the time it takes the caller is recorded as "fanout", the number of recipients as the "fanout_recipients" counter
+def deliver_message(username, room_ID, seq, message) :
+    started = time.perf_counter()
+    with clients_lock :
+        shards = room_index.member_shards(room_ID)
+        if shards is None :
+            members = list(room_index.members(room_ID))
+        else :
+            members = None
+            shards = [tuple(shard) for shard in shards]
+
+    frames = {}   # (the encoding, the compression) -> the frame of the event, built for the first recipient that uses them
+
+    def send(members) :
+        recipients = 0
+        for member in members :
+            if member.username == username :
+                continue
+            recipients += 1
+            key = (member.encoding, member.client_socket.compression)
+            frame = frames.get(key)
+            if frame is None :
+                if member.encoding == "binary" :
+                    payload = encode_message_event(room_ID, seq, message)
+                else :
+                    payload = json.dumps({"event" : "message", "room_ID" : room_ID, "seq" : seq, "message" : message}).encode('utf-8')
+                if key[1] is not None :
+                    payload = maybe_compress(payload)
+                frame = frames[key] = encode_frame(payload)
+            try :
+                member.client_socket.sendall(frame)
+            except Exception as exception :
+                print(f"Error sending the message to {member.username} : {exception}")
+        metrics.count("fanout_recipients", recipients)
+
+    fanout.submit(members, shards, send)
+    metrics.observe("fanout", time.perf_counter() - started)
+
+# handles the "hello" action a client sends right after connecting
+# agrees on the maximum frame size : the smaller of the size the client asked for and MAX_FRAME_SIZE
+# and on the encoding of the message events : binary if the client lists it in its encodings (see protocol/binary.py), JSON otherwise
+# and on the compression of the frames the server sends : zlib if the client lists it in its compressions (see protocol/compression.py)
+# the decoder of this connection starts enforcing the size and the agreed size, encoding and compression are sent back with a 200 code
+# (the response itself is never compressed, the frames after it are)
+def handle_hello(client_socket, session, requested_frame_size, encodings = None, compressions = None) :
+    max_frame_size = negotiate_frame_size(requested_frame_size)
+    session.decoder.max_frame_size = max_frame_size
+    session.encoding = "binary" if isinstance(encodings, list) and "binary" in encodings else "json"
+    compression = next((name for name in COMPRESSIONS if isinstance(compressions, list) and name in compressions), None)
+    session.client_socket.compression = None
+    send_frame(client_socket, json.dumps({"code" : 200, "max_frame_size" : max_frame_size, "encoding" : session.encoding,
+                                          "compression" : compression}).encode())
+    session.client_socket.compression = compression
+
+# handles user registration, calling the register_user function to attempt the user registration
+# if successful, the session takes the username and counts as authenticated,
+# and the method sends a success message with a 200 code and a session token
+# if failure, the method sends an error message with a 400 code, the session keeps the identity it had
+def handle_registration(client_socket, session, username, password) :
+    if register_user(username, password) :
+        session.username = username
+        session.authenticated = True
+        send_frame(client_socket, json.dumps({"code" : 200, "username" : username, "message" : "Registered Successfully!",
+                                              "token" : issue_token(username)}).encode())
+    else :
+        send_frame(client_socket, json.dumps({"code" : 400, "message" : "Registration Failed!"}).encode())
+
+# handles user login, calling the authenticate_user function to verify the provided credentials
+# if successful, the session takes the username and counts as authenticated,
+# and the method sends a success message with a 200 code and a session token (see auth/session_tokens.py)
+# the token lets the client resume its session after a reconnect without logging in again
+# if failure, the method sends an error message with a 400 code, the session keeps the identity it had :
+# the username of a failed login never reaches the session, the tokens or the admin check of handle_stats
+def handle_login(client_socket, session, username, password) :
+    if authenticate_user(username, password) :
+        session.username = username
+        session.authenticated = True
+        send_frame(client_socket, json.dumps({"code" : 200, "username" : username, "message" : "Authentication Successful!",
+                                              "token" : issue_token(username)}).encode())
+    else :
+        send_frame(client_socket, json.dumps({"code" : 400, "message" : "Authentication Failed!"}).encode())
+
+# retrieves and returns all the chat rooms from the storage (see storage/backends.py), used to load the room catalog
+# fetching the IDs, names and passwords, the timeouts and the retention policies of the existing rooms
+# the result is returned as a list of dictionaries
+def load_rooms() :
+    return get_storage().load_rooms()
+
+room_catalog = RoomCatalog(load_rooms)  # the rooms table kept in memory, loaded when the server starts
+room_catalog.member_counts = presence.member_counts  # the list response carries the member count of every room
+room_expiry = ExpiryScheduler(ROOM_TIMEOUT, room_catalog.room_timeout)  # the deadlines of the rooms with activity, see check_inactivity
+
+# tells the history compactor whether a room it has history for was deleted
+# the rooms missing from the catalog are looked up in the database (another server sharing the database may have created them),
+# and a room is kept as long as the database can not be reached
+def room_deleted(room_ID) :
+    if room_ID in room_catalog or not room_catalog.ensure_loaded() :
+        return False
+    try :
+        found = get_storage().room_exists(room_ID)
+    except Exception as exception :
+        print(f"Error looking up room {room_ID} : {exception}")
+        return False
+    return not found
+
+# enforces the retention policies of the rooms on the history log and removes the history of the deleted rooms (see server/compaction.py)
+compactor = HistoryCompactor(history, retention_for = room_catalog.retention, is_deleted = room_deleted)
+
+# allows a user to join a chat room by verifying the room ID and password
+# checks the room catalog (the in-memory copy of the rooms table) for a room with the provided room_ID and room_password
+# if the room exists, the client enters the room (see enter_room)
+# the client receives a success message with a 200 code and a confirmation of joining the room,
+# along with a session token that also names the room, if the client is authenticated
+# then sends the chatting history of the room from the history log, in frames of at most max_frame_size (see sync_mode) :
+# a client rejoining with the last_seq it saw only gets the messages it missed, the others get the last HISTORY_PAGE_SIZE messages
+# the response carries last_seq (the newest message the history covers), the sync mode and,
+# unless only the missed messages are sent, the cursor to pass to the "history" action for the older messages
+# if the room does not exist or the credentials are wrong, the client receives an error message with a 400 code
+def join_room(client_socket, session, room_ID, room_password, last_seq = None) :
+    if room_catalog.check_password(room_ID, room_password) :
+        with clients_lock :
+            enter_room(session, room_ID)
+        upto = history.last_seq(room_ID)
+
+        sync = sync_mode(room_ID, last_seq, upto)
+        page = sync_records(room_ID, sync, last_seq, upto)
+        response = {"code" : 200, "message" : f"Joined room {room_ID} successfully!", "last_seq" : upto, "sync" : sync}
+        if sync != "incremental" :
+            response["cursor"] = history_cursor(room_ID, page)
+        if session.authenticated :
+            response["token"] = issue_token(session.username, room_ID)
+        send_frame(client_socket, json.dumps(response).encode())
+        print(f"{session.username} joined room {room_ID}.")
+    else :
+        send_frame(client_socket, json.dumps({"code" : 400, "message" : "Invalid room ID or password!"}).encode())
+        return
+
+    send_sync_history(client_socket, session, room_ID, sync, page)
+
+# decides which history a client entering a room gets, upto is the newest message of the room when the client entered it
+# (the newer ones reach the client as events), returns the sync mode :
+# "incremental" : the client saw the room up to last_seq, only the messages after it are sent
+# "resync" : the client is more than MAX_SYNC_GAP messages behind, or the messages after last_seq are no longer kept,
+#            or last_seq is from the future (another history), so it gets the last HISTORY_PAGE_SIZE messages and starts over
+# "full" : the client did not say what it saw, so it gets the last HISTORY_PAGE_SIZE messages
+def sync_mode(room_ID, last_seq, upto) :
+    if last_seq is None :
+        return "full"
+    if isinstance(last_seq, int) and history.first_seq(room_ID) - 1 <= last_seq <= upto and upto - last_seq <= MAX_SYNC_GAP :
+        return "incremental"
+    return "resync"
+
+# returns the (seq, timestamp, message) records to send for the sync mode
+# the missed messages are found through the sequence numbers, so the cost of a rejoin depends on what was missed, not on the room age
+def sync_records(room_ID, sync, last_seq, upto) :
+    if sync == "incremental" :
+        return history.records(room_ID, after_seq = last_seq, before_seq = upto + 1)
+    return history.records(room_ID, before_seq = upto + 1, limit = HISTORY_PAGE_SIZE)
+
+# sends the records chosen by sync_records, the missed messages under a "Missed Messages" title
+# a client that negotiated compression gets the history in blocks, see send_history_blocks
+def send_sync_history(client_socket, session, room_ID, sync, page) :
+    title = "Missed Messages : \n" if sync == "incremental" else "Chatting History : \n"
+    if not page :
+        if sync != "incremental" :
+            send_frame(client_socket, f"No Chatting History\n".encode())
+    elif client_socket.compression is not None :
+        send_history_blocks(client_socket, room_ID, page, session.decoder.max_frame_size, title)
+    else :
+        send_history(client_socket, "".join(message + "\n" for _, _, message in page), session.decoder.max_frame_size, title)
+
+# sends the history records to a client that negotiated compression : the title, then the records block by block
+# the full blocks go out as the compressed payloads history_blocks keeps for every client (see server/history_blocks.py),
+# the partial blocks at the ends (and a full block larger than the frame size of the client) are sent like for any client
+def send_history_blocks(client_socket, room_ID, page, max_frame_size, title) :
+    send_frame(client_socket, title.encode())
+    for block, records in history_blocks.split(page) :
+        if block is not None :
+            payload, size = history_blocks.payload(room_ID, block, records)
+            if size <= max_frame_size :
+                client_socket.sendall(encode_frame(payload))
+                continue
+        send_history(client_socket, "".join(message + "\n" for _, _, message in records), max_frame_size, title = "")
+
+# returns the cursor of the page of history records : the sequence number of its oldest message,
+# or None if the page already starts at the oldest message of the room
+def history_cursor(room_ID, page) :
+    if page and page[0][0] > history.first_seq(room_ID) :
+        return page[0][0]
+    return None
+
+# handles the "history" action, which pages backwards through the chatting history of the room the client is in
+# returns up to limit messages (HISTORY_PAGE_SIZE by default, MAX_HISTORY_PAGE at most) sent before the message numbered before,
+# or the most recent ones without a before cursor, as {"code" : 200, "messages" : [{"seq", "time", "message"}, ...], "cursor" : ...}
+# the messages are read through the sparse index of the history log, so a page costs the same wherever it is in the history
+# the oldest messages of the page are left out if the page would not fit into a frame, the cursor then points at the ones kept
+# the client receives an error message with a 400 code if it is not in a room or the cursor or the limit is invalid
+def handle_history(client_socket, session, before, limit) :
+    room_ID = session.room_ID
+    if room_ID is None :
+        send_frame(client_socket, json.dumps({"code" : 400, "message" : "Join a room first!"}).encode())
+        return
+    if limit is None :
+        limit = HISTORY_PAGE_SIZE
+    if not isinstance(limit, int) or limit <= 0 or (before is not None and not isinstance(before, int)) :
+        send_frame(client_socket, json.dumps({"code" : 400, "message" : "Invalid history cursor or limit!"}).encode())
+        return
+
+    page = history.records(room_ID, before_seq = before, limit = min(limit, MAX_HISTORY_PAGE))
+    messages = []
+    budget = session.decoder.max_frame_size - 256
+    for seq, timestamp, message in reversed(page) :
+        entry = {"seq" : seq, "time" : timestamp, "message" : message}
+        budget -= len(json.dumps(entry)) + 2
+        if budget < 0 :
+            break
+        messages.append(entry)
+    messages.reverse()
+
+    if len(messages) < len(page) :
+        cursor = messages[0]["seq"] if messages else page[-1][0]
+    else :
+        cursor = history_cursor(room_ID, page)
+    send_frame(client_socket, json.dumps({"code" : 200, "room_ID" : room_ID, "messages" : messages, "cursor" : cursor}).encode())
+
+# handles the "search" action, which looks for the messages of the room the client is in that contain every word of query
+# (a word ending in * matches the words it starts), only among the messages of username if one is given (see server/search.py)
+# returns up to limit results (SEARCH_PAGE_SIZE by default, MAX_SEARCH_PAGE at most), newest first, sent before the message numbered before,
+# as {"code" : 200, "room_ID" : ..., "results" : [{"seq", "time", "message"}, ...], "cursor" : ...}, the cursor being the before of the next page
+# the client receives an error message with a 400 code if it is not in a room, there is nothing to search for, or the cursor or the limit is invalid
+def handle_search(client_socket, session, query, username, before, limit) :
+    room_ID = session.room_ID
+    if room_ID is None :
+        send_frame(client_socket, json.dumps({"code" : 400, "message" : "Join a room first!"}).encode())
+        return
+    if limit is None :
+        limit = SEARCH_PAGE_SIZE
+    if (not isinstance(limit, int) or limit <= 0 or (before is not None and not isinstance(before, int))
+            or not isinstance(query or "", str) or not isinstance(username or "", str)) :
+        send_frame(client_socket, json.dumps({"code" : 400, "message" : "Invalid search cursor or limit!"}).encode())
+        return
+
+    try :
+        found, cursor = search_index.search(room_ID, query, username, before, min(limit, MAX_SEARCH_PAGE))
+    except SearchError as exception :
+        send_frame(client_socket, json.dumps({"code" : 400, "message" : str(exception)}).encode())
+        return
+    results = []
+    budget = session.decoder.max_frame_size - 256
+    for seq, timestamp, message in found :
+        entry = {"seq" : seq, "time" : timestamp, "message" : message}
+        budget -= len(json.dumps(entry)) + 2
+        if budget < 0 :
+            cursor = results[-1]["seq"] if results else seq
+            break
+        results.append(entry)
+    send_frame(client_socket, json.dumps({"code" : 200, "room_ID" : room_ID, "results" : results, "cursor" : cursor}).encode())
+
+# handles the "who" action : the users in the room (the room the client is in, unless it names another one), served from the presence index
+# returns {"code" : 200, "room_ID" : ..., "count" : ..., "users" : [...]}, count being the member count (as in the list response)
+# and users the usernames, sorted, MAX_WHO_USERS of them at most
+# the client receives an error message with a 400 code if it is not logged in, or names no room or a room that does not exist
+def handle_who(client_socket, session, room_ID) :
+    if not session.authenticated :
+        send_frame(client_socket, json.dumps({"code" : 400, "message" : "Log in first!"}).encode())
+        return
+    room_ID = room_ID or session.room_ID
+    if room_ID is None or room_ID not in room_catalog :
+        send_frame(client_socket, json.dumps({"code" : 400, "message" : "Invalid room ID!"}).encode())
+        return
+    count, users = presence.who(room_ID)
+    send_frame(client_socket, json.dumps({"code" : 200, "room_ID" : room_ID, "count" : count, "users" : users}).encode())
+
+# sends the presence changes the presence index coalesced since its last flush (see server/presence.py) :
+# the members of every room that changed get a {"event" : "presence", "room_ID" : ..., "joined" : [...], "left" : [...], "count" : ...} event,
+# and the sessions watching the room list get one {"event" : "room_counts", "counts" : {room_ID : members}} event with the new counts
+def publish_presence(changes, counts, watchers) :
+    with clients_lock :
+        recipients = [(member, room_ID) for room_ID in changes for member in room_index.rooms.get(room_ID, ())]
+    frames = {}   # (room_ID, the compression) -> the frame of the event of the room, built once like the message events
+    for member, room_ID in recipients :
+        key = (room_ID, member.client_socket.compression)
+        frame = frames.get(key)
+        if frame is None :
+            joined, left, count = changes[room_ID]
+            payload = json.dumps({"event" : "presence", "room_ID" : room_ID, "joined" : joined, "left" : left, "count" : count}).encode()
+            frame = frames[key] = encode_frame(payload if key[1] is None else maybe_compress(payload))
+        try :
+            member.client_socket.sendall(frame)
+        except Exception as exception :
+            print(f"Error sending the presence to {member.username} : {exception}")
+    payload = json.dumps({"event" : "room_counts", "counts" : counts}).encode()
+    frames = {}   # the compression -> the frame of the room_counts event
+    for watcher in watchers :
+        compression = watcher.client_socket.compression
+        frame = frames.get(compression)
+        if frame is None :
+            frame = frames[compression] = encode_frame(payload if compression is None else maybe_compress(payload))
+        try :
+            watcher.client_socket.sendall(frame)
+        except Exception as exception :
+            print(f"Error sending the room counts to {watcher.username} : {exception}")
+
+presence.on_change = publish_presence
+
+# adds the client to the clients dictionary and to the room index (leaving its previous room)
+# and updates the last activity time of the room, the caller must hold clients_lock
+def enter_room(session, room_ID) :
+    clients[session.client_socket] = session
+    room_index.join(session, room_ID)
+    room_expiry.touch(room_ID, time.time())
+
+# handles the "resume" action a reconnecting client sends instead of logging in and joining its room again
+# the session token is verified with the signing secret alone, so resuming never waits on the database
+# if the token is valid, the username is restored and the client enters the room named in the token, if that room still exists
+# the client receives a 200 code with the room it is in (None if it is in no room) and a fresh token
+# messages of the room can reach the client before the response, the client tells them apart by their "event" field
+# a client that sends the last_seq it saw in the room also gets the messages it missed while it was away (see sync_mode)
+# if the token is malformed, forged or expired, the client receives an error message with a 400 code and has to log in
+def handle_resume(client_socket, session, token, last_seq = None) :
+    claims = verify_token(token)
+    if claims is None :
+        send_frame(client_socket, json.dumps({"code" : 400, "message" : "Invalid or expired session token!"}).encode())
+        return
+
+    session.username = claims["username"]
+    session.authenticated = True
+    room_ID = room_key(claims["room_ID"])
+    if room_ID is not None and room_ID in room_catalog :
+        with clients_lock :
+            enter_room(session, room_ID)
+        upto = history.last_seq(room_ID)
+        sync = sync_mode(room_ID, last_seq, upto) if last_seq is not None else None
+    else :
+        room_ID = upto = sync = None
+    send_frame(client_socket, json.dumps({"code" : 200, "username" : session.username, "room_ID" : room_ID,
+                                          "last_seq" : upto, "sync" : sync, "message" : "Session Resumed!",
+                                          "token" : issue_token(session.username, room_ID)}).encode())
+    print(f"{session.username} resumed the session" + (f" in room {room_ID}." if room_ID is not None else "."))
+
+    if sync is not None :
+        send_sync_history(client_socket, session, room_ID, sync, sync_records(room_ID, sync, last_seq, upto))
+
+# sends the chatting history of a room under the title, split into as many frames as needed
+# every frame holds whole lines and stays within the max_frame_size negotiated with the client
+def send_history(client_socket, chat_history, max_frame_size, title = "Chatting History : \n") :
+    chunk = [title]
+    chunk_size = len(chunk[0])
+    for line in chat_history.splitlines(keepends = True) :
+        line_size = len(line.encode('utf-8'))
+        if chunk and chunk_size + line_size > max_frame_size :
+            send_frame(client_socket, "".join(chunk).encode())
+            chunk, chunk_size = [], 0
+        chunk.append(line)
+        chunk_size += line_size
+    if chunk :
+        send_frame(client_socket, "".join(chunk).encode())
+
+# creates a new room in the storage with the provided room_name, room_description and room_password
+# and room_timeout, the seconds (a positive number, not a boolean) of inactivity after which its users are disconnected (None for ROOM_TIMEOUT)
+# and the retention policy of its history : retention_age (the seconds a message is kept), retention_messages (the newest messages kept)
+# and retention_bytes (the disk bytes of its history), None for the limits of the server (see server/compaction.py)
+# attempts to insert the room data into the rooms table
+# if successful, the new room is added to the room catalog (of every worker in the cluster mode) and the method sends a 200 success message to the client
+# if the database refuses the room, the method sends a 400 failure message to the client
+def handle_create_room(client_socket, room_name, room_description, room_password, room_timeout = None,
+                       retention_age = None, retention_messages = None, retention_bytes = None) :
+    if room_timeout is not None and (not isinstance(room_timeout, (int, float)) or isinstance(room_timeout, bool) or not 0 < room_timeout < math.inf) :
+        send_frame(client_socket, json.dumps({"code" : 400, "message" : "Invalid room timeout!"}).encode())
+        return
+    retention = (retention_age, retention_messages, retention_bytes)
+    if any(limit is not None and (not isinstance(limit, int) or isinstance(limit, bool) or limit <= 0) for limit in retention) :
+        send_frame(client_socket, json.dumps({"code" : 400, "message" : "Invalid retention policy!"}).encode())
+        return
+    room = {'room_name' : room_name, 'room_password' : room_password, 'room_timeout' : room_timeout, **dict(zip(RETENTION_COLUMNS, retention))}
+    room_ID = get_storage().add_room({**room, 'room_description' : room_description})
+    if room_ID is None :
+        send_frame(client_socket, json.dumps({"code" : 400, "message" : "Room Creation Failed!"}).encode())
+        return
+    room = {'room_ID' : room_ID, **room}
+    room_catalog.add(room)
+    if broker is not None :
+        broker.send("catalog", change = "add", room = room)
+    send_frame(client_socket, json.dumps({"code" : 200, "message" : "Room Creation Successful!"}).encode())
+
+# deletes a room from the storage based on the provided room_ID
+# attempts to delete the room from the rooms table
+# if successful, the room is removed from the room catalog (of every worker in the cluster mode) and the method sends a 200 success message to the client
+# if no room is deleted (invalid room_ID), the method sends a 400 failure message to the client
+def handle_delete_room(client_socket, room_ID) :
+    if get_storage().delete_room(room_ID) :
+        room_catalog.remove(room_ID)
+        history_blocks.forget(room_ID)
+        if broker is not None :
+            broker.send("catalog", change = "remove", room_ID = room_ID)
+        send_frame(client_socket, json.dumps({"code" : 200, "message" : "Room Deletion Successful!"}).encode())
+    else:
+        send_frame(client_socket, json.dumps({"code" : 400, "message" : "Room Deletion Failed!"}).encode())
+
+# processes a single client action that has already been decoded from JSON (see dispatch_action)
+# the action first goes through the admission control (see server/ratelimit.py) : an action over the rate limits of its connection,
+# its user or its room, or a DB-bound action that finds no free slot, is rejected right away (see send_rejection)
+# records the latency of the action and counts the actions that raised an error
+# used by both the threaded handle_client loop and the asyncio server in server/async_server.py
+def handle_action(client_socket, data, session) :
+    name = data.get("action") if data.get("action") in ACTIONS else "unknown"
+    request_id = data.get("id")
+    if isinstance(request_id, (int, str)) and not isinstance(request_id, bool) :
+        client_socket = CorrelatedSocket(client_socket, request_id)
+    rejection = admission.admit(session, name)
+    if rejection is None and name in DB_ACTIONS and not admission.acquire_db_slot() :
+        rejection = ("database", DB_RETRY_AFTER)
+    if rejection is not None :
+        send_rejection(client_socket, name, *rejection)
+        return
+    started = time.perf_counter()
+    try :
+        dispatch_action(client_socket, data, session)
+    except Exception :
+        metrics.count(f"errors.{name}")
+        raise
+    finally :
+        metrics.observe(f"action.{name}", time.perf_counter() - started)
+        if name in DB_ACTIONS :
+            admission.release_db_slot()
+
+# tells the client that its action was turned away by the admission control, retry_after is in seconds
+# the actions that have a response get a 429 response (a rate limit was hit, scope tells which) or a 503 one (the database is saturated)
+# a send_message, which has no response, gets a "rate_limited" event instead, so it can never be taken for the response of another action
+def send_rejection(client_socket, action, scope, retry_after) :
+    if action == "send_message" :
+        send_frame(client_socket, json.dumps({"event" : "rate_limited", "action" : action, "scope" : scope,
+                                              "retry_after" : retry_after}).encode())
+    elif scope == "database" :
+        send_frame(client_socket, json.dumps({"code" : 503, "message" : "Server busy, try again later!",
+                                              "retry_after" : retry_after}).encode())
+    else :
+        send_frame(client_socket, json.dumps({"code" : 429, "message" : "Too many requests!", "scope" : scope,
+                                              "retry_after" : retry_after}).encode())
+
+# the room IDs arrive the way the clients send them, a number or a string (the binary encoding always sends a string),
+# they are turned into their string form before any index sees them, the form the room catalog and the history key the rooms by
+def room_key(room_ID) :
+    return None if room_ID is None else str(room_ID)
+
+# session is the ClientSession of the connection (username, room_ID and the frame decoder), shared between consecutive actions
+# Negotiation : the "hello" action agrees on the maximum frame size, the encoding and the compression with handle_hello
+# Registration/Authentication : calls the handle_registration or handle_login functions based on the action
+# Resuming : restores the username and the room of a reconnecting client from its session token with handle_resume
+# Room Operations : joining rooms (join_room), creating rooms (handle_create_room) and deleting rooms (handle_delete_room)
+# Message Sending : sends messages in the room using the broadcast_message function if the client is in a room,
+# under the username of the session (a binary send_message does not carry one, the one of a JSON send_message is ignored)
+# Listing Available Rooms : returns the list of available rooms with their member counts, pre-serialized by the room catalog
+# (re-framed to add a correlation ID or compress it), a list with "watch" true (or false) starts (or stops) the room_counts events
+# Presence : returns the users of a room with handle_who
+# Paging the History : returns older messages of the current room with handle_history
+# Searching the History : returns the messages of the current room matching the words (and the user) with handle_search
+# Statistics : returns the server metrics to the admin with handle_stats
+# Disconnecting : cleans up by removing the client from the clients dictionary and the room index, and deleting the room activity data
+# any other action gets an error message with a 400 code, a client waiting for the response to its request is not left hanging
+def dispatch_action(client_socket, data, session) :
+    if data["action"] == "hello" :
+        handle_hello(client_socket, session, data.get("max_frame_size"), data.get("encodings"), data.get("compressions"))
+
+    elif data["action"] == "register" :
+        username = data["username"]
+        password = data["password"]
+        handle_registration(client_socket, session, username, password)
+
+    elif data["action"] == "login" :
+        username = data["username"]
+        password = data["password"]
+        handle_login(client_socket, session, username, password)
+
+    elif data["action"] == "resume" :
+        handle_resume(client_socket, session, data.get("token"), data.get("last_seq"))
+
+    elif data["action"] == "join_room" :
+        room_ID = room_key(data["room_ID"])
+        room_password = data["room_password"]
+        join_room(client_socket, session, room_ID, room_password, data.get("last_seq"))
+
+    elif data["action"] == "create_room" :
+        room_name = data["room_name"]
+        room_description = data["room_description"]
+        room_password = data["room_password"]
+        handle_create_room(client_socket, room_name, room_description, room_password, data.get("room_timeout"),
+                           *(data.get(column) for column in RETENTION_COLUMNS))
+
+    elif data["action"] == "delete_room" :
+        room_ID = room_key(data["room_ID"])
+        handle_delete_room(client_socket, room_ID)
+
+    elif data["action"] == "list" :
+        if data.get("watch") is not None :
+            presence.watch(session, bool(data["watch"]))
+        if isinstance(client_socket, CorrelatedSocket) or client_socket.compression is not None :
+            send_frame(client_socket, room_catalog.list_frame()[HEADER_SIZE:])
+        else :
+            client_socket.sendall(room_catalog.list_frame())
+
+    elif data["action"] == "who" :
+        handle_who(client_socket, session, room_key(data.get("room_ID")))
+
+    elif data["action"] == "history" :
+        handle_history(client_socket, session, data.get("before"), data.get("limit"))
+
+    elif data["action"] == "search" :
+        handle_search(client_socket, session, data.get("query"), data.get("username"), data.get("before"), data.get("limit"))
+
+    elif data["action"] == "stats" :
+        handle_stats(client_socket, session)
+
+    elif data["action"] == "send_message" :
+        if session.room_ID :
+            broadcast_message(session.username, f"{session.username} >> {data['message']}", session.room_ID)
+
+    elif data["action"] == "disconnect" :
+        print(f"{session.username} disconnected...")
+        # quit_message = f"{username} left the room..."
+        # broadcast_message(username,quit_message,room_ID)
+        remove_client(session)
+
+    else :
+        send_frame(client_socket, json.dumps({"code" : 400, "message" : "Unknown action!"}).encode())
+
+# handles the "stats" action, only the admin gets the server metrics (see server_stats), with a 200 code
+# the username checked is the one the session authenticated as : only a successful login, registration or resume sets it
+# (see handle_login), the username a failed login asked for never does
+# the other clients receive an error message with a 400 code
+# in the cluster mode these are the metrics of the worker the admin is connected to (the history log is the shared one)
+def handle_stats(client_socket, session) :
+    if not session.authenticated or session.username != ADMIN_USERNAME :
+        send_frame(client_socket, json.dumps({"code" : 400, "message" : "Permission Denied. Only Admin!"}).encode())
+        return
+    send_frame(client_socket, json.dumps({"code" : 200, "stats" : server_stats()}).encode())
+
+# returns the metrics of this server process : the counters and latency histograms of server/metrics.py
+# (the actions, the database, the history writes and the fanout), the clients in rooms (the STATS_TOP_ROOMS busiest rooms one by one),
+# the depth of the outbound queues, and the state of the history log and of the storage (see storage/backends.py)
+def server_stats() :
+    with clients_lock :
+        room_sizes = {room_ID : len(members) for room_ID, members in room_index.rooms.items()}
+        queue_depths = [len(client_socket.queue.items) for client_socket in clients]
+    busiest = sorted(room_sizes.items(), key = lambda room : room[1], reverse = True)[:STATS_TOP_ROOMS]
+    return {
+        **metrics.snapshot(),
+        "rooms" : {
+            "active" : len(room_sizes),
+            "clients" : sum(room_sizes.values()),
+            "busiest" : {str(room_ID) : size for room_ID, size in busiest},
+        },
+        "outbound" : {
+            "queued" : sum(queue_depths),
+            "deepest_queue" : max(queue_depths, default = 0),
+            **outbound.snapshot_counters(),
+        },
+        "history" : history.metrics(),
+        "history_blocks" : history_blocks.metrics(),
+        "search" : search_index.metrics(),
+        "admission" : admission.metrics(),
+        "presence" : presence.metrics(),
+        "fanout" : fanout.metrics(),
+        "auth" : chat_auth.metrics(),
+        **({"compaction" : compactor.metrics()} if broker is None else {}),
+        "storage" : get_storage().metrics(),
+    }
+
+# removes the client from the clients dictionary and from its room, then stops tracking the activity of that room if it is now empty
+# the client also stops getting the room_counts events (see publish_presence)
+# used by the "disconnect" action and when a connection ends without one
+def remove_client(session) :
+    presence.unwatch(session)
+    with clients_lock :
+        if session.client_socket in clients :
+            del clients[session.client_socket]
+            room_ID = session.room_ID
+            room_index.leave(session)
+            if not room_index.members(room_ID) :
+                room_expiry.forget(room_ID)
+
+# processes the client actions received over the socket, listening for commands like
+# registering, logging in, joining rooms, creating or deleting rooms, listing rooms, sending messages and disconnecting
+# the socket is read into a reusable buffer and fed to the frame decoder of the session
+# every complete frame is decoded (from JSON or binary) and passed to handle_action, so a client can pipeline many actions in one read
+# if any error occurs (connection issues or an oversized frame), the client is disconnected from the server
+# once the connection ends the client is removed from its room and its writer is told to close the socket
+def handle_client(sock) :
+    client_socket = outbound.QueuedClientSocket(sock)
+    session = ClientSession(client_socket)
+    recv_buffer = bytearray(RECV_BUFFER_SIZE)
+    recv_view = memoryview(recv_buffer)
+
+    while True :
+        try :
+            received = client_socket.recv_into(recv_buffer)
+            if not received :
+                break
+
+            for payload in session.decoder.feed(recv_view[:received]) :
+                data = decode_action(decompress_payload(payload, session.decoder.max_frame_size))
+                handle_action(client_socket, data, session)
+
+        except (ConnectionAbortedError, ConnectionResetError) as exception :
+            print(f"Connection error with client {session.username if session.username else 'unknown'} : {exception}")
+            break
+        except FrameError as exception :
+            print(f"Invalid frame from client {session.username if session.username else 'unknown'} : {exception}")
+            break
+        except Exception as exception :
+            print(f"Error handling client {session.username if session.username else 'unknown'} : {exception}")
+            break
+
+    remove_client(session)
+    client_socket.close()
+
+# checks for inactive rooms and disconnects users from rooms that have been inactive for too long
+# continuously runs in a loop, sleeping until the earliest deadline of room_expiry (at most EXPIRY_CHECK_INTERVAL seconds)
+# a room expires once the time since its last activity exceeds its timeout (the room_timeout of the room, ROOM_TIMEOUT by default)
+# only the rooms that are due are looked at, so the time clients_lock is held does not grow with the number of rooms
+# the function sends a disconnect message to all users in the room and removes them from the clients dictionary and the room index
+def check_inactivity() :
+    while is_running :
+        current_time = time.time()
+        with clients_lock :
+            for room_ID in room_expiry.pop_expired(current_time) :
+                print(f"Room {room_ID} has been inactive for too long. Disconnecting its users...")
+                notice = encode_frame(f"Room {room_ID} has been inactive for too long. You are being disconnected...\n")
+                for member in room_index.pop_room(room_ID) :
+                    try :
+                        member.client_socket.sendall(notice)
+                        member.client_socket.close()
+                    except Exception as exception :
+                        print(f"Error sending the message to {member.username} : {exception}")
+                    clients.pop(member.client_socket, None)
+            next_deadline = room_expiry.next_deadline()
+        wait = EXPIRY_CHECK_INTERVAL if next_deadline is None else next_deadline - time.time()
+        time.sleep(min(max(wait, 0.01), EXPIRY_CHECK_INTERVAL))
+
+# starts the server, accepting client connections and handling them either in separate threads or as asyncio tasks
+# it also monitors for inactivity and allows the server to be shut down
+# the storage (its database connections), the room catalog and the history log are started before the first client is accepted
+# the server socket is created on the given port (7171 by default), and the server begins listening for incoming client connections
+# another thread runs check_inactivity to manage the room activity
+# the server listens for a "stats" command, which prints the server metrics (see server_stats), and a "shutdown" command, when issued --
+# closes the server socket, notifies all connected clients, disconnects them (after their writers flush) and clears the clients dictionary
+# then commits the rest of the chatting history to disk
+def start_server(mode = "threaded", port = 7171) :
+    passwords.start()   # forks the password hashing processes, before the threads of the server
+    get_storage().start()
+    room_catalog.start()
+    start_history()
+    fanout.start()
+
+    close_listener = start_listener(mode, port)
+    print(f"Server started in {mode} mode, waiting for connections...")
+    threading.Thread(target = check_inactivity, daemon = True).start()
+    presence.start()
+
+    while True :
+        command = input("Enter 'stats' to see the server metrics or 'shutdown' to stop the server : ").strip().lower()
+        if command == "stats" :
+            print(json.dumps(server_stats(), indent = 2))
+        elif command == "shutdown" :
+            print("Server is shutting down...")
+            log_shutdown_time()
+            disconnect_clients(close_listener)
+            print(f"Storage : {get_storage().metrics()}")
+            get_storage().close()
+            passwords.close()
+            close_history()
+            print(f"History log : {history.metrics()}")
+            break
+
+# starts accepting the client connections on the port, returns the function that stops accepting them
+# threaded mode : a new thread is spawned for each client, calling handle_client to process their requests
+# asyncio mode : every client is a lightweight task on a single event loop (see server/async_server.py)
+# with reuse_port, the other processes of the cluster listen on the same port and the kernel spreads the connections between them
+def start_listener(mode, port, reuse_port = False) :
+    if mode == "asyncio" :
+        from server.async_server import start_async_listener
+        blocking_actions = BLOCKING_ACTIONS if broker is None else CLUSTER_BLOCKING_ACTIONS
+        return start_async_listener(port, LISTEN_BACKLOG, handle_action, blocking_actions, ClientSession, remove_client, reuse_port)
+
+    server_socket = create_socket(port, reuse_port)
+
+    def accept_clients() :
+        while is_running :
+            try :
+                client_sock, addr = server_socket.accept()
+                print(f"\nConnection from {addr}")
+                threading.Thread(target = handle_client, args = (client_sock,)).start()
+            except OSError :
+                if not is_running :
+                    break
+
+    threading.Thread(target = accept_clients, daemon = True).start()
+    return server_socket.close
+
+# stops accepting connections, notifies all connected clients and disconnects them,
+# waiting up to SHUTDOWN_FLUSH_TIMEOUT seconds for their writers to flush the notice
+def disconnect_clients(close_listener) :
+    global is_running
+    is_running = False
+    close_listener()
+    fanout.close(SHUTDOWN_FLUSH_TIMEOUT)   # the messages already handed to the fanout workers are queued before the notice
+
+    notice = encode_frame("Server is shutting down. You will be disconnected...\n")
+    with clients_lock :
+        client_sockets = list(clients.keys())
+        for client_socket in client_sockets :
+            try :
+                client_socket.sendall(notice)
+            except Exception as exception :
+                print(f"Error notifying the client : {exception}")
+            finally :
+                client_socket.close()
+        clients.clear()
+        room_index.clear()
+
+    deadline = time.time() + SHUTDOWN_FLUSH_TIMEOUT
+    for client_socket in client_sockets :
+        client_socket.join(max(0, deadline - time.time()))
+    print("All clients have been disconnected...")
+    print(f"Outbound queues : {outbound.snapshot_counters()}")
+    print(f"Fanout : {fanout.metrics()}")
+
+# runs the server as a cluster of worker processes, to use more than one core
+# the workers are forked first (before any thread is started), every worker listens on the same port with SO_REUSEPORT
+# and serves the clients the kernel hands it, in the given mode, exactly like a single server (see run_worker)
+# the supervisor process owns the history log and runs the broker (see server/cluster.py) :
+# the messages of a room go through the broker, which numbers them, writes them and delivers them to the workers with members in the room
+# the "shutdown" command stops the workers (SIGTERM), waits for them to disconnect their clients, then closes the history log
+def start_cluster(mode = "threaded", port = 7171, workers = 2) :
+    cluster_broker = Broker(broker_path(port), history, search_index)
+    cluster_broker.on_catalog = apply_catalog_change   # the compactor of the supervisor reads the retention policies from its catalog
+    cluster_broker.listen()
+
+    worker_pids = []
+    for number in range(workers) :
+        pid = os.fork()
+        if pid == 0 :
+            cluster_broker.server_socket.close()
+            code = 1
+            try :
+                run_worker(mode, port, number)
+                code = 0
+            except Exception as exception :
+                print(f"Worker {number} failed : {exception}")
+            finally :
+                os._exit(code)
+        worker_pids.append(pid)
+
+    get_storage().start()
+    room_catalog.start()
+    start_history()
+    cluster_broker.start()
+    print(f"Server started with {workers} {mode} workers, waiting for connections...")
+
+    try :
+        while True :
+            command = input("Enter 'stats' to see the broker metrics or 'shutdown' to stop the server : ").strip().lower()
+            if command == "stats" :
+                print(json.dumps({**metrics.snapshot(), "broker" : cluster_broker.metrics(), "history" : history.metrics(),
+                                  "search" : search_index.metrics(), "compaction" : compactor.metrics()}, indent = 2))
+            elif command == "shutdown" :
+                print("Server is shutting down...")
+                log_shutdown_time()
+                break
+    finally :
+        for pid in worker_pids :
+            try :
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError :
+                pass
+        for pid in worker_pids :
+            os.waitpid(pid, 0)
+        print(f"Broker : {cluster_broker.metrics()}")
+        cluster_broker.close()
+        get_storage().close()
+        close_history()
+        print(f"History log : {history.metrics()}")
+
+# the main loop of a worker process of the cluster, until the supervisor stops it or goes away
+# the worker reads the history through the broker (RemoteHistory), subscribes to the rooms its clients are in,
+# hands the messages of the other workers to its clients and applies the room catalog changes they make
+def run_worker(mode, port, number) :
+    global history, search_index, broker
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame : stopping.set())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)   # the supervisor owns the terminal, a ^C stops it and then the workers
+    passwords.start()   # forks the password hashing processes, before the threads of the worker
+
+    broker = BrokerClient(broker_path(port), deliver_remote_message, apply_catalog_change, stopping.set, presence.apply_remote)
+    history = RemoteHistory(broker)
+    search_index = RemoteSearch(broker)
+    room_index.on_open = broker.subscribe
+    room_index.on_close = broker.unsubscribe
+    presence.on_local_changes = lambda changes : broker.send("presence", changes = changes)
+
+    get_storage().start()
+    room_catalog.start()
+    fanout.start()
+    close_listener = start_listener(mode, port, reuse_port = True)
+    print(f"Worker {number} (pid {os.getpid()}) started in {mode} mode")
+    threading.Thread(target = check_inactivity, daemon = True).start()
+    presence.start()
+
+    while not stopping.wait(1) :
+        pass
+    disconnect_clients(close_listener)
+    print(f"Worker {number} storage : {get_storage().metrics()}")
+    get_storage().close()
+    passwords.close()
+    broker.close()
+
+# a message published in the cluster, by this worker or another one, for a room this worker has members in
+def deliver_remote_message(username, room_ID, seq, message) :
+    with clients_lock :
+        room_expiry.touch(room_ID, time.time())
+    deliver_message(username, room_ID, seq, message)
+
+# a room created or deleted through another worker of the cluster
+def apply_catalog_change(change) :
+    if change["change"] == "add" :
+        room_catalog.add(change["room"])
+    else :
+        room_catalog.remove(change["room_ID"])
+        history_blocks.forget(change["room_ID"])
+
+# starts the history writer, then imports the history files of the old format ({room_ID}.txt, one message per line)
+# of the rooms that have no history log yet, and starts the search index, which catches up with the log in the background,
+# and the history compactor, which drops the messages it trims from the search index and the compressed history blocks too
+def start_history() :
+    history.on_commit = search_index.add
+    history.start()
+    for room_ID in list(room_catalog.rooms) :
+        imported = history.import_legacy(room_ID, legacy_history_path(room_ID))
+        if imported :
+            print(f"Imported {imported} messages of room {room_ID} into the history log")
+    search_index.start(history)
+    compactor.on_trim = forget_history
+    compactor.legacy_path = legacy_history_path
+    compactor.start()
+
+# the messages of the room below first_seq are gone, all of them with first_seq None
+def forget_history(room_ID, first_seq = None) :
+    search_index.forget(room_ID, first_seq)
+    history_blocks.forget(room_ID, first_seq)
+
+# stops the history compactor, commits the rest of the chatting history and stops the search index
+def close_history() :
+    compactor.close()
+    history.close()
+    search_index.close()
+
+def legacy_history_path(room_ID) :
+    return f"{room_ID}.txt"
+
+def log_shutdown_time() :
+    current_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+    with open("logs.txt", "a") as log_file :
+        log_file.write(f"SERVER was closed at {current_time}.\n")
+
+if __name__ == "__main__" :
+    parser = argparse.ArgumentParser(description = "Chatroom server")
+    parser.add_argument("--mode", choices = SERVER_MODES, default = "threaded",
+                        help = "serve the clients with one thread per connection or with a single asyncio event loop")
+    parser.add_argument("--port", type = int, default = 7171, help = "the port to listen on")
+    parser.add_argument("--room-timeout", type = float, default = ROOM_TIMEOUT,
+                        help = "the seconds of inactivity after which the users of a room are disconnected, unless the room has its own")
+    parser.add_argument("--workers", type = int, default = 0,
+                        help = "serve the clients with this many processes sharing the port (SO_REUSEPORT), 0 for a single process")
+    parser.add_argument("--queue-size", type = int, default = outbound.max_items,
+                        help = "the number of messages that can wait to be written to a single client")
+    parser.add_argument("--queue-bytes", type = int, default = outbound.max_bytes,
+                        help = "the number of bytes that can wait to be written to a single client under the coalesce policy")
+    parser.add_argument("--overflow-policy", choices = outbound.OVERFLOW_POLICIES, default = outbound.overflow_policy,
+                        help = "what to do with a client whose outbound queue is full")
+    parser.add_argument("--fanout-workers", type = int, default = FANOUT_WORKERS,
+                        help = "the threads that deliver the messages of the large rooms, 0 to deliver every message from the sender's thread")
+    parser.add_argument("--fanout-threshold", type = int, default = SHARD_THRESHOLD,
+                        help = "the members a room needs before its messages go to the fanout workers")
+    parser.add_argument("--hash-workers", type = int, default = passwords.HASH_WORKERS,
+                        help = "the processes that hash the passwords, 0 to hash them on the threads of the connections")
+    parser.add_argument("--hash-cost", type = int, default = passwords.SCRYPT_LOG_N,
+                        help = "the scrypt cost of the new password hashes, as the base 2 logarithm of n")
+    parser.add_argument("--login-failure-ttl", type = float, default = chat_auth.FAILURE_TTL,
+                        help = "the seconds a failed login is remembered, the same login fails right away until then")
+    parser.add_argument("--login-max-failures", type = int, default = chat_auth.MAX_FAILURES,
+                        help = "the failed logins of a username, within the failure TTL, after which its logins fail right away")
+    parser.add_argument("--db", choices = STORAGE_BACKENDS, default = "mysql",
+                        help = "the MySQL database of dump.sql, a SQLite stand-in of it inside the server (see db/standin.py), "
+                               "or a SQLite file holding the chatting history too (see storage/backends.py)")
+    parser.add_argument("--db-path", default = None,
+                        help = "the file of the stand-in database (a new temporary file by default) or of the SQLite database (chatroom.db)")
+    parser.add_argument("--db-pool-min", type = int, default = MIN_SIZE,
+                        help = "the database connections opened at startup and kept open while idle")
+    parser.add_argument("--db-pool-max", type = int, default = MAX_SIZE,
+                        help = "the most database connections open at the same time")
+    parser.add_argument("--db-acquire-timeout", type = float, default = ACQUIRE_TIMEOUT,
+                        help = "the seconds an action waits for a free database connection")
+    parser.add_argument("--connection-rate", type = float, default = ratelimit.CONNECTION_RATE,
+                        help = "the actions per second a connection can send, 0 for no limit")
+    parser.add_argument("--connection-burst", type = float, default = ratelimit.CONNECTION_BURST,
+                        help = "the actions a connection can send at once, above its rate")
+    parser.add_argument("--user-message-rate", type = float, default = ratelimit.USER_MESSAGE_RATE,
+                        help = "the messages per second a user can send over all of its connections, 0 for no limit")
+    parser.add_argument("--user-message-burst", type = float, default = ratelimit.USER_MESSAGE_BURST,
+                        help = "the messages a user can send at once, above its rate")
+    parser.add_argument("--room-message-rate", type = float, default = ratelimit.ROOM_MESSAGE_RATE,
+                        help = "the messages per second a room accepts from all of its members, 0 for no limit")
+    parser.add_argument("--room-message-burst", type = float, default = ratelimit.ROOM_MESSAGE_BURST,
+                        help = "the messages a room accepts at once, above its rate")
+    parser.add_argument("--max-db-actions", type = int, default = ratelimit.MAX_DB_ACTIONS,
+                        help = "the logins, registrations and room changes running at the same time, 0 for no limit")
+    parser.add_argument("--db-admission-timeout", type = float, default = ratelimit.DB_ADMISSION_TIMEOUT,
+                        help = "the seconds such an action waits for a slot before it is rejected as busy")
+    parser.add_argument("--history-dir", default = HISTORY_DIR, help = "the directory of the room history logs")
+    parser.add_argument("--history-flush-interval", type = float, default = FLUSH_INTERVAL,
+                        help = "the seconds a message can wait before the history writer commits it to disk")
+    parser.add_argument("--history-flush-bytes", type = int, default = FLUSH_BYTES,
+                        help = "the waiting message bytes that make the history writer commit early")
+    parser.add_argument("--retention-age", type = int, default = None,
+                        help = "the seconds a message is kept in the history of a room, unless the room has its own limit (forever by default)")
+    parser.add_argument("--retention-messages", type = int, default = None,
+                        help = "the newest messages kept in the history of a room, unless the room has its own limit (all by default)")
+    parser.add_argument("--retention-bytes", type = int, default = None,
+                        help = "the disk bytes the history of a room is kept to, unless the room has its own limit (no limit by default)")
+    parser.add_argument("--compact-interval", type = float, default = COMPACT_INTERVAL,
+                        help = "the seconds between two passes of the history compactor")
+    parser.add_argument("--rotate-age", type = float, default = ROTATE_AGE,
+                        help = "the seconds after which the history segment a room writes to is sealed and archived")
+    parser.add_argument("--session-ttl", type = int, default = session_tokens.TOKEN_TTL,
+                        help = "the seconds a session token stays valid (the signing secret is read from CHAT_SESSION_SECRET)")
+    parser.add_argument("--room-catalog-ttl", type = float, default = None,
+                        help = "reload the room catalog from the database every this many seconds (never by default)")
+    args = parser.parse_args()
+    if args.workers and not (hasattr(os, "fork") and hasattr(socket, "SO_REUSEPORT")) :
+        parser.error("--workers needs fork() and SO_REUSEPORT, which this platform does not have")
+    outbound.configure(args.queue_size, args.queue_bytes, args.overflow_policy)
+    fanout.workers = room_index.shard_count = args.fanout_workers
+    room_index.shard_threshold = args.fanout_threshold
+    fanout.observe = metrics.observe
+    storage = configure_storage(args.db, args.db_path, observe = metrics.observe, min_size = args.db_pool_min, max_size = args.db_pool_max,
+                                acquire_timeout = args.db_acquire_timeout)
+    history = storage.open_history(args.history_dir, args.history_flush_interval, args.history_flush_bytes)
+    compactor.history = history
+    room_catalog.ttl = args.room_catalog_ttl
+    room_expiry.timeout = args.room_timeout
+    history.observe = metrics.observe
+    admission.configure((args.connection_rate, args.connection_burst), (args.user_message_rate, args.user_message_burst),
+                        (args.room_message_rate, args.room_message_burst), args.max_db_actions, args.db_admission_timeout)
+    compactor.retention = (args.retention_age, args.retention_messages, args.retention_bytes)
+    compactor.interval = args.compact_interval
+    compactor.rotate_age = args.rotate_age
+    session_tokens.configure(ttl = args.session_ttl)
+    passwords.configure(args.hash_workers, args.hash_cost)
+    chat_auth.configure(args.login_failure_ttl, args.login_max_failures)
+    try :
+        if args.workers :
+            start_cluster(args.mode, args.port, args.workers)
+        else :
+            start_server(args.mode, args.port)
+    except KeyboardInterrupt :
+        print("\nServer shut down by a keyboard interrupt...\n")
+    except Exception as e :
         print(f"Something went wrong. Shutting down...{e}")
\ No newline at end of file
@@ -0,0 +1,52 @@
+import threading
+from db import standin
+from storage.sqlite_storage import SQLiteStorage, SQLITE_PATH
+
+# where the server keeps its users, its rooms and the chatting history of the rooms, behind one interface :
+#   add_user(username, password) adds a user, returns False if the username is already in use
+#   find_user(username) returns the user as a {"user_ID", "username", "password"} dictionary, None if there is no such user
+#   set_password(username, password) replaces the stored password of the user (the passwords are hashed by the auth module)
+#   load_rooms() returns every room as a dictionary with room_ID, room_name, room_password, room_timeout and the retention columns
+#   room_exists(room_ID) returns True if the room is in the database
+#   add_room(room) inserts the room dictionary (room_name, room_description, room_password, room_timeout and the retention columns),
+#   returns its room_ID, None if the database refused it
+#   delete_room(room_ID) returns False if there was no such room
+#   open_history(directory, flush_interval, flush_bytes) returns the history log of the messages, with the interface of the HistoryLog
+#   start() opens the connections, close() closes them, metrics() returns the state of the backend
+# the database errors are raised as they are, the callers that catch every error (handle_action, the auth module) handle them
+# only the "mysql" backend needs mysql.connector, it is imported when that backend is created
+# the backends :
+#   "mysql" : the MySQL database of dump.sql, the history in segment files (see storage/mysql_storage.py and server/history.py)
+#   "standin" : the same on the SQLite stand-in of the MySQL database, inside the server (see db/standin.py)
+#   "sqlite" : everything in one SQLite file in WAL mode, the history included (see storage/sqlite_storage.py)
+STORAGE_BACKENDS = ("mysql", "standin", "sqlite")
+
+storage = None   # the storage shared by the server and the auth module, created by configure_storage or on first use
+storage_lock = threading.Lock()
+
+# replaces the shared storage with a new one of the backend and returns it
+# path is the file of the standin and sqlite backends (a new temporary file and SQLITE_PATH by default),
+# pool_settings are the settings of the connection pool (see db/pool.py)
+def configure_storage(backend = "mysql", path = None, **pool_settings) :
+    global storage
+    with storage_lock :
+        if storage is not None :
+            storage.close()
+        if backend == "sqlite" :
+            storage = SQLiteStorage(path or SQLITE_PATH, **pool_settings)
+        elif backend == "standin" :
+            from storage.mysql_storage import MySQLStorage
+            print(f"Using the stand-in database {standin.create_database(path)}")
+            storage = MySQLStorage(driver = standin, connect = standin.connect, **pool_settings)
+        else :
+            from storage.mysql_storage import MySQLStorage
+            storage = MySQLStorage(**pool_settings)
+        return storage
+
+def get_storage() :
+    global storage
+    with storage_lock :
+        if storage is None :
+            from storage.mysql_storage import MySQLStorage
+            storage = MySQLStorage()
+        return storage
@@ -0,0 +1,102 @@
+from db.pool import configure_pool
+from server.history import HistoryLog
+
+UNKNOWN_COLUMN = 1054   # the MySQL error of a query naming a column the table does not have (ER_BAD_FIELD_ERROR)
+
+# the storage of the server on the MySQL database of dump.sql (see storage/backends.py for the interface)
+# the users and the rooms are in its tables, queried through the connection pool shared by the whole process (see db/pool.py),
+# the chatting history of the rooms is in the segment files of a HistoryLog (see server/history.py)
+# pool_settings are the settings of the pool, connect among them : standin.connect runs the same queries on the SQLite stand-in (see db/standin.py)
+# driver is the module whose errors the queries raise, mysql.connector (imported only then) unless another one is given,
+# the stand-in module for its connections
+class MySQLStorage :
+    def __init__(self, driver = None, **pool_settings) :
+        if driver is None :
+            import mysql.connector as driver
+        self.driver = driver
+        self.pool = configure_pool(**pool_settings)
+
+    # opens the idle connections of the pool
+    def start(self) :
+        self.pool.start()
+
+    # runs the query on a connection of the pool, returns its rows (as dictionaries), or its rowcount and lastrowid if commit is True
+    def execute(self, query, params = (), commit = False) :
+        conn = self.pool.acquire()
+        try :
+            cursor = conn.cursor(dictionary = True)
+            try :
+                cursor.execute(query, params)
+                if commit :
+                    conn.commit()
+                    return cursor.rowcount, cursor.lastrowid
+                return cursor.fetchall()
+            finally :
+                cursor.close()
+        finally :
+            conn.close()
+
+    # adds the user, returns False if the username is already in use
+    def add_user(self, username, password) :
+        try :
+            self.execute("INSERT INTO users (username, password) VALUES (%s, %s)", (username, password), commit = True)
+            return True
+        except self.driver.IntegrityError :
+            return False
+
+    def find_user(self, username) :
+        rows = self.execute("SELECT user_ID, username, password FROM users WHERE username = %s", (username,))
+        return rows[0] if rows else None
+
+    def set_password(self, username, password) :
+        self.execute("UPDATE users SET password = %s WHERE username = %s", (password, username), commit = True)
+
+    # a database created from an older dump.sql has none of the columns added since (see upgrade.sql) :
+    # its rooms are loaded without them, as rooms with the default timeout and retention, until it is upgraded
+    def load_rooms(self) :
+        try :
+            return self.execute("SELECT room_ID, room_name, room_password, room_timeout, retention_age, retention_messages, "
+                                "retention_bytes FROM rooms")
+        except self.driver.ProgrammingError as exception :
+            if exception.errno != UNKNOWN_COLUMN :
+                raise
+            print(f"The rooms table predates the room timeouts and retention policies, run upgrade.sql : {exception}")
+            return self.execute("SELECT room_ID, room_name, room_password FROM rooms")
+
+    def room_exists(self, room_ID) :
+        return bool(self.execute("SELECT room_ID FROM rooms WHERE room_ID = %s", (room_ID,)))
+
+    # inserts the room, returns its room_ID, None if the database refused it
+    # on a rooms table that predates the room timeouts and retention policies (see load_rooms), the room is inserted without them :
+    # it keeps them in the room catalog until the catalog is reloaded, and has the defaults after that
+    def add_room(self, room) :
+        try :
+            try :
+                _, room_ID = self.execute("INSERT INTO rooms (room_name, room_description, room_password, room_timeout, "
+                                          "retention_age, retention_messages, retention_bytes) VALUES (%s, %s, %s, %s, %s, %s, %s)",
+                                          (room['room_name'], room.get('room_description'), room['room_password'], room.get('room_timeout'),
+                                           room.get('retention_age'), room.get('retention_messages'), room.get('retention_bytes')),
+                                          commit = True)
+            except self.driver.ProgrammingError as exception :
+                if exception.errno != UNKNOWN_COLUMN :
+                    raise
+                print(f"The rooms table predates the room timeouts and retention policies, run upgrade.sql : {exception}")
+                _, room_ID = self.execute("INSERT INTO rooms (room_name, room_description, room_password) VALUES (%s, %s, %s)",
+                                          (room['room_name'], room.get('room_description'), room['room_password']), commit = True)
+            return room_ID
+        except self.driver.IntegrityError :
+            return None
+
+    # deletes the room, returns False if there was no such room
+    def delete_room(self, room_ID) :
+        deleted, _ = self.execute("DELETE FROM rooms WHERE room_ID = %s", (room_ID,), commit = True)
+        return deleted > 0
+
+    def open_history(self, directory, flush_interval, flush_bytes) :
+        return HistoryLog(directory, flush_interval, flush_bytes)
+
+    def close(self) :
+        self.pool.close()
+
+    def metrics(self) :
+        return {"backend" : "mysql", "pool" : self.pool.metrics()}
@@ -0,0 +1,422 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from db.pool import ConnectionPool
+from db.standin import SCHEMA as TABLES
+from server.history import HISTORY_DIR, FLUSH_INTERVAL, FLUSH_BYTES, RECORD, SEAL_TIMEOUT
+
+# the storage of the server in a single SQLite file, the chatting history included (see storage/backends.py for the interface)
+# for a server running alone on one machine, or a cluster of workers on it : nothing to install or run besides the server
+# the file is in WAL mode, so the readers never wait for the writer and a commit appends to the log instead of rewriting pages
+# the connections come from a ConnectionPool (see db/pool.py) and keep their prepared statements : sqlite3 caches the compiled
+# statement of every query text it runs on a connection (cached_statements), and the queries below are constants,
+# so a query is parsed and planned once per connection, then only bound and stepped
+# the messages are inserted by the writer thread of the SQLiteHistory in batches, one transaction and one sync per batch
+SQLITE_PATH = "chatroom.db"
+BUSY_TIMEOUT = 30.0          # the seconds a query waits for another connection (or process) that is writing
+SYNCHRONOUS = "FULL"         # every commit is synced, like the batches of the HistoryLog, NORMAL only syncs at checkpoints
+CACHED_STATEMENTS = 256      # the prepared statements a connection keeps
+
+# the tables of the history, in the same file as the users and the rooms (the tables of the stand-in database, see db/standin.py)
+# a room's messages are clustered by sequence number (a WITHOUT ROWID table keyed by room and seq), so a page of history is a range scan
+# history_rooms keeps the first and last sequence numbers of every room, so that the numbering survives a restart
+# even when the retention policy dropped every message of the room
+HISTORY_TABLES = """
+create table if not exists messages (
+    room_ID text not null,
+    seq integer not null,
+    time real not null,
+    message text not null,
+    primary key (room_ID, seq)
+) without rowid;
+create table if not exists history_rooms (
+    room_ID text primary key,
+    first_seq integer not null,
+    last_seq integer not null
+) without rowid;
+"""
+
+INSERT_USER = "INSERT INTO users (username, password) VALUES (?, ?)"
+SELECT_USER = "SELECT user_ID, username, password FROM users WHERE username = ?"
+UPDATE_PASSWORD = "UPDATE users SET password = ? WHERE username = ?"
+SELECT_ROOMS = "SELECT room_ID, room_name, room_password, room_timeout, retention_age, retention_messages, retention_bytes FROM rooms"
+SELECT_ROOM = "SELECT room_ID FROM rooms WHERE room_ID = ?"
+INSERT_ROOM = ("INSERT INTO rooms (room_name, room_description, room_password, room_timeout, retention_age, retention_messages, retention_bytes) "
+               "VALUES (?, ?, ?, ?, ?, ?, ?)")
+DELETE_ROOM = "DELETE FROM rooms WHERE room_ID = ?"
+
+INSERT_MESSAGE = "INSERT INTO messages (room_ID, seq, time, message) VALUES (?, ?, ?, ?)"
+UPDATE_HISTORY_ROOM = ("INSERT INTO history_rooms (room_ID, first_seq, last_seq) VALUES (?, ?, ?) "
+                       "ON CONFLICT (room_ID) DO UPDATE SET last_seq = max(last_seq, excluded.last_seq)")
+SELECT_HISTORY_ROOMS = "SELECT room_ID, first_seq, last_seq FROM history_rooms"
+SELECT_RECORDS = "SELECT seq, time, message FROM messages WHERE room_ID = ? AND seq >= ? AND seq < ? ORDER BY seq"
+SELECT_FIRST_NEWER = "SELECT seq FROM messages WHERE room_ID = ? AND time >= ? ORDER BY seq LIMIT 1"
+SELECT_FIRST_OVER = ("SELECT seq FROM (SELECT seq, sum(length(CAST(message AS BLOB)) + ?) OVER (ORDER BY seq DESC) AS total "
+                     "FROM messages WHERE room_ID = ?) WHERE total > ? LIMIT 1")
+TRIM_MESSAGES = "DELETE FROM messages WHERE room_ID = ? AND seq < ?"
+TRIM_HISTORY_ROOM = "UPDATE history_rooms SET first_seq = max(first_seq, ?) WHERE room_ID = ?"
+DROP_MESSAGES = "DELETE FROM messages WHERE room_ID = ?"
+DROP_HISTORY_ROOM = "DELETE FROM history_rooms WHERE room_ID = ?"
+
+# creates the tables in the file at path, unless they exist, along with the admin user and the test room of dump.sql
+# the pages freed by the messages the retention policies drop are given back to the file system (auto_vacuum, see SQLiteHistory.trim)
+def create_database(path) :
+    connection = sqlite3.connect(path, timeout = BUSY_TIMEOUT)
+    try :
+        connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.executescript(TABLES + HISTORY_TABLES)
+        connection.commit()
+    finally :
+        connection.close()
+
+# opens a connection to the database, shared between the threads through the pool
+def connect(path, synchronous = SYNCHRONOUS) :
+    connection = sqlite3.connect(path, timeout = BUSY_TIMEOUT, check_same_thread = False, cached_statements = CACHED_STATEMENTS)
+    connection.execute(f"PRAGMA synchronous = {synchronous}")
+    return connection
+
+class SQLiteStorage :
+    # the database is created right away : in the cluster mode that is before the workers are forked, the connections are opened after
+    def __init__(self, path = SQLITE_PATH, synchronous = SYNCHRONOUS, **pool_settings) :
+        self.path = path
+        self.synchronous = synchronous
+        create_database(path)
+        self.pool = ConnectionPool(connect = lambda : connect(path, synchronous), **pool_settings)
+
+    def start(self) :
+        self.pool.start()
+
+    # runs the query on a connection of the pool, returns its rows (as dictionaries), or its rowcount and lastrowid if commit is True
+    def execute(self, query, params = (), commit = False) :
+        conn = self.pool.acquire()
+        try :
+            cursor = conn.cursor()
+            cursor.row_factory = sqlite3.Row
+            try :
+                cursor.execute(query, params)
+                if commit :
+                    conn.commit()
+                    return cursor.rowcount, cursor.lastrowid
+                return [dict(row) for row in cursor.fetchall()]
+            finally :
+                cursor.close()
+        finally :
+            conn.close()
+
+    # adds the user, returns False if the username is already in use
+    def add_user(self, username, password) :
+        try :
+            self.execute(INSERT_USER, (username, password), commit = True)
+            return True
+        except sqlite3.IntegrityError :
+            return False
+
+    def find_user(self, username) :
+        rows = self.execute(SELECT_USER, (username,))
+        return rows[0] if rows else None
+
+    def set_password(self, username, password) :
+        self.execute(UPDATE_PASSWORD, (password, username), commit = True)
+
+    def load_rooms(self) :
+        return self.execute(SELECT_ROOMS)
+
+    def room_exists(self, room_ID) :
+        return bool(self.execute(SELECT_ROOM, (room_ID,)))
+
+    # inserts the room, returns its room_ID, None if the database refused it
+    def add_room(self, room) :
+        try :
+            _, room_ID = self.execute(INSERT_ROOM, (room['room_name'], room.get('room_description'), room['room_password'],
+                                                    room.get('room_timeout'), room.get('retention_age'), room.get('retention_messages'),
+                                                    room.get('retention_bytes')), commit = True)
+            return room_ID
+        except sqlite3.IntegrityError :
+            return None
+
+    # deletes the room, returns False if there was no such room
+    def delete_room(self, room_ID) :
+        deleted, _ = self.execute(DELETE_ROOM, (room_ID,), commit = True)
+        return deleted > 0
+
+    # the messages go to the same file, read through the same pool
+    def open_history(self, directory, flush_interval, flush_bytes) :
+        return SQLiteHistory(self.path, directory, flush_interval, flush_bytes, self.pool, self.synchronous)
+
+    def close(self) :
+        self.pool.close()
+
+    def metrics(self) :
+        return {"backend" : "sqlite", "path" : self.path, "pool" : self.pool.metrics()}
+
+# the chatting history of every room in the messages table, with the interface of the HistoryLog (see server/history.py)
+# append() numbers the message and queues it like the log does, so the senders never wait on the database,
+# and a single writer thread inserts the queued messages in batches : a batch is one transaction of one prepared INSERT
+# run for all of its messages (executemany), committed once flush_interval seconds have passed since its first message,
+# or as soon as flush_bytes of messages are waiting, whichever comes first
+# the messages the writer has not committed yet are served from memory, the others from the table
+# the retention policies are applied by trim(), which the history compactor calls (see server/compaction.py) :
+# the writer deletes the messages in a transaction of its own, between two batches
+# directory is where the files that go with the history are kept, like the search index (see server/search.py)
+class SQLiteHistory :
+    def __init__(self, path = SQLITE_PATH, directory = HISTORY_DIR, flush_interval = FLUSH_INTERVAL, flush_bytes = FLUSH_BYTES,
+                 pool = None, synchronous = SYNCHRONOUS) :
+        self.path = path
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.synchronous = synchronous
+        self.pool = pool or ConnectionPool(connect = lambda : connect(path, synchronous))
+        self.condition = threading.Condition()   # guards everything below, the writer waits on it for new messages
+        self.next_seq = {}                  # room_ID -> the sequence number of the next message of the room
+        self.first_seqs = {}                # room_ID -> the sequence number of the oldest message of the room that is kept
+        self.pending = deque()              # the (room_ID, seq, timestamp, message) entries not taken by the writer yet
+        self.pending_bytes = 0
+        self.writing = []                   # the batch the writer is currently writing, still served to the readers from memory
+        self.trim_requests = []             # the (room_ID, keep_from, threading.Event) trims for the writer, keep_from None drops the room
+        self.closed = False
+        self.writer_thread = None
+        self.connection = None              # the connection of the writer
+        self.counters = {'appended' : 0, 'written' : 0, 'batches' : 0, 'fsyncs' : 0, 'largest_batch' : 0, 'trimmed' : 0}
+        self.observe = None                 # when set, observe(name, seconds) receives the time of every batch write ("history.write_batch")
+        self.on_commit = None               # when set, on_commit(batch) receives the (room_ID, seq, timestamp, message) entries of every written batch
+
+    # recovers the sequence numbers of every room, then starts the writer
+    def start(self) :
+        os.makedirs(self.directory, exist_ok = True)
+        create_database(self.path)
+        self.connection = connect(self.path, self.synchronous)
+        for room_ID, first_seq, last_seq in self.connection.execute(SELECT_HISTORY_ROOMS).fetchall() :
+            self.first_seqs[room_ID] = first_seq
+            self.next_seq[room_ID] = last_seq + 1
+        self.writer_thread = threading.Thread(target = self.write_loop, daemon = True)
+        self.writer_thread.start()
+
+    # imports the history file of the old format (one message per line) of a room that has no history yet
+    # the messages get the modification time of the file as their timestamp, the file itself is left in place
+    # returns the number of imported messages
+    def import_legacy(self, room_ID, path) :
+        room_ID = str(room_ID)
+        if room_ID in self.next_seq or not os.path.exists(path) :
+            return 0
+        with open(path, "r") as chat_file :
+            lines = chat_file.read().splitlines()
+        if not lines :
+            return 0
+        timestamp = os.path.getmtime(path)
+        conn = self.pool.acquire()
+        try :
+            conn.executemany(INSERT_MESSAGE, ((room_ID, seq, timestamp, line) for seq, line in enumerate(lines, 1)))
+            conn.execute(UPDATE_HISTORY_ROOM, (room_ID, 1, len(lines)))
+            conn.commit()
+        finally :
+            conn.close()
+        with self.condition :
+            self.first_seqs[room_ID] = 1
+            self.next_seq[room_ID] = len(lines) + 1
+        return len(lines)
+
+    # numbers the message and queues it for the writer, returns its sequence number without waiting for the database
+    def append(self, room_ID, message, timestamp = None) :
+        room_ID = str(room_ID)
+        with self.condition :
+            seq = self.next_seq.get(room_ID, 1)
+            self.next_seq[room_ID] = seq + 1
+            self.pending.append((room_ID, seq, time.time() if timestamp is None else timestamp, message))
+            self.pending_bytes += len(message)
+            self.counters['appended'] += 1
+            if self.pending_bytes >= self.flush_bytes or len(self.pending) == 1 :
+                self.condition.notify()
+        return seq
+
+    # returns the rooms that have messages
+    def rooms(self) :
+        with self.condition :
+            return list(self.next_seq)
+
+    # returns the last sequence number given out in the room, 0 for a room without messages
+    def last_seq(self, room_ID) :
+        with self.condition :
+            return self.next_seq.get(str(room_ID), 1) - 1
+
+    # returns the sequence number of the oldest message of the room that is still kept, 1 for a room without messages
+    def first_seq(self, room_ID) :
+        with self.condition :
+            return self.first_seqs.get(str(room_ID), 1)
+
+    # returns the (seq, timestamp, message) records of the room with a sequence number above after_seq and below before_seq,
+    # oldest first, only the newest limit of them if a limit is given
+    # the messages the writer has not committed yet are included, so a reader sees every message that was appended
+    def records(self, room_ID, after_seq = 0, before_seq = None, limit = None) :
+        room_ID = str(room_ID)
+        with self.condition :
+            end = self.next_seq.get(room_ID, 1)
+            if before_seq is not None :
+                end = min(end, before_seq)
+            start = after_seq + 1
+            if limit is not None :
+                start = max(start, end - limit)
+            unwritten = [(seq, timestamp, message) for entry_room, seq, timestamp, message in (*self.writing, *self.pending)
+                         if entry_room == room_ID and start <= seq < end]
+
+        # every message below the first one the writer has not committed is in the table
+        disk_end = unwritten[0][0] if unwritten else end
+        if start >= disk_end :
+            return unwritten
+        return self.query(SELECT_RECORDS, (room_ID, start, disk_end)) + unwritten
+
+    # returns the sequence number of the first message of the room sent at cutoff or later (the next one if there is none)
+    # the messages are read in order until then, that is the ones about to be trimmed
+    def first_newer(self, room_ID, cutoff) :
+        rows = self.query(SELECT_FIRST_NEWER, (str(room_ID), cutoff))
+        return rows[0][0] if rows else self.last_seq(room_ID) + 1
+
+    # returns the sequence number of the oldest message of the room the newest messages can go back to within max_bytes,
+    # every message counting its UTF-8 bytes and the header of a record of the HistoryLog, so that the limit means the same for both
+    def first_within(self, room_ID, max_bytes) :
+        rows = self.query(SELECT_FIRST_OVER, (RECORD.size, str(room_ID), max_bytes))
+        return rows[0][0] + 1 if rows else self.first_seq(room_ID)
+
+    def query(self, query, params) :
+        conn = self.pool.acquire()
+        try :
+            return conn.execute(query, params).fetchall()
+        finally :
+            conn.close()
+
+    # asks the writer to delete the messages of the room below keep_from, and waits (at most timeout seconds) until it did
+    # the messages still queued below keep_from are not written at all
+    # returns False if the writer did not get to it in time, or is closed, first_seq() tells what was trimmed
+    def trim(self, room_ID, keep_from, timeout = SEAL_TIMEOUT) :
+        with self.condition :
+            if self.closed :
+                return False
+            done = threading.Event()
+            self.trim_requests.append((str(room_ID), keep_from, done))
+            self.condition.notify()
+        return done.wait(timeout)
+
+    # forgets a room that was deleted and deletes its messages, returns no segments (the HistoryLog returns the files to remove)
+    # the next message of the room, if any, starts its history over
+    def drop_room(self, room_ID) :
+        room_ID = str(room_ID)
+        done = threading.Event()
+        with self.condition :
+            self.next_seq.pop(room_ID, None)
+            self.first_seqs.pop(room_ID, None)
+            self.pending = deque(entry for entry in self.pending if entry[0] != room_ID)
+            self.pending_bytes = sum(len(entry[3]) for entry in self.pending)
+            if self.closed :
+                return []
+            # queued with the numbering reset, so the writer deletes the old rows before it writes any message numbered after it
+            self.trim_requests.append((room_ID, None, done))
+            self.condition.notify()
+        done.wait(SEAL_TIMEOUT)
+        return []
+
+    # waits for messages and commits them in batches until the history is closed and everything is written
+    # the trims are done after the batch the writer was writing when they were asked for, so they see every message below keep_from,
+    # the drops of rooms before it : the messages of the batch for a dropped room were numbered after the drop, from 1 again
+    def write_loop(self) :
+        while True :
+            with self.condition :
+                while not self.pending and not self.closed and not self.trim_requests :
+                    self.condition.wait()
+                if self.pending or self.closed :
+                    # the first message of the batch is here, give the others flush_interval seconds to join it
+                    deadline = time.monotonic() + self.flush_interval
+                    while self.pending_bytes < self.flush_bytes and not self.closed :
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0 :
+                            break
+                        self.condition.wait(remaining)
+                    if not self.pending and self.closed :
+                        break
+                self.writing = list(self.pending)
+                self.pending.clear()
+                self.pending_bytes = 0
+                drops = [request for request in self.trim_requests if request[1] is None]
+                self.trim_requests = [request for request in self.trim_requests if request[1] is not None]
+            self.apply_trims(drops)
+
+            if self.writing :
+                started = time.monotonic()
+                try :
+                    self.write_batch(self.writing)
+                    if self.on_commit is not None :
+                        self.on_commit(self.writing)
+                except sqlite3.Error as exception :
+                    print(f"Error writing the chatting history : {exception}")
+                if self.observe is not None :
+                    self.observe("history.write_batch", time.monotonic() - started)
+
+            with self.condition :
+                if self.writing :
+                    self.counters['written'] += len(self.writing)
+                    self.counters['batches'] += 1
+                    self.counters['largest_batch'] = max(self.counters['largest_batch'], len(self.writing))
+                    self.writing = []
+                trim_requests, self.trim_requests = self.trim_requests, []
+            self.apply_trims(trim_requests)
+
+        with self.condition :
+            trim_requests, self.trim_requests = self.trim_requests, []
+        self.apply_trims(trim_requests)
+        self.connection.close()
+
+    # inserts the messages of the batch and moves the last sequence numbers of their rooms, in one transaction
+    # the messages below the first kept message of their room were trimmed while they waited, they are left out
+    def write_batch(self, batch) :
+        with self.condition :
+            first_seqs = dict(self.first_seqs)
+        rows = [entry for entry in batch if entry[1] >= first_seqs.get(entry[0], 1)]
+        rooms = {}
+        for room_ID, seq, _, _ in rows :
+            first, _ = rooms.get(room_ID, (seq, seq))
+            rooms[room_ID] = (first, seq)
+        with self.connection :
+            self.connection.executemany(INSERT_MESSAGE, rows)
+            self.connection.executemany(UPDATE_HISTORY_ROOM, [(room_ID, first, last) for room_ID, (first, last) in rooms.items()])
+        with self.condition :
+            self.counters['fsyncs'] += 1
+
+    # deletes the messages of the trim requests, then wakes up the callers of trim()
+    # the pages freed go back to the file system a few at a time (incremental vacuum), the file does not grow forever
+    def apply_trims(self, trim_requests) :
+        for room_ID, keep_from, done in trim_requests :
+            try :
+                with self.connection :
+                    if keep_from is None :
+                        deleted = self.connection.execute(DROP_MESSAGES, (room_ID,)).rowcount
+                        self.connection.execute(DROP_HISTORY_ROOM, (room_ID,))
+                    else :
+                        deleted = self.connection.execute(TRIM_MESSAGES, (room_ID, keep_from)).rowcount
+                        self.connection.execute(TRIM_HISTORY_ROOM, (keep_from, room_ID))
+                with self.condition :
+                    if keep_from is not None and room_ID in self.next_seq :
+                        self.first_seqs[room_ID] = max(self.first_seqs.get(room_ID, 1), keep_from)
+                    self.counters['trimmed'] += deleted
+            except sqlite3.Error as exception :
+                print(f"Error trimming the chatting history of room {room_ID} : {exception}")
+            done.set()
+        if trim_requests :
+            try :
+                self.connection.execute("PRAGMA incremental_vacuum").fetchall()   # a page is freed per row stepped
+            except sqlite3.Error as exception :
+                print(f"Error vacuuming the chatting history : {exception}")
+
+    # commits everything that was appended and stops the writer
+    def close(self, timeout = None) :
+        with self.condition :
+            self.closed = True
+            self.condition.notify()
+        if self.writer_thread is not None :
+            self.writer_thread.join(timeout)
+
+    # returns a copy of the counters, along with the messages waiting to be written
+    def metrics(self) :
+        with self.condition :
+            return {**self.counters, 'pending' : len(self.pending) + len(self.writing)}
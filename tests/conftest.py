@@ -0,0 +1,11 @@
+import time
+
+# waits until condition() is true, at most timeout seconds, and returns its last result
+# the history writers, the indexer and the fanout workers run in threads of their own, the tests wait for them this way
+def wait_for(condition, timeout = 5.0) :
+    deadline = time.monotonic() + timeout
+    result = condition()
+    while not result and time.monotonic() < deadline :
+        time.sleep(0.005)
+        result = condition()
+    return result
@@ -0,0 +1,106 @@
+import threading
+import pytest
+from conftest import wait_for
+from auth import chat_auth, passwords
+from auth.chat_auth import FailureCache, SingleFlight
+
+@pytest.fixture
+def cheap_hashes(monkeypatch) :
+    monkeypatch.setattr(passwords, "hash_workers", 0)
+    monkeypatch.setattr(passwords, "work_factor", 4)
+
+def test_concurrent_calls_of_a_key_run_once() :
+    flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def slow() :
+        calls.append(True)
+        release.wait(5.0)
+        return "result"
+
+    results = []
+    threads = [threading.Thread(target = lambda : results.append(flight.do("key", slow))) for _ in range(5)]
+    for thread in threads :
+        thread.start()
+    assert wait_for(lambda : flight.coalesced == 4)
+    release.set()
+    for thread in threads :
+        thread.join(5.0)
+    assert (calls, results) == ([True], ["result"] * 5)
+    assert flight.calls == {}
+    assert flight.do("key", lambda : "again") == "again"
+
+def test_followers_get_the_exception_of_the_call() :
+    flight = SingleFlight()
+    release = threading.Event()
+    errors = []
+
+    def fail() :
+        release.wait(5.0)
+        raise OSError("database down")
+
+    def call() :
+        try :
+            flight.do("key", fail)
+        except OSError as exception :
+            errors.append(exception)
+
+    threads = [threading.Thread(target = call) for _ in range(3)]
+    for thread in threads :
+        thread.start()
+    assert wait_for(lambda : flight.coalesced == 2)
+    release.set()
+    for thread in threads :
+        thread.join(5.0)
+    assert len(errors) == 3 and len(set(map(id, errors))) == 1
+
+def test_failure_cache() :
+    failures = FailureCache(ttl = 60, max_failures = 3)
+    assert not failures.failing("alice", b"wrong")
+    failures.record("alice", b"wrong", False)
+    assert failures.failing("alice", b"wrong")
+    assert not failures.failing("alice", b"right")
+    failures.record("alice", b"other", False)
+    failures.record("alice", b"third", False)
+    assert failures.failing("alice", b"right")
+    failures.forget("alice")
+    assert not failures.failing("alice", b"right")
+    assert failures.failing("alice", b"wrong")
+
+    failures.record("nobody", b"any", True)
+    assert failures.failing("nobody", b"whatever")
+    assert failures.rejected == 4
+
+def test_failures_expire() :
+    failures = FailureCache(ttl = 0)
+    failures.record("alice", b"wrong", False)
+    assert not failures.failing("alice", b"wrong")
+    assert len(failures) == 0
+
+def test_password_hashes(cheap_hashes) :
+    stored = passwords.hash_password("correct horse")
+    assert stored.startswith("scrypt4$") and len(stored) <= 60
+    assert passwords.check_password("correct horse", stored)
+    assert not passwords.check_password("wrong horse", stored)
+    assert stored != passwords.hash_password("correct horse")
+    assert not passwords.needs_upgrade(stored)
+    assert passwords.needs_upgrade("admin123")
+    assert passwords.check_password("admin123", "admin123")
+    passwords.configure(log_n = 5)
+    assert passwords.needs_upgrade(stored)
+
+def test_login_upgrades_the_stored_password(cheap_hashes, tmp_path, monkeypatch) :
+    from storage.sqlite_storage import SQLiteStorage
+    storage = SQLiteStorage(str(tmp_path / "chatroom.db"), min_size = 1, max_size = 2)
+    monkeypatch.setattr(chat_auth, "get_storage", lambda : storage)
+    monkeypatch.setattr(chat_auth, "failures", FailureCache())
+    assert chat_auth.authenticate_user("admin", "admin123")
+    assert passwords.hash_cost(storage.find_user("admin")["password"]) == 4
+    assert chat_auth.authenticate_user("admin", "admin123")
+    assert not chat_auth.authenticate_user("admin", "wrong")
+    assert not chat_auth.authenticate_user("nobody", "admin123")
+    assert chat_auth.register_user("alice", "secret")
+    assert not chat_auth.register_user("alice", "other")
+    assert chat_auth.authenticate_user("alice", "secret")
+    storage.close()
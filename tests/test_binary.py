@@ -0,0 +1,33 @@
+import json
+import pytest
+from protocol.binary import BinaryError, decode_action, decode_event, encode_action, encode_message_event
+
+def test_actions_round_trip() :
+    action = {"action" : "send_message", "message" : "héllo"}
+    assert decode_action(encode_action(action)) == action
+    assert decode_action(json.dumps(action).encode('utf-8')) == action
+    action = {"action" : "join_room", "room_ID" : "12", "room_password" : "secret", "last_seq" : None}
+    assert decode_action(encode_action(action)) == action
+
+# the server accepts any positive number of seconds as the room timeout, the binary encoding carries the ones JSON does
+@pytest.mark.parametrize("room_timeout", [1.5, 0.25, 60, None])
+def test_room_timeout_round_trip(room_timeout) :
+    action = {"action" : "create_room", "room_name" : "lobby", "room_description" : "", "room_password" : "secret",
+              "room_timeout" : room_timeout, "retention_age" : None, "retention_messages" : 100, "retention_bytes" : None}
+    decoded = decode_action(encode_action(action))
+    assert decoded == action
+    assert type(decoded["room_timeout"]) is type(room_timeout)
+
+def test_message_event_round_trip() :
+    assert decode_event(encode_message_event("12", 34, "bob >> hi")) == {"event" : "message", "room_ID" : "12", "seq" : 34,
+                                                                          "message" : "bob >> hi"}
+
+def test_malformed_payloads_are_refused() :
+    with pytest.raises(BinaryError) :
+        decode_action(bytes((0x1E,)))
+    with pytest.raises(BinaryError) :
+        decode_action(encode_action({"action" : "send_message", "message" : "hi"}) + b"!")
+    with pytest.raises(BinaryError) :
+        decode_action(encode_action({"action" : "send_message", "message" : "hi"})[:-1])
+    with pytest.raises(ValueError) :
+        encode_action({"action" : "create_room", "room_name" : "lobby", "room_password" : "", "room_timeout" : "soon"})
@@ -0,0 +1,64 @@
+import os
+from conftest import wait_for
+from server.compaction import HistoryCompactor
+from server.history import HistoryLog
+from storage.sqlite_storage import SQLiteHistory
+
+def fill(history, room_ID, count) :
+    for number in range(count) :
+        history.append(room_ID, f"message {number}")
+    assert wait_for(lambda : history.metrics()["pending"] == 0)
+
+def test_segments_are_archived_and_trimmed_to_the_retention(tmp_path) :
+    history = HistoryLog(str(tmp_path / "history"), flush_interval = 0.01, segment_size = 200)
+    history.start()
+    fill(history, 1, 40)
+    trims = []
+    compactor = HistoryCompactor(history, retention = (None, 10, None), rate = 0)
+    compactor.on_trim = lambda room_ID, first_seq : trims.append((room_ID, first_seq))
+    compactor.compact()
+
+    first_seq = history.first_seq(1)
+    assert 1 < first_seq <= 31
+    assert trims == [("1", first_seq)]
+    assert [seq for seq, _, _ in history.records(1)] == list(range(first_seq, 41))
+    assert any(segment.archived for segment in history.room_segments_of(1))
+    names = os.listdir(history.room_directory(1))
+    assert len(names) == len(history.room_segments_of(1))
+    assert compactor.metrics()["errors"] == 0
+
+    # the archives and the segment being written are read back the same after a restart
+    history.close()
+    history = HistoryLog(str(tmp_path / "history"), flush_interval = 0.01, segment_size = 200)
+    history.start()
+    assert history.append(1, "after the restart") == 41
+    assert [seq for seq, _, _ in history.records(1)] == list(range(first_seq, 42))
+    history.close()
+
+def test_deleted_room_loses_its_history(tmp_path) :
+    history = HistoryLog(str(tmp_path / "history"), flush_interval = 0.01)
+    history.start()
+    fill(history, 1, 5)
+    fill(history, 2, 5)
+    trims = []
+    compactor = HistoryCompactor(history, is_deleted = lambda room_ID : room_ID == "2", rate = 0)
+    compactor.on_trim = lambda room_ID, first_seq : trims.append((room_ID, first_seq))
+    compactor.compact()
+    assert trims == [("2", None)]
+    assert not os.path.exists(history.room_directory(2))
+    assert history.records(2) == []
+    assert len(history.records(1)) == 5
+    history.close()
+
+def test_history_table_is_trimmed_in_place(tmp_path) :
+    history = SQLiteHistory(str(tmp_path / "chatroom.db"), str(tmp_path / "history"), flush_interval = 0.01)
+    history.start()
+    fill(history, 1, 40)
+    trims = []
+    compactor = HistoryCompactor(history, retention_for = lambda room_ID : (None, 10, None), rate = 0)
+    compactor.on_trim = lambda room_ID, first_seq : trims.append((room_ID, first_seq))
+    compactor.compact()
+    assert history.first_seq(1) == 31
+    assert trims == [("1", 31)]
+    assert [seq for seq, _, _ in history.records(1)] == list(range(31, 41))
+    history.close()
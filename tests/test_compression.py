@@ -0,0 +1,59 @@
+import json
+import pytest
+from protocol.compression import CompressionError, DICTIONARY, compress_payload, decompress_payload, is_compressed, maybe_compress
+from server.history_blocks import HistoryBlocks, HISTORY_BLOCK
+
+def test_compressed_payload_round_trip() :
+    payload = json.dumps({"code" : 200, "room_ID" : "1", "messages" : [{"seq" : seq, "time" : 0, "message" : f"bob >> hi {seq}"}
+                                                                        for seq in range(50)]}).encode('utf-8')
+    compressed = maybe_compress(payload)
+    assert is_compressed(compressed)
+    assert len(compressed) < len(payload)
+    assert decompress_payload(compressed, len(payload)) == payload
+    assert maybe_compress(b"short") == b"short"
+    assert decompress_payload(b"plain", 10) == b"plain"
+
+def test_decompression_is_held_to_the_frame_size() :
+    compressed = compress_payload(b"a" * 10000)
+    with pytest.raises(CompressionError) :
+        decompress_payload(compressed, 9999)
+    with pytest.raises(CompressionError) :
+        decompress_payload(compressed[:-2], 10000)
+    with pytest.raises(CompressionError) :
+        decompress_payload(bytes((compressed[0],)) + b"\xff" * 20, 10000)
+
+def test_dictionary_keeps_its_strings_apart() :
+    assert b"right now\nChatting History : \n" in DICTIONARY
+    assert b"nowChatting" not in DICTIONARY
+
+def records(first, last) :
+    return [(seq, 0.0, f"bob >> message {seq}") for seq in range(first, last + 1)]
+
+def test_only_the_full_blocks_are_cached() :
+    blocks = HistoryBlocks()
+    runs = blocks.split(records(HISTORY_BLOCK - 1, 2 * HISTORY_BLOCK + 1))
+    assert [(block, len(run)) for block, run in runs] == [(None, 2), (1, HISTORY_BLOCK), (None, 1)]
+    first = blocks.payload("1", 1, runs[1][1])
+    assert blocks.payload(1, 1, runs[1][1]) is first
+    assert (blocks.hits, blocks.misses) == (1, 1)
+    payload, size = first
+    assert decompress_payload(payload, size).decode('utf-8').splitlines() == [message for _, _, message in runs[1][1]]
+
+def test_blocks_are_evicted_least_recently_used_first() :
+    blocks = HistoryBlocks(max_blocks = 2)
+    for block in range(3) :
+        blocks.payload("1", block, records(block * HISTORY_BLOCK + 1, (block + 1) * HISTORY_BLOCK))
+    assert list(blocks.blocks) == [("1", 1), ("1", 2)]
+
+def test_forget_drops_the_trimmed_blocks() :
+    blocks = HistoryBlocks()
+    for block in range(3) :
+        blocks.payload("1", block, records(block * HISTORY_BLOCK + 1, (block + 1) * HISTORY_BLOCK))
+    blocks.payload("2", 0, records(1, HISTORY_BLOCK))
+    # the second block starts at the first kept message, it is still whole
+    blocks.forget(1, HISTORY_BLOCK + 1)
+    assert sorted(blocks.blocks) == [("1", 1), ("1", 2), ("2", 0)]
+    blocks.forget(1, HISTORY_BLOCK + 2)
+    assert sorted(blocks.blocks) == [("1", 2), ("2", 0)]
+    blocks.forget("1")
+    assert sorted(blocks.blocks) == [("2", 0)]
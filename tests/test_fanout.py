@@ -0,0 +1,59 @@
+import threading
+from server.fanout import FanoutEngine
+from server.rooms import ClientSession, RoomIndex
+
+def test_every_member_receives_the_messages_in_order() :
+    engine = FanoutEngine(workers = 4)
+    engine.start()
+    index = RoomIndex(shard_count = 4, shard_threshold = 8)
+    members = [ClientSession(None) for _ in range(50)]
+    for member in members :
+        index.join(member, "1")
+    shards = index.member_shards("1")
+    assert shards is not None and sum(len(shard) for shard in shards) == 50
+
+    received = {member : [] for member in members}
+    lock = threading.Lock()
+
+    def sender(seq) :
+        def send(shard) :
+            for member in shard :
+                with lock :
+                    received[member].append(seq)
+        return send
+
+    for seq in range(1, 201) :
+        with engine.ordered("1") :
+            engine.submit(index.members("1"), shards, sender(seq))
+    engine.close(5.0)
+    assert all(messages == list(range(1, 201)) for messages in received.values())
+    assert engine.metrics()["sharded"] == 200
+
+def test_small_rooms_are_delivered_from_the_sender() :
+    engine = FanoutEngine(workers = 2)
+    engine.start()
+    delivered = []
+    engine.submit({"a", "b"}, None, lambda members : delivered.append((threading.current_thread(), sorted(members))))
+    assert delivered == [(threading.current_thread(), ["a", "b"])]
+    engine.close(5.0)
+    # a closed engine delivers the shards right away
+    engine.submit(None, [{"a"}, {"b"}], lambda members : delivered.append(sorted(members)))
+    assert delivered[1:] == [["a"], ["b"]]
+    assert engine.metrics()["direct"] == 2
+
+def test_failed_delivery_does_not_stop_the_worker() :
+    engine = FanoutEngine(workers = 1)
+    engine.start()
+    delivered = []
+
+    def fail(shard) :
+        raise OSError("connection reset")
+    engine.submit(None, [{"a"}], fail)
+    engine.submit(None, [{"a"}], delivered.append)
+    engine.close(5.0)
+    assert delivered == [{"a"}]
+    assert engine.metrics()["errors"] == 1
+
+def test_rooms_keep_their_order_lock() :
+    engine = FanoutEngine(workers = 0)
+    assert engine.ordered("1") is engine.ordered("1")
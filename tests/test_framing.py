@@ -0,0 +1,32 @@
+import pytest
+from protocol.framing import DEFAULT_MAX_FRAME_SIZE, FrameDecoder, FrameError, encode_frame, negotiate_frame_size
+
+def test_frames_split_anywhere_are_decoded_in_order() :
+    payloads = [b"first", "sécond", b"", b"x" * 1000]
+    stream = b"".join(encode_frame(payload) for payload in payloads)
+    expected = [payload.encode('utf-8') if isinstance(payload, str) else payload for payload in payloads]
+    for chunk_size in (1, 3, 7, len(stream)) :
+        decoder = FrameDecoder()
+        decoded = []
+        for start in range(0, len(stream), chunk_size) :
+            decoded.extend(decoder.feed(memoryview(stream)[start : start + chunk_size]))
+        assert decoded == expected
+        assert (decoder.offset, len(decoder.buffer)) == (0, 0)
+
+def test_partial_frame_waits_for_the_rest() :
+    decoder = FrameDecoder()
+    frame = encode_frame(b"hello world")
+    assert decoder.feed(frame + frame[:6]) == [b"hello world"]
+    assert decoder.feed(frame[6:]) == [b"hello world"]
+
+def test_oversized_frame_is_refused() :
+    decoder = FrameDecoder(max_frame_size = 8)
+    assert decoder.feed(encode_frame(b"12345678")) == [b"12345678"]
+    with pytest.raises(FrameError) :
+        decoder.feed(encode_frame(b"123456789")[:4])
+
+def test_frame_size_negotiation() :
+    assert negotiate_frame_size(None) == DEFAULT_MAX_FRAME_SIZE
+    assert negotiate_frame_size(-1) == DEFAULT_MAX_FRAME_SIZE
+    assert negotiate_frame_size(100) == 100
+    assert negotiate_frame_size(10 ** 9, limit = 4096) == 4096
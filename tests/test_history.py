@@ -0,0 +1,143 @@
+import os
+import pytest
+from conftest import wait_for
+from server.history import HistoryLog, RECORD, encode_record, iter_records
+from storage.sqlite_storage import SQLiteHistory
+
+def open_history(kind, tmp_path, **settings) :
+    if kind == "log" :
+        history = HistoryLog(str(tmp_path / "history"), flush_interval = 0.01, **settings)
+    else :
+        history = SQLiteHistory(str(tmp_path / "chatroom.db"), str(tmp_path / "history"), flush_interval = 0.01)
+    history.start()
+    return history
+
+def written(history) :
+    return wait_for(lambda : history.metrics()["pending"] == 0)
+
+@pytest.fixture(params = ["log", "sqlite"])
+def kind(request) :
+    return request.param
+
+def test_append_numbers_the_messages_of_every_room(kind, tmp_path) :
+    history = open_history(kind, tmp_path)
+    assert [history.append(1, f"a{number}") for number in range(3)] == [1, 2, 3]
+    assert history.append("2", "b0") == 1
+    # the messages are served before the writer committed them, and after
+    assert [message for _, _, message in history.records("1")] == ["a0", "a1", "a2"]
+    assert written(history)
+    assert [message for _, _, message in history.records(1, after_seq = 1)] == ["a1", "a2"]
+    assert [seq for seq, _, _ in history.records(1, limit = 2)] == [2, 3]
+    assert [seq for seq, _, _ in history.records(1, before_seq = 3)] == [1, 2]
+    assert sorted(history.rooms()) == ["1", "2"]
+    assert (history.first_seq(1), history.last_seq(1), history.last_seq(3)) == (1, 3, 0)
+    history.close()
+
+def test_restart_recovers_the_numbering(kind, tmp_path) :
+    history = open_history(kind, tmp_path)
+    for number in range(5) :
+        history.append(1, f"message {number}")
+    history.close()
+
+    history = open_history(kind, tmp_path)
+    assert history.last_seq(1) == 5
+    assert history.append(1, "after the restart") == 6
+    assert written(history)
+    assert [seq for seq, _, _ in history.records(1)] == [1, 2, 3, 4, 5, 6]
+    history.close()
+
+def test_writer_commits_in_batches(kind, tmp_path) :
+    history = open_history(kind, tmp_path)
+    history.flush_interval = 0.2
+    committed = []
+    history.on_commit = committed.append
+    for number in range(100) :
+        history.append(number % 4, f"message {number}")
+    assert written(history)
+    metrics = history.metrics()
+    assert metrics["written"] == 100
+    assert metrics["batches"] < 10
+    assert sorted(seq for batch in committed for room_ID, seq, _, _ in batch if room_ID == "3") == list(range(1, 26))
+    history.close()
+
+def test_record_crc() :
+    record = encode_record(7, 1.5, "héllo")
+    assert [(seq, timestamp, bytes(payload)) for _, seq, timestamp, payload in iter_records(record)] == [(7, 1.5, "héllo".encode('utf-8'))]
+    corrupt = bytearray(record)
+    corrupt[-1] ^= 0xFF
+    assert list(iter_records(bytes(corrupt))) == []
+    assert list(iter_records(record[:-1])) == []
+
+def test_torn_tail_is_cut_off_on_restart(tmp_path) :
+    history = open_history("log", tmp_path)
+    for number in range(3) :
+        history.append(1, f"message {number}")
+    history.close()
+    segment = history.room_segments_of(1)[-1].path
+    size = os.path.getsize(segment)
+    with open(segment, "ab") as file :
+        file.write(encode_record(4, 0.0, "torn")[:RECORD.size + 1])
+
+    history = open_history("log", tmp_path)
+    assert os.path.getsize(segment) == size
+    assert history.append(1, "after the restart") == 4
+    assert written(history)
+    assert [message for _, _, message in history.records(1)] == ["message 0", "message 1", "message 2", "after the restart"]
+    history.close()
+
+def test_full_segment_is_sealed_and_a_new_one_started(tmp_path) :
+    history = open_history("log", tmp_path, segment_size = 200)
+    for number in range(20) :
+        history.append(1, f"message {number}")
+    assert written(history)
+    segments = history.room_segments_of(1)
+    assert len(segments) > 1
+    assert all(segment.sealed for segment in segments[:-1])
+    assert [segment.first_seq for segment in segments] == sorted(segment.first_seq for segment in segments)
+    assert [seq for seq, _, _ in history.records(1, after_seq = 5, before_seq = 16)] == list(range(6, 16))
+    history.close()
+
+def test_dropped_room_starts_over(kind, tmp_path) :
+    history = open_history(kind, tmp_path)
+    for number in range(5) :
+        history.append(1, f"old {number}")
+    history.append(2, "kept")
+    assert written(history)
+    history.drop_room(1)
+    assert history.last_seq(1) == 0
+    assert history.append(1, "new") == 1
+    assert written(history)
+    assert [message for _, _, message in history.records(1)] == ["new"]
+    assert [message for _, _, message in history.records(2)] == ["kept"]
+    history.close()
+
+def test_trim_deletes_the_older_messages(tmp_path) :
+    history = open_history("sqlite", tmp_path)
+    for number in range(10) :
+        history.append(1, f"message {number}")
+    assert written(history)
+    assert history.trim(1, 6)
+    assert history.first_seq(1) == 6
+    assert [seq for seq, _, _ in history.records(1)] == [6, 7, 8, 9, 10]
+    history.close()
+
+    history = open_history("sqlite", tmp_path)
+    assert (history.first_seq(1), history.last_seq(1)) == (6, 10)
+    history.close()
+
+# the messages sent to a room right after it was dropped are numbered from 1 again : the drop must not delete them
+def test_drop_does_not_delete_the_messages_numbered_after_it(tmp_path) :
+    history = open_history("sqlite", tmp_path)
+    for number in range(50) :
+        history.append(1, f"old {number}")
+    history.flush_interval = 0.05
+    history.append(1, "queued before the drop")
+    history.drop_room(1)
+    for number in range(5) :
+        history.append(1, f"new {number}")
+    assert written(history)
+    history.close()
+
+    history = open_history("sqlite", tmp_path)
+    assert [message for _, _, message in history.records(1)] == [f"new {number}" for number in range(5)]
+    history.close()
@@ -0,0 +1,120 @@
+import sqlite3
+import threading
+import pytest
+from db import standin
+from db.pool import ConnectionPool, PoolError
+
+@pytest.fixture
+def database(tmp_path) :
+    return standin.create_database(str(tmp_path / "standin.db"))
+
+def memory_connection() :
+    return sqlite3.connect(":memory:", check_same_thread = False)
+
+def test_acquire_times_out_when_every_connection_is_in_use() :
+    pool = ConnectionPool(connect = memory_connection, min_size = 0, max_size = 1, acquire_timeout = 0.05)
+    held = pool.acquire()
+    with pytest.raises(PoolError) :
+        pool.acquire()
+    assert pool.metrics()["timeouts"] == 1
+    held.close()
+    pool.acquire().close()
+    assert pool.metrics()["created"] == 1
+    pool.close()
+
+def test_waiter_gets_the_released_connection() :
+    pool = ConnectionPool(connect = memory_connection, min_size = 0, max_size = 1, acquire_timeout = 5.0)
+    held = pool.acquire()
+    acquired = []
+    waiter = threading.Thread(target = lambda : acquired.append(pool.acquire()))
+    waiter.start()
+    held.close()
+    waiter.join(5.0)
+    assert len(acquired) == 1
+    acquired[0].close()
+    assert pool.metrics()["created"] == 1
+    pool.close()
+
+def test_start_opens_the_idle_connections(database) :
+    pool = ConnectionPool(connect = standin.connect, min_size = 3, max_size = 4)
+    assert pool.start() == 3
+    assert pool.metrics()["idle"] == 3
+    assert pool.metrics()["in_use"] == 0
+    pool.close()
+
+def test_release_rolls_back_the_open_transaction(database) :
+    pool = ConnectionPool(connect = standin.connect, min_size = 0, max_size = 1)
+    conn = pool.acquire()
+    conn.cursor().execute("INSERT INTO users (username, password) VALUES (%s, %s)", ("uncommitted", "secret"))
+    conn.close()
+    # the same connection is handed out again, it would see its own insert had it not been rolled back
+    conn = pool.acquire()
+    cursor = conn.cursor()
+    cursor.execute("SELECT username FROM users WHERE username = %s", ("uncommitted",))
+    assert cursor.fetchall() == []
+    conn.close()
+    assert pool.metrics()["created"] == 1
+    pool.close()
+
+def test_connection_that_fails_to_roll_back_is_discarded(database) :
+    pool = ConnectionPool(connect = standin.connect, min_size = 0, max_size = 1)
+    conn = pool.acquire()
+    conn.close()
+    broken, _ = pool.idle[-1]
+
+    def fail() :
+        raise standin.Error("connection lost")
+    broken.rollback = fail
+    pool.acquire().close()
+    assert pool.metrics()["discarded"] == 1
+    assert pool.metrics()["size"] == 0
+    pool.acquire().close()
+    assert pool.metrics()["created"] == 2
+    pool.close()
+
+def test_health_check_replaces_a_broken_idle_connection(database) :
+    pool = ConnectionPool(connect = standin.connect, min_size = 0, max_size = 1, health_check_interval = 0)
+    pool.acquire().close()
+    broken, _ = pool.idle[-1]
+
+    def fail(reconnect = False) :
+        raise standin.Error("server has gone away")
+    broken.ping = fail
+    conn = pool.acquire()
+    cursor = conn.cursor()
+    cursor.execute("SELECT 1")
+    assert cursor.fetchall() == [(1,)]
+    conn.close()
+    metrics = pool.metrics()
+    assert metrics["discarded"] == 1
+    assert metrics["created"] == 2
+    assert metrics["size"] == 1
+    pool.close()
+
+def test_recently_used_connection_is_not_pinged(database) :
+    pool = ConnectionPool(connect = standin.connect, min_size = 0, max_size = 1, health_check_interval = 60)
+    pool.acquire().close()
+    pinged = []
+    pool.idle[-1][0].ping = lambda reconnect = False : pinged.append(True)
+    pool.acquire().close()
+    assert pinged == []
+    pool.close()
+
+def test_failed_connect_frees_its_place() :
+    def refuse() :
+        raise standin.Error("can not connect")
+    pool = ConnectionPool(connect = refuse, min_size = 0, max_size = 1, acquire_timeout = 0.05)
+    for _ in range(2) :
+        with pytest.raises(standin.Error) :
+            pool.acquire()
+    assert pool.metrics()["size"] == 0
+    assert pool.metrics()["timeouts"] == 0
+
+def test_closed_pool_refuses_acquire() :
+    pool = ConnectionPool(connect = memory_connection, min_size = 0, max_size = 1)
+    held = pool.acquire()
+    pool.close()
+    with pytest.raises(PoolError) :
+        pool.acquire()
+    held.close()
+    assert pool.metrics()["size"] == 0
@@ -0,0 +1,56 @@
+import pytest
+from server.ratelimit import AdmissionControl, TokenBucket
+from server.rooms import ClientSession
+
+def test_bucket_spends_its_burst_then_refills() :
+    bucket = TokenBucket(3, 0.0)
+    assert [bucket.take(2.0, 3, 0.0) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.take(2.0, 3, 0.0) == pytest.approx(0.5)
+    assert bucket.take(2.0, 3, 0.25) == pytest.approx(0.25)
+    assert bucket.take(2.0, 3, 0.5) == 0.0
+    assert not bucket.full(2.0, 3, 1.0)
+    assert bucket.full(2.0, 3, 2.0)
+    assert bucket.take(2.0, 3, 100.0) == 0.0
+    assert bucket.tokens == 2
+
+def session(username = "alice", room_ID = 1) :
+    session = ClientSession(None)
+    session.username = username
+    session.room_ID = room_ID
+    return session
+
+def test_connection_limit_covers_every_action_but_disconnect() :
+    admission = AdmissionControl()
+    admission.configure(connection = (0.001, 2))
+    client = session()
+    assert admission.admit(client, "list") is None
+    assert admission.admit(client, "history") is None
+    scope, retry_after = admission.admit(client, "list")
+    assert scope == "connection" and retry_after > 0
+    assert admission.admit(client, "disconnect") is None
+    assert admission.admit(session(), "list") is None
+    assert admission.metrics()["rejected_connection"] == 1
+
+def test_user_and_room_limits_are_shared() :
+    admission = AdmissionControl()
+    admission.configure(connection = (0, 0), user = (0.001, 2), room = (0.001, 3))
+    first, second = session("alice"), session("alice")
+    assert admission.admit(first, "send_message") is None
+    assert admission.admit(second, "send_message") is None
+    assert admission.admit(first, "send_message")[0] == "user"
+    assert admission.admit(first, "list") is None
+    assert admission.admit(session("bob"), "send_message") is None
+    assert admission.admit(session("carol"), "send_message")[0] == "room"
+    assert admission.admit(session("carol", room_ID = "2"), "send_message") is None
+    metrics = admission.metrics()
+    assert (metrics["rejected_user"], metrics["rejected_room"], metrics["user_buckets"], metrics["room_buckets"]) == (1, 1, 3, 2)
+
+def test_database_slots() :
+    admission = AdmissionControl()
+    admission.configure(max_db_actions = 1, db_timeout = 0.01)
+    assert admission.acquire_db_slot()
+    assert not admission.acquire_db_slot()
+    admission.release_db_slot()
+    assert admission.acquire_db_slot()
+    admission.release_db_slot()
+    assert admission.metrics()["rejected_database"] == 1
@@ -0,0 +1,107 @@
+import pytest
+from conftest import wait_for
+from server import search
+from server.compaction import HistoryCompactor
+from server.history import HistoryLog
+from server.search import MAX_ROOM_ID, SearchIndex, SearchError, match_expression, split_message
+
+def open_history(tmp_path, **settings) :
+    history = HistoryLog(str(tmp_path / "history"), flush_interval = 0.01, **settings)
+    history.start()
+    return history
+
+def written(history) :
+    return wait_for(lambda : history.metrics()["pending"] == 0)
+
+def seqs(results) :
+    return [seq for seq, _, _ in results[0]]
+
+@pytest.fixture
+def index(tmp_path) :
+    history = open_history(tmp_path)
+    index = SearchIndex()
+    history.on_commit = index.add
+    index.start(history)
+    yield index
+    index.close()
+    history.close()
+
+def test_match_expression_quotes_the_words() :
+    assert match_expression('hello wor* "quoted"', "bob") == 'text : ("hello" AND "wor"* AND """quoted""") AND username : "bob"'
+    assert split_message("bob >> hi >> there") == ("bob", "hi >> there")
+    assert split_message("no separator") == ("", "no separator")
+    with pytest.raises(SearchError) :
+        match_expression("*** !!")
+
+def test_committed_messages_are_searchable(index) :
+    history = index.history
+    history.append(1, "alice >> the quick brown fox")
+    history.append(1, "bob >> a lazy dog")
+    history.append(1, "bob >> the quick reply")
+    history.append(2, "alice >> quick but elsewhere")
+    assert written(history)
+    assert wait_for(lambda : index.metrics()["indexed"] == 4)
+
+    results, cursor = index.search(1, "quick")
+    assert ([seq for seq, _, _ in results], cursor) == ([3, 1], None)
+    assert [message for _, _, message in index.search(1, "quick", "bob")[0]] == ["bob >> the quick reply"]
+    assert seqs(index.search(1, "qui*")) == [3, 1]
+
+    # the cursor pages backwards from the newest match
+    results, cursor = index.search(1, "quick", limit = 1)
+    assert ([seq for seq, _, _ in results], cursor) == ([3], 3)
+    assert seqs(index.search(1, "quick", before = cursor)) == [1]
+
+# the retention trimmed the oldest messages before the index saw them : the catch up starts at the oldest kept message,
+# rather than taking the missing chunks for the end of the room
+def test_catch_up_after_a_trim(tmp_path, monkeypatch) :
+    monkeypatch.setattr(search, "CATCH_UP_CHUNK", 10)
+    history = open_history(tmp_path, segment_size = 200)
+    for number in range(100) :
+        history.append(1, f"alice >> message number {number}")
+    assert written(history)
+    HistoryCompactor(history, retention = (None, 20, None), rate = 0).compact()
+    first_seq = history.first_seq(1)
+    assert first_seq > 1 + search.CATCH_UP_CHUNK
+
+    index = SearchIndex()
+    index.start(history)
+    index.close()
+    assert index.metrics()["caught_up"] == 101 - first_seq
+    assert seqs(index.search(1, "message", limit = 100)) == list(range(100, first_seq - 1, -1))
+    history.close()
+
+def test_forget_drops_the_trimmed_and_deleted_messages(index) :
+    history = index.history
+    for number in range(10) :
+        history.append(1, f"alice >> hello {number}")
+        history.append(2, f"alice >> hello {number}")
+    assert written(history)
+    assert wait_for(lambda : index.metrics()["indexed"] == 20)
+    index.forget(1, 6)
+    index.forget(2)
+    assert wait_for(lambda : index.metrics()["forgotten"] == 2)
+    assert seqs(index.search(1, "hello", limit = 100)) == [10, 9, 8, 7, 6]
+    assert index.search(2, "hello")[0] == []
+
+# the indexer takes a drop and the batches that came with it together : the messages of the room numbered from 1 again
+# after the drop are kept, the ones below a trim are not indexed
+def test_drops_and_trims_apply_before_the_batch_of_the_same_cycle(index) :
+    index.add([("1", seq, 0.0, f"alice >> old {seq}") for seq in range(1, 6)])
+    assert wait_for(lambda : index.metrics()["indexed"] == 5)
+    with index.condition :
+        index.forget(1)
+        index.add([("1", 1, 0.0, "alice >> new 1"), ("2", 1, 0.0, "alice >> trimmed 1"), ("2", 2, 0.0, "alice >> kept 2")])
+        index.forget(2, 2)
+    assert wait_for(lambda : index.metrics()["indexed"] == 7)
+    assert index.metrics()["forgotten"] == 2
+    assert [message for _, _, message in index.search(1, username = "alice", limit = 100)[0]] == ["alice >> new 1"]
+    assert [message for _, _, message in index.search(2, username = "alice", limit = 100)[0]] == ["alice >> kept 2"]
+
+# a rowid is a signed 64 bit integer : the rooms beyond MAX_ROOM_ID are skipped instead of failing the batch of the others
+def test_rooms_beyond_the_rowids_are_skipped(index) :
+    index.add([(str(MAX_ROOM_ID + 1), 1, 0.0, "alice >> too far"), (str(MAX_ROOM_ID), 1, 0.0, "alice >> last room")])
+    assert wait_for(lambda : index.metrics()["indexed"] == 1)
+    assert index.metrics()["skipped"] == 1
+    assert seqs(index.search(MAX_ROOM_ID, "room")) == [1]
+    assert index.search(MAX_ROOM_ID + 1, "far") == ([], None)
@@ -0,0 +1,218 @@
+import json
+import pytest
+from conftest import wait_for
+from auth import chat_auth, passwords
+from protocol.binary import decode_action, encode_action
+from protocol.compression import decompress_payload
+from protocol.framing import FrameDecoder
+from server import server
+from server.history_blocks import HistoryBlocks
+from server.rooms import ClientSession
+from server.server import room_key
+from storage.backends import configure_storage
+
+# a client socket that keeps the frames the server sends it
+class RecordingSocket :
+    def __init__(self) :
+        self.compression = None
+        self.decoder = FrameDecoder(1 << 24)
+        self.payloads = []
+
+    def sendall(self, data) :
+        self.payloads.extend(self.decoder.feed(data))
+
+    # the JSON payloads received so far, the ones with a response code or the events
+    def received(self, key = "code") :
+        documents = [json.loads(payload) for payload in self.payloads if payload[:1] == b"{"]
+        return [document for document in documents if key in document]
+
+    def last_response(self) :
+        return self.received()[-1]
+
+# a client of the server, its actions go through handle_action like the ones read from a connection
+class Client :
+    def __init__(self) :
+        self.socket = RecordingSocket()
+        self.session = ClientSession(self.socket)
+
+    def send(self, action, **fields) :
+        server.handle_action(self.socket, {"action" : action, **fields}, self.session)
+        return self.socket.last_response() if action not in ("send_message", "disconnect") else None
+
+# the server state of a test : a SQLite storage and history in a temporary directory, the room catalog loaded from it,
+# an empty cache of compressed history blocks, cheap password hashes in the calling thread, and no members in any room
+@pytest.fixture
+def chat(tmp_path, monkeypatch) :
+    monkeypatch.setattr(passwords, "hash_workers", 0)
+    monkeypatch.setattr(passwords, "work_factor", 4)
+    monkeypatch.setattr(chat_auth, "failures", chat_auth.FailureCache())
+    storage = configure_storage("sqlite", str(tmp_path / "chatroom.db"), min_size = 1, max_size = 4)
+    history = storage.open_history(str(tmp_path / "history"), 0.01, server.FLUSH_BYTES)
+    monkeypatch.setattr(server, "history", history)
+    monkeypatch.setattr(server, "history_blocks", HistoryBlocks())
+    history.start()
+    server.room_catalog.refresh()
+    yield server
+    with server.clients_lock :
+        server.room_index.clear()
+        server.clients.clear()
+    history.close()
+    storage.close()
+
+# the message events the client received
+def messages(client) :
+    return [event for event in client.socket.received("event") if event["event"] == "message"]
+
+def test_room_IDs_are_keyed_as_strings() :
+    assert room_key(1) == room_key("1") == "1"
+    assert room_key(None) is None
+
+# a room ID sent as a number and the same ID sent as a string are the same room
+def test_members_joining_by_number_and_by_string_share_the_room(chat) :
+    alice, bob = Client(), Client()
+    assert alice.send("register", username = "alice", password = "secret")["code"] == 200
+    assert alice.send("join_room", room_ID = 1, room_password = "test5")["code"] == 200
+    assert bob.send("join_room", room_ID = "1", room_password = "test5")["code"] == 200
+    assert len(chat.room_index.members("1")) == 2
+    alice.send("send_message", message = "hello")
+    assert wait_for(lambda : messages(bob))
+    event = messages(bob)[-1]
+    assert (event["room_ID"], event["seq"], event["message"]) == ("1", 1, "alice >> hello")
+    assert messages(alice) == []
+    assert bob.send("join_room", room_ID = 1, room_password = "wrong")["code"] == 400
+
+def test_login_and_registration(chat) :
+    client = Client()
+    response = client.send("register", username = "alice", password = "secret")
+    assert (response["code"], response["username"]) == (200, "alice")
+    assert client.send("register", username = "alice", password = "other")["code"] == 400
+    assert Client().send("login", username = "alice", password = "other")["code"] == 400
+    response = Client().send("login", username = "alice", password = "secret")
+    assert (response["code"], response["username"]) == (200, "alice")
+    assert chat.session_tokens.verify_token(response["token"])["username"] == "alice"
+
+# a failed login or registration leaves the session as it was : it never takes the username it asked for
+def test_failed_login_keeps_the_identity_of_the_session(chat) :
+    client = Client()
+    assert client.send("register", username = "alice", password = "secret")["code"] == 200
+    assert client.send("login", username = "admin", password = "wrong")["code"] == 400
+    assert client.send("register", username = "admin", password = "mine")["code"] == 400
+    assert (client.session.username, client.session.authenticated) == ("alice", True)
+    assert client.send("stats")["code"] == 400
+
+    response = client.send("join_room", room_ID = 1, room_password = "test5")
+    assert chat.session_tokens.verify_token(response["token"])["username"] == "alice"
+    resumed = Client()
+    response = resumed.send("resume", token = response["token"])
+    assert (response["code"], response["username"], response["room_ID"]) == (200, "alice", "1")
+    assert resumed.send("stats")["code"] == 400
+
+def test_failed_login_of_a_new_session_stays_anonymous(chat) :
+    client = Client()
+    assert client.send("login", username = "admin", password = "wrong")["code"] == 400
+    assert (client.session.username, client.session.authenticated) == (None, False)
+    assert "token" not in client.send("join_room", room_ID = 1, room_password = "test5")
+    assert client.send("stats")["code"] == 400
+
+def test_only_the_admin_gets_the_stats(chat) :
+    admin, client = Client(), Client()
+    assert client.send("stats")["code"] == 400
+    assert client.send("register", username = "alice", password = "secret")["code"] == 200
+    assert client.send("stats")["code"] == 400
+    assert admin.send("login", username = "admin", password = "admin123")["code"] == 200
+    response = admin.send("stats")
+    assert response["code"] == 200
+    assert response["stats"]["storage"]["backend"] == "sqlite"
+    assert "action.login" in response["stats"]["latency"]
+    # a session resumed from the token of the admin is the admin
+    token = admin.socket.received()[0]["token"]
+    resumed = Client()
+    assert resumed.send("resume", token = token)["code"] == 200
+    assert resumed.send("stats")["code"] == 200
+
+# the plain text frames of the chatting history the client received
+def history_lines(client) :
+    return [line for payload in client.socket.payloads if payload[:1] != b"{" for line in payload.decode('utf-8').splitlines()]
+
+def test_join_sends_the_tail_of_the_history_and_history_pages_back(chat) :
+    for number in range(1, 61) :
+        chat.history.append("1", f"bob >> message {number}")
+    client = Client()
+    response = client.send("join_room", room_ID = 1, room_password = "test5")
+    assert (response["last_seq"], response["sync"], response["cursor"]) == (60, "full", 11)
+    lines = history_lines(client)
+    assert lines[0] == "Chatting History : "
+    assert lines[1:] == [f"bob >> message {number}" for number in range(11, 61)]
+
+    response = client.send("history", before = 11, limit = 4)
+    assert [message["seq"] for message in response["messages"]] == [7, 8, 9, 10]
+    assert response["cursor"] == 7
+    response = client.send("history", before = 7)
+    assert [message["seq"] for message in response["messages"]] == [1, 2, 3, 4, 5, 6]
+    assert response["cursor"] is None
+    assert client.send("history", before = "7")["code"] == 400
+    assert Client().send("history")["code"] == 400
+
+def test_empty_room_has_no_history(chat) :
+    client = Client()
+    response = client.send("join_room", room_ID = 1, room_password = "test5")
+    assert (response["last_seq"], response["cursor"]) == (0, None)
+    assert history_lines(client) == ["No Chatting History"]
+
+# a fractional room timeout is accepted in either encoding
+def test_create_room_with_a_fractional_timeout_in_binary(chat) :
+    client = Client()
+    action = decode_action(encode_action({"action" : "create_room", "room_name" : "lobby", "room_description" : "",
+                                          "room_password" : "secret", "room_timeout" : 1.5}))
+    server.handle_action(client.socket, action, client.session)
+    assert client.socket.last_response()["code"] == 200
+    room = next(room for room in chat.room_catalog.rooms.values() if room["room_name"] == "lobby")
+    assert chat.room_catalog.room_timeout(room["room_ID"]) == 1.5
+    assert client.send("create_room", room_name = "bad", room_description = "", room_password = "", room_timeout = True)["code"] == 400
+
+def test_compressed_client_gets_the_same_history(chat) :
+    for number in range(1, 101) :
+        chat.history.append("1", f"bob >> message {number}")
+    client = Client()
+    response = client.send("hello", compressions = ["zlib"])
+    assert response["compression"] == "zlib"
+    start = len(client.socket.payloads)
+    server.handle_action(client.socket, {"action" : "join_room", "room_ID" : 1, "room_password" : "test5"}, client.session)
+    payloads = [decompress_payload(payload, 1 << 24) for payload in client.socket.payloads[start:]]
+    assert json.loads(payloads[0])["last_seq"] == 100
+    lines = [line for payload in payloads[1:] for line in payload.decode('utf-8').splitlines()]
+    assert lines == ["Chatting History : "] + [f"bob >> message {number}" for number in range(51, 101)]
+    assert chat.history_blocks.metrics()["cached_blocks"] >= 1
+
+# the presence events the client received
+def presence_events(client) :
+    return [event for event in client.socket.received("event") if event["event"] == "presence"]
+
+# a user counts once however many sessions it has in the room, the changes go out when the presence index flushes
+def test_who_and_the_presence_events(chat) :
+    chat.presence.flush()
+    alice, bob, second_bob = Client(), Client(), Client()
+    assert alice.send("who", room_ID = 1)["code"] == 400
+    assert alice.send("register", username = "alice", password = "secret")["code"] == 200
+    assert bob.send("register", username = "bob", password = "secret")["code"] == 200
+    assert second_bob.send("login", username = "bob", password = "secret")["code"] == 200
+    assert alice.send("who")["code"] == 400
+    for client in (alice, bob, second_bob) :
+        assert client.send("join_room", room_ID = 1, room_password = "test5")["code"] == 200
+    response = alice.send("who")
+    assert (response["room_ID"], response["count"], response["users"]) == ("1", 2, ["alice", "bob"])
+    assert alice.send("who", room_ID = 99)["code"] == 400
+
+    chat.presence.flush()
+    event = presence_events(alice)[-1]
+    assert (event["room_ID"], event["joined"], event["left"], event["count"]) == ("1", ["alice", "bob"], [], 2)
+    assert chat.presence.member_counts()[1]["1"] == 2
+
+    bob.send("disconnect")
+    chat.presence.flush()
+    assert len(presence_events(alice)) == 1
+    second_bob.send("disconnect")
+    chat.presence.flush()
+    event = presence_events(alice)[-1]
+    assert (event["joined"], event["left"], event["count"]) == ([], ["bob"], 1)
+    assert alice.send("who")["users"] == ["alice"]
@@ -0,0 +1,84 @@
+import sqlite3
+import pytest
+from db import standin
+from storage.mysql_storage import MySQLStorage
+from storage.sqlite_storage import SQLiteStorage
+
+# every backend but "mysql", which needs a MySQL server : the stand-in runs the same queries as it
+@pytest.fixture(params = ["sqlite", "standin"])
+def storage(request, tmp_path) :
+    if request.param == "sqlite" :
+        storage = SQLiteStorage(str(tmp_path / "chatroom.db"), min_size = 1, max_size = 2)
+    else :
+        standin.create_database(str(tmp_path / "standin.db"))
+        storage = MySQLStorage(driver = standin, connect = standin.connect, min_size = 1, max_size = 2)
+    storage.start()
+    yield storage
+    storage.close()
+
+def test_users(storage) :
+    assert storage.find_user("alice") is None
+    assert storage.add_user("alice", "first")
+    assert not storage.add_user("alice", "again")
+    user = storage.find_user("alice")
+    assert (user["username"], user["password"]) == ("alice", "first")
+    storage.set_password("alice", "second")
+    assert storage.find_user("alice")["password"] == "second"
+    assert storage.find_user("admin")["password"] == "admin123"
+
+def test_rooms(storage) :
+    assert [room["room_name"] for room in storage.load_rooms()] == ["test"]
+    room_ID = storage.add_room({"room_name" : "lobby", "room_password" : "secret", "room_timeout" : 60, "retention_messages" : 100})
+    assert room_ID is not None
+    assert storage.room_exists(room_ID)
+    room = next(room for room in storage.load_rooms() if room["room_ID"] == room_ID)
+    assert (room["room_timeout"], room["retention_messages"], room["retention_age"]) == (60, 100, None)
+    assert storage.delete_room(room_ID)
+    assert not storage.room_exists(room_ID)
+    assert not storage.delete_room(room_ID)
+
+def test_queries_give_their_connection_back(storage) :
+    for number in range(10) :
+        storage.add_user(f"user{number}", "password")
+        storage.find_user(f"user{number}")
+    metrics = storage.metrics()["pool"]
+    assert metrics["in_use"] == 0
+    assert metrics["size"] <= 2
+
+# the tables of a dump.sql from before the room timeouts and the retention policies, which upgrade.sql adds the columns of
+OLD_SCHEMA = """
+create table users (user_ID integer primary key autoincrement, username varchar(60) not null unique, password varchar(60) not null);
+create table rooms (room_ID integer primary key autoincrement, room_name varchar(60) not null, room_description varchar(240),
+                    room_password varchar(60), created_at timestamp default current_timestamp);
+"""
+
+def test_rooms_table_without_the_upgrade(tmp_path) :
+    path = str(tmp_path / "standin.db")
+    connection = sqlite3.connect(path)
+    connection.executescript(OLD_SCHEMA)
+    connection.close()
+    standin.create_database(path)
+    storage = MySQLStorage(driver = standin, connect = standin.connect, min_size = 1, max_size = 2)
+    storage.start()
+
+    assert [(room["room_ID"], room["room_name"]) for room in storage.load_rooms()] == [(1, "test")]
+    room_ID = storage.add_room({"room_name" : "lobby", "room_password" : "secret", "room_timeout" : 60, "retention_messages" : 100})
+    assert room_ID == 2
+    assert storage.room_exists(room_ID)
+    assert [room["room_name"] for room in storage.load_rooms()] == ["test", "lobby"]
+    assert storage.metrics()["pool"]["in_use"] == 0
+    storage.close()
+
+def test_unknown_column_is_a_programming_error(tmp_path) :
+    standin.create_database(str(tmp_path / "standin.db"))
+    cursor = standin.connect().cursor()
+    try :
+        cursor.execute("SELECT missing FROM rooms")
+    except standin.ProgrammingError as exception :
+        assert exception.errno == standin.UNKNOWN_COLUMN
+    else :
+        raise AssertionError("the query did not fail")
+    try :
+        cursor.execute("SELECT * FROM missing")
+    except standin.Error as exception :
+        assert not isinstance(exception, standin.ProgrammingError) and exception.errno is None
@@ -0,0 +1,7 @@
+-- brings a chatroom database created from an older dump.sql up to date, without touching its users, rooms or passwords
+-- run it once against an existing database : mysql chatroom < upgrade.sql (a fresh install only needs dump.sql)
+
+alter table rooms add column room_timeout int after room_password;
+alter table rooms add column retention_age int after room_timeout;
+alter table rooms add column retention_messages int after retention_age;
+alter table rooms add column retention_bytes bigint after retention_messages;